@@ -39,6 +39,29 @@ public class KyukouApiClient : MonoBehaviour
     /// </summary>
     public KyukouResponse? LastResponse { get; private set; }
 
+    /// <summary>
+    /// 新しい休講情報・変更された休講情報をイベントストリームで受け取ったときのコールバック
+    /// </summary>
+    public System.Action<CancellationEvent>? OnCancellationEvent;
+
+    /// <summary>
+    /// イベントストリームに接続中かどうか
+    /// </summary>
+    public bool IsStreaming { get; private set; } = false;
+
+    /// <summary>
+    /// /api/kyukou/latest の前回の応答の ETag と、そのリクエストURL（条件付きリクエスト用）
+    /// </summary>
+    private string? lastLatestEtag;
+    private string? lastLatestUrl;
+
+    /// <summary>
+    /// イベントストリームの接続と、再接続時に送る最後に受け取ったイベントID
+    /// </summary>
+    private UnityWebRequest? streamRequest;
+    private string? streamApiToken;
+    private string? lastEventId;
+
     private void Start()
     {
         // 初期化時にデバッグログ出力
@@ -54,6 +77,15 @@ private void Start()
     /// <param name="apiToken">Canvas APIトークン</param>
     /// <param name="forceRefresh">キャッシュを無視して強制更新</param>
     public void GetKyukouInfo(string? apiToken = null, bool forceRefresh = false)
+    {
+        string endpoint = useLatestCache && !forceRefresh ? "/api/kyukou/latest" : "/api/kyukou";
+        StartKyukouRequest(apiToken, endpoint, forceRefresh);
+    }
+
+    /// <summary>
+    /// 休講情報の取得を開始（取得中の場合は何もしない）
+    /// </summary>
+    private void StartKyukouRequest(string? apiToken, string endpoint, bool forceRefresh)
     {
         if (IsLoading)
         {
@@ -64,18 +96,16 @@ public void GetKyukouInfo(string? apiToken = null, bool forceRefresh = false)
             return;
         }
 
-        StartCoroutine(GetKyukouInfoCoroutine(apiToken, forceRefresh));
+        StartCoroutine(GetKyukouInfoCoroutine(apiToken, endpoint, forceRefresh));
     }
 
     /// <summary>
     /// 休講情報取得のコルーチン
     /// </summary>
-    private IEnumerator GetKyukouInfoCoroutine(string? apiToken, bool forceRefresh)
+    private IEnumerator GetKyukouInfoCoroutine(string? apiToken, string endpoint, bool forceRefresh)
     {
         IsLoading = true;
 
-        // エンドポイントURLを決定
-        string endpoint = useLatestCache && !forceRefresh ? "/api/kyukou/latest" : "/api/kyukou";
         string url = $"{apiBaseUrl}{endpoint}";
 
         // クエリパラメータ追加
@@ -108,12 +138,32 @@ private IEnumerator GetKyukouInfoCoroutine(string? apiToken, bool forceRefresh)
             // タイムアウト設定
             request.timeout = (int)timeoutSeconds;
 
+            // 最新結果の取得では前回の ETag を送り、変更がなければ本文なしの 304 を受け取る
+            bool isLatestRequest = endpoint == "/api/kyukou/latest";
+            if (isLatestRequest && LastResponse != null && lastLatestEtag != null && lastLatestUrl == url)
+            {
+                request.SetRequestHeader("If-None-Match", lastLatestEtag);
+            }
+
             // リクエスト送信
             yield return request.SendWebRequest();
 
             // レスポンス処理
-            if (request.result == UnityWebRequest.Result.Success)
+            if (request.result == UnityWebRequest.Result.Success && request.responseCode == 304 && LastResponse != null)
             {
+                if (enableDebugLog)
+                {
+                    Debug.Log("[KyukouApiClient] 休講情報に変更はありません（304 Not Modified）");
+                }
+                OnKyukouReceived?.Invoke(LastResponse);
+            }
+            else if (request.result == UnityWebRequest.Result.Success)
+            {
+                if (isLatestRequest)
+                {
+                    lastLatestEtag = request.GetResponseHeader("ETag");
+                    lastLatestUrl = url;
+                }
                 yield return ProcessSuccessResponse(request.downloadHandler.text);
             }
             else
@@ -272,6 +322,113 @@ private IEnumerator CheckServerHealthCoroutine()
         }
     }
 
+    /// <summary>
+    /// イベントストリーム（/api/kyukou/stream）に接続し、休講情報の変更を受け取る
+    /// 切断された場合は自動的に再接続し、最後に受け取ったイベントの続きから受け取る
+    /// </summary>
+    /// <param name="apiToken">Canvas APIトークン</param>
+    public void StartEventStream(string? apiToken = null)
+    {
+        if (IsStreaming)
+        {
+            return;
+        }
+
+        IsStreaming = true;
+        streamApiToken = apiToken;
+        StartCoroutine(EventStreamCoroutine());
+    }
+
+    /// <summary>
+    /// イベントストリームを切断する
+    /// </summary>
+    public void StopEventStream()
+    {
+        IsStreaming = false;
+        streamRequest?.Abort();
+    }
+
+    private void OnDestroy()
+    {
+        StopEventStream();
+    }
+
+    /// <summary>
+    /// イベントストリームのコルーチン（切断されたらサーバーが指定した間隔をあけて再接続する）
+    /// </summary>
+    private IEnumerator EventStreamCoroutine()
+    {
+        while (IsStreaming)
+        {
+            string url = $"{apiBaseUrl}/api/kyukou/stream";
+            if (!string.IsNullOrEmpty(streamApiToken))
+            {
+                url += $"?canvas_token={UnityWebRequest.EscapeURL(streamApiToken)}";
+            }
+
+            var handler = new ServerSentEventHandler(HandleStreamEvent);
+            using (UnityWebRequest request = new UnityWebRequest(url, UnityWebRequest.kHttpVerbGET, handler, null))
+            {
+                streamRequest = request;
+                if (lastEventId != null)
+                {
+                    request.SetRequestHeader("Last-Event-ID", lastEventId);
+                }
+
+                if (enableDebugLog)
+                {
+                    Debug.Log($"[KyukouApiClient] イベントストリームに接続: {url}");
+                }
+
+                // タイムアウトは設定しない（接続中はサーバーから定期的にハートビートが届く）
+                yield return request.SendWebRequest();
+                streamRequest = null;
+
+                if (IsStreaming && enableDebugLog)
+                {
+                    Debug.LogWarning($"[KyukouApiClient] イベントストリームが切断されました: {request.error}");
+                }
+            }
+
+            if (IsStreaming)
+            {
+                yield return new WaitForSeconds(handler.RetrySeconds);
+            }
+        }
+    }
+
+    /// <summary>
+    /// イベントストリームのイベントを処理する
+    /// </summary>
+    private void HandleStreamEvent(string? eventId, string eventName, string data)
+    {
+        if (eventId != null)
+        {
+            lastEventId = eventId;
+        }
+
+        switch (eventName)
+        {
+            case "cancellation":
+                var cancellationEvent = JsonUtility.FromJson<CancellationEvent>(data);
+                if (enableDebugLog)
+                {
+                    Debug.Log($"[KyukouApiClient] 休講情報の{(cancellationEvent.changed ? "変更" : "追加")}: {cancellationEvent.course_name} {cancellationEvent.date} {cancellationEvent.period}");
+                }
+                OnCancellationEvent?.Invoke(cancellationEvent);
+                break;
+            case "reset":
+                // 取りこぼしたイベントがあるため、最新の結果を取得し直す
+                // （useLatestCache の設定にかかわらず /api/kyukou/latest を使い、休講情報の取得処理は実行させない）
+                if (enableDebugLog)
+                {
+                    Debug.Log("[KyukouApiClient] イベントの続きから再開できないため、最新の結果を取得し直します");
+                }
+                StartKyukouRequest(streamApiToken, "/api/kyukou/latest", false);
+                break;
+        }
+    }
+
     /// <summary>
     /// API設定の更新
     /// </summary>
@@ -285,4 +442,102 @@ public void UpdateApiSettings(string newBaseUrl, float newTimeout = 30f)
             Debug.Log($"[KyukouApiClient] API設定更新 - URL: {apiBaseUrl}, タイムアウト: {timeoutSeconds}s");
         }
     }
-}
\ No newline at end of file
+}
+
+/// <summary>
+/// Server-Sent Events を受信しながら1イベントずつ解析するダウンロードハンドラー
+/// </summary>
+public class ServerSentEventHandler : DownloadHandlerScript
+{
+    private readonly System.Action<string?, string, string> onEvent;
+    private readonly System.Text.Decoder decoder = System.Text.Encoding.UTF8.GetDecoder();
+    private readonly System.Text.StringBuilder line = new System.Text.StringBuilder();
+    private readonly System.Text.StringBuilder data = new System.Text.StringBuilder();
+    private string? eventId;
+    private string eventName = "message";
+    private bool hasData = false;
+
+    /// <summary>
+    /// サーバーが retry で指定した再接続までの時間（秒）
+    /// </summary>
+    public float RetrySeconds { get; private set; } = 5f;
+
+    public ServerSentEventHandler(System.Action<string?, string, string> onEvent) : base(new byte[4096])
+    {
+        this.onEvent = onEvent;
+    }
+
+    protected override bool ReceiveData(byte[] bytes, int dataLength)
+    {
+        // マルチバイト文字がチャンクの境目で分かれても Decoder が続きを持ち越す
+        char[] chars = new char[decoder.GetCharCount(bytes, 0, dataLength)];
+        decoder.GetChars(bytes, 0, dataLength, chars, 0);
+        foreach (char c in chars)
+        {
+            if (c == '\n')
+            {
+                ProcessLine(line.ToString());
+                line.Clear();
+            }
+            else if (c != '\r')
+            {
+                line.Append(c);
+            }
+        }
+        return true;
+    }
+
+    private void ProcessLine(string text)
+    {
+        // 空行でイベントを確定する
+        if (text.Length == 0)
+        {
+            if (hasData)
+            {
+                onEvent(eventId, eventName, data.ToString());
+            }
+            eventName = "message";
+            data.Clear();
+            hasData = false;
+            return;
+        }
+
+        // コメント行（ハートビート）
+        if (text[0] == ':')
+        {
+            return;
+        }
+
+        int colon = text.IndexOf(':');
+        string field = colon < 0 ? text : text.Substring(0, colon);
+        string value = colon < 0 ? "" : text.Substring(colon + 1);
+        if (value.StartsWith(" "))
+        {
+            value = value.Substring(1);
+        }
+
+        switch (field)
+        {
+            case "id":
+                eventId = value;
+                break;
+            case "event":
+                eventName = value;
+                break;
+            case "data":
+                if (hasData)
+                {
+                    data.Append('\n');
+                }
+                data.Append(value);
+                hasData = true;
+                break;
+            case "retry":
+                if (int.TryParse(value, out int milliseconds))
+                {
+                    RetrySeconds = milliseconds / 1000f;
+                }
+                break;
+        }
+    }
+}
@@ -50,6 +50,22 @@ public class Cancellation
         public double confidence = 0.0;
     }
 
+    /// <summary>
+    /// イベントストリーム（/api/kyukou/stream）の cancellation イベント
+    /// </summary>
+    [Serializable]
+    public class CancellationEvent
+    {
+        public int course_id = 0;
+        public string course_name = "";
+        public int announcement_id = 0;
+        public string date = "";
+        public string period = "";
+        public bool canceled = false;
+        public string message = "";
+        public bool changed = false;
+    }
+
     /// <summary>
     /// API エラーレスポンス
     /// </summary>
@@ -0,0 +1,364 @@
+"""
+GPT分析スケジューラー
+
+複数のお知らせの休講判定を並行して実行します。
+OpenAI APIのレート制限（リクエスト数/分・トークン数/分）をトークンバケットで守り、
+429（Rate Limit）・5xx・タイムアウトの場合は Retry-After に従うか、ジッター付きの指数バックオフで再試行します。
+"""
+
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date
+from typing import Callable, Dict, List, Optional, Tuple
+
+from gpt_analyzer import (
+    analysis_tiers, batch_max_tokens, build_batch_messages, build_messages, lookup_analysis,
+    request_model_analysis, request_model_analysis_batch, run_cascade, run_cascade_batch, store_analysis
+)
+from metrics import GPT_ERRORS, GPT_REQUESTS, GPT_RETRIES, GPT_SKIPPED
+from relevance_model import screen
+from config import Config, get_logger
+
+logger = get_logger(__name__)
+
+class TokenBucket:
+    """
+    1分あたりの上限を持つトークンバケット
+
+    acquire() は必要な量が貯まるまでブロックします。
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0  # 1秒あたりの補充量
+        self._available = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float = 1.0):
+        """amount だけ消費する（足りない場合は貯まるまで待つ）"""
+        # 上限を超える量は一度に消費できないため、上限で打ち切る
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._available >= amount:
+                    self._available -= amount
+                    return
+                wait = (amount - self._available) / self.rate
+            time.sleep(wait)
+
+    def adjust(self, amount: float):
+        """見積もりと実際の消費量の差を反映する（正なら追加消費、負なら返却）"""
+        with self._lock:
+            self._refill()
+            self._available = min(self.capacity, self._available - amount)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._available = min(self.capacity, self._available + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+def _retry_after_seconds(error: Exception) -> Optional[float]:
+    """APIエラーのレスポンスヘッダーから再試行までの待ち時間（秒）を取得する"""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000.0
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except ValueError:
+        return None
+    return None
+
+def _is_retryable(error: Exception) -> bool:
+    """再試行すべきエラー（429・5xx・タイムアウト・接続エラー）かどうか"""
+    import openai  # openai の読み込みは最初のAPI呼び出しまで遅らせる（通常はクライアント作成時に読み込み済み）
+    if isinstance(error, (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+def _estimate_tokens(messages: List[Dict], max_tokens: int) -> int:
+    """メッセージの文字数と最大出力トークン数でトークン消費を見積もる（日本語はおおむね1文字1トークン）"""
+    return sum(len(message['content']) for message in messages) + max_tokens
+
+def _error_result(error: Exception) -> Dict:
+    return {"error": str(error), "raw_response": getattr(error, 'raw_response', 'N/A')}
+
+# RunStats の項目のうち、プロセス全体の累計としても記録するもの（metrics）
+_RUN_COUNTERS = {
+    'skipped': GPT_SKIPPED,
+    'requests': GPT_REQUESTS,
+    'retries': GPT_RETRIES,
+    'errors': GPT_ERRORS,
+}
+
+class RunStats:
+    """1回の analyze_many の統計情報（プロセス全体の累計は metrics に記録する）"""
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.submitted = 0
+        self.skipped = 0   # ルールベース抽出・保存済み結果でAPIを呼ばなかった件数
+        self.gated = 0     # 関連度モデルで休講ではないと判定しAPIを呼ばなかった件数（metrics は relevance_model で記録する）
+        self.requests = 0
+        self.escalated = 0  # 段階的な判定で次のモデルで判定し直した件数（metrics は gpt_analyzer で記録する）
+        self.retries = 0
+        self.errors = 0
+        self.tokens = 0
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+        for name, value in counts.items():
+            counter = _RUN_COUNTERS.get(name)
+            if counter is not None:
+                counter.inc(value)
+
+    def to_dict(self) -> Dict:
+        elapsed = time.monotonic() - self.started_at
+        return {
+            'submitted': self.submitted,
+            'skipped': self.skipped,
+            'gated': self.gated,
+            'requests': self.requests,
+            'escalated': self.escalated,
+            'retries': self.retries,
+            'errors': self.errors,
+            'tokens': self.tokens,
+            'elapsed_seconds': round(elapsed, 3),
+            'announcements_per_second': round(self.submitted / elapsed, 3) if elapsed > 0 else None,
+            'tokens_per_minute': round(self.tokens / elapsed * 60, 1) if elapsed > 0 else None
+        }
+
+class AnalysisScheduler:
+    """
+    レート制限を守りながらお知らせの休講判定を並行実行するクラス
+
+    レート制限と再試行待ちはインスタンス内で共有されるため、
+    複数の実行（APIサーバーの同時リクエストなど）で1つのインスタンスを使い回してください。
+    """
+
+    def __init__(self, max_workers: int, requests_per_minute: int, tokens_per_minute: int,
+                 max_retries: int, retry_base_delay: float, retry_max_delay: float):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gpt")
+        self._request_bucket = TokenBucket(requests_per_minute)
+        self._token_bucket = TokenBucket(tokens_per_minute)
+        self._max_retries = max_retries
+        self._retry_base_delay = retry_base_delay
+        self._retry_max_delay = retry_max_delay
+        # Retry-After を受け取ったら、全ワーカーがこの時刻まで新しいリクエストを控える
+        self._paused_until = 0.0
+        self._pause_lock = threading.Lock()
+
+    def submit(self, title: str, body: str, course_name: Optional[str] = None,
+               reference_date: Optional[date] = None, stats: Optional[RunStats] = None) -> Future:
+        """1件のお知らせの休講判定を登録し、結果（analyze_announcement と同じ形式の辞書）の Future を返す"""
+        stats = stats or RunStats()
+        stats.add(submitted=1)
+        return self._executor.submit(self._analyze, title, body, course_name, reference_date, stats)
+
+    def analyze_many(self, items: List[Dict], batch_size: Optional[int] = None) -> Tuple[List[Dict], Dict]:
+        """
+        複数のお知らせを並行して休講判定する
+
+        ルールベース抽出・保存済みの結果で判定できないお知らせは、関連度モデル（relevance_model）でまとめて採点し、
+        休講ではないと判定できたものはAPIを呼びません。
+        batch_size が2以上の場合は、APIを呼ぶ必要のあるお知らせを batch_size 件ずつ
+        1回のリクエストにまとめて判定します（request_model_analysis_batch）。
+        ANALYSIS_CASCADE_MODELS を設定した場合は、安いモデルから順に判定します（gpt_analyzer.run_cascade）。
+
+        Args:
+            items: title, body, course_name, reference_date をキーに持つ辞書のリスト
+            batch_size: 1回のリクエストで判定するお知らせ数（Noneの場合は Config.ANALYSIS_BATCH_SIZE）
+
+        Returns:
+            (入力と同じ順序の判定結果のリスト, 統計情報)
+        """
+        batch_size = batch_size or Config.ANALYSIS_BATCH_SIZE
+        stats = RunStats()
+        results, misses = self._resolve_without_api(items, stats)
+        if batch_size > 1:
+            self._analyze_batched(items, misses, results, batch_size, stats)
+        else:
+            futures = [
+                (index, self._executor.submit(self._request, items[index]['title'], items[index]['body'], stats))
+                for index in misses
+            ]
+            for index, future in futures:
+                results[index] = future.result()
+
+        run_stats = stats.to_dict()
+        if items:
+            logger.info(
+                f"GPT分析: {run_stats['submitted']}件（API呼び出し {run_stats['requests']}回, "
+                f"関連度モデルで除外 {run_stats['gated']}件, 上位モデルでの再判定 {run_stats['escalated']}件, "
+                f"再試行 {run_stats['retries']}回, エラー {run_stats['errors']}件, "
+                f"{run_stats['tokens']}トークン, {run_stats['elapsed_seconds']}秒, "
+                f"{run_stats['announcements_per_second']}件/秒）"
+            )
+        return results, run_stats
+
+    def _resolve_without_api(self, items: List[Dict], stats: RunStats) -> Tuple[List[Optional[Dict]], List[int]]:
+        """
+        APIを呼ばずに判定できるもの（ルールベース抽出・保存済み結果・関連度モデル）を先に片付ける
+
+        Returns:
+            (判定結果のリスト（APIで判定するものは None）, APIで判定するお知らせの位置のリスト)
+        """
+        results: List[Optional[Dict]] = [None] * len(items)
+        misses = []
+        for index, item in enumerate(items):
+            stats.add(submitted=1)
+            cached_result = lookup_analysis(item['title'], item['body'], item.get('course_name'), item.get('reference_date'))
+            if cached_result is not None:
+                stats.add(skipped=1)
+                results[index] = cached_result
+            else:
+                misses.append(index)
+
+        remaining = []
+        for index, gated_result in zip(misses, screen([items[index] for index in misses])):
+            if gated_result is not None:
+                stats.add(gated=1)
+                results[index] = gated_result
+            else:
+                remaining.append(index)
+        return results, remaining
+
+    def _analyze_batched(self, items: List[Dict], indexes: List[int], results: List[Optional[Dict]],
+                         batch_size: int, stats: RunStats):
+        """items のうち indexes の位置のお知らせを batch_size 件ずつまとめて判定し、results に書き込む"""
+        misses = [{'id': str(index), 'title': items[index]['title'], 'body': items[index]['body']} for index in indexes]
+        chunks = [misses[i:i + batch_size] for i in range(0, len(misses), batch_size)]
+        futures = [self._executor.submit(self._analyze_chunk, chunk, stats) for chunk in chunks]
+        for chunk, future in zip(chunks, futures):
+            chunk_results = future.result()
+            for item in chunk:
+                analysis_result = chunk_results.get(item['id'])
+                if analysis_result is None:
+                    logger.error(f"まとめて判定した応答にお知らせが含まれていませんでした: {item['title']}")
+                    stats.add(errors=1)
+                    analysis_result = {"error": "応答に判定結果が含まれていませんでした", "raw_response": 'N/A'}
+                results[int(item['id'])] = analysis_result
+
+    def _analyze(self, title: str, body: str, course_name: Optional[str],
+                 reference_date: Optional[date], stats: RunStats) -> Dict:
+        cached_result = lookup_analysis(title, body, course_name, reference_date)
+        if cached_result is not None:
+            stats.add(skipped=1)
+            return cached_result
+        return self._request(title, body, stats)
+
+    def _request(self, title: str, body: str, stats: RunStats) -> Dict:
+        # 段階的に判定する場合も、モデルごとの1回のリクエストをそれぞれレート制限・再試行の対象にする
+        estimated_tokens = _estimate_tokens(build_messages(title, body), Config.OPENAI_MAX_TOKENS)
+        first_model = analysis_tiers()[0]
+
+        def call(model: str) -> Dict:
+            if model != first_model:
+                stats.add(escalated=1)
+            return self._call_with_retries(
+                lambda: request_model_analysis(title, body, model, max_retries=0), estimated_tokens, stats
+            )
+
+        try:
+            analysis_result, model = run_cascade(call)
+        except Exception as e:
+            logger.error(f"OpenAI APIエラーまたはJSON解析エラーが発生しました: {e}")
+            stats.add(errors=1)
+            return _error_result(e)
+        store_analysis(title, body, analysis_result, model)
+        return analysis_result
+
+    def _analyze_chunk(self, chunk: List[Dict], stats: RunStats) -> Dict[str, Dict]:
+        first_model = analysis_tiers()[0]
+
+        def call(model: str, items: List[Dict]) -> Dict[str, Dict]:
+            if model != first_model:
+                stats.add(escalated=len(items))
+            estimated_tokens = _estimate_tokens(build_batch_messages(items), batch_max_tokens(len(items)))
+            return self._call_with_retries(
+                lambda: request_model_analysis_batch(items, model, max_retries=0), estimated_tokens, stats
+            )
+
+        try:
+            results, models = run_cascade_batch(chunk, call)
+        except Exception as e:
+            logger.error(f"OpenAI APIエラーまたはJSON解析エラーが発生しました: {e}")
+            stats.add(errors=len(chunk))
+            return {item['id']: _error_result(e) for item in chunk}
+        for item in chunk:
+            if item['id'] in results:
+                store_analysis(item['title'], item['body'], results[item['id']], models[item['id']])
+        return results
+
+    def _call_with_retries(self, call: Callable[[], Tuple[object, int]], estimated_tokens: int, stats: RunStats):
+        """
+        レート制限を守って call を実行し、再試行可能なエラーの場合は待ってから再試行する
+
+        call は (結果, 消費トークン数) を返す関数です。再試行できないエラーや
+        再試行回数を超えたエラーはそのまま送出します。
+        """
+        attempt = 0
+        while True:
+            self._wait_for_pause()
+            self._request_bucket.acquire(1)
+            self._token_bucket.acquire(estimated_tokens)
+            stats.add(requests=1)
+            try:
+                result, used_tokens = call()
+                self._token_bucket.adjust(used_tokens - estimated_tokens)
+                stats.add(tokens=used_tokens)
+                return result
+            except Exception as e:
+                if not _is_retryable(e) or attempt >= self._max_retries:
+                    raise
+
+                delay = self._retry_delay(e, attempt)
+                logger.warning(f"OpenAI APIエラーのため{delay:.1f}秒後に再試行します（{attempt + 1}/{self._max_retries}）: {e}")
+                stats.add(retries=1)
+                attempt += 1
+                time.sleep(delay)
+
+    def _retry_delay(self, error: Exception, attempt: int) -> float:
+        """再試行までの待ち時間を決める（Retry-After があれば優先し、全ワーカーを一時停止する）"""
+        retry_after = _retry_after_seconds(error)
+        if retry_after is not None:
+            with self._pause_lock:
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            return retry_after
+        # フルジッター付き指数バックオフ
+        return random.uniform(0, min(self._retry_max_delay, self._retry_base_delay * (2 ** attempt)))
+
+    def _wait_for_pause(self):
+        with self._pause_lock:
+            wait = self._paused_until - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler() -> AnalysisScheduler:
+    """共有の AnalysisScheduler を取得する"""
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = AnalysisScheduler(
+                    max_workers=Config.OPENAI_MAX_CONCURRENCY,
+                    requests_per_minute=Config.OPENAI_REQUESTS_PER_MINUTE,
+                    tokens_per_minute=Config.OPENAI_TOKENS_PER_MINUTE,
+                    max_retries=Config.OPENAI_MAX_RETRIES,
+                    retry_base_delay=Config.OPENAI_RETRY_BASE_DELAY,
+                    retry_max_delay=Config.OPENAI_RETRY_MAX_DELAY
+                )
+    return _scheduler
@@ -0,0 +1,150 @@
+"""
+GPT分析結果の保存モジュール
+
+お知らせの内容（正規化したタイトル・本文）とプロンプトのバージョン・モデル名から
+ハッシュキーを作り、休講かどうかに関わらずすべての判定結果をデータベース（database.py）に保存します。
+同じ内容のお知らせを再分析するときは、OpenAI APIを呼ばずに保存済みの結果を返せます。
+"""
+
+import copy
+import hashlib
+import threading
+import unicodedata
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from database import get_connection, transaction
+from metrics import ANALYSIS_STORE_LOOKUPS, hit_ratio
+from serialization import dumps_str, loads
+from config import get_logger
+
+logger = get_logger(__name__)
+
+def normalize_text(text: Optional[str]) -> str:
+    """
+    ハッシュ計算用にテキストを正規化する（NFKC正規化・空白の統一・前後の空白除去）
+    """
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKC", text)
+    return " ".join(text.split())
+
+def make_analysis_key(title: str, body: str, prompt_version: str, model: str) -> str:
+    """
+    分析結果の保存キーを作成する
+
+    Args:
+        title: お知らせのタイトル
+        body: お知らせの本文
+        prompt_version: プロンプトのバージョン
+        model: 使用するモデル名
+
+    Returns:
+        SHA-256の16進文字列
+    """
+    payload = "\x1f".join([normalize_text(title), normalize_text(body), prompt_version, model])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class AnalysisStore:
+    """
+    分析結果をデータベースの analyses テーブルに保存するキー・バリューストア
+
+    読み込みはキーごとにデータベースを参照し、書き込みは flush() で1つのトランザクションにまとめて行います。
+    """
+
+    def __init__(self):
+        self._pending: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Dict]:
+        """保存済みの分析結果を返す（存在しない場合は None）"""
+        result = self._load(key)
+        ANALYSIS_STORE_LOOKUPS.inc(result='miss' if result is None else 'hit')
+        return result
+
+    def get_first(self, keys: List[str], accept: Optional[Callable[[int, Dict], bool]] = None) -> Optional[Dict]:
+        """
+        keys の順に保存済みの分析結果を探し、最初に見つかったものを返す（ヒット・ミスは1回の検索として数える）
+
+        accept を指定した場合は、accept(keys での位置, 分析結果) が True を返す結果だけを使います。
+        """
+        result = None
+        for position, key in enumerate(keys):
+            candidate = self._load(key)
+            if candidate is not None and (accept is None or accept(position, candidate)):
+                result = candidate
+                break
+        ANALYSIS_STORE_LOOKUPS.inc(result='miss' if result is None else 'hit')
+        return result
+
+    def _load(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            entry = self._pending.get(key)
+        if entry is not None:
+            # 呼び出し側で結果に情報を追加しても保存内容が変わらないようにコピーを返す
+            return copy.deepcopy(entry['result'])
+        row = get_connection().execute("SELECT result FROM analyses WHERE key = ?", (key,)).fetchone()
+        return loads(row['result']) if row is not None else None
+
+    def put(self, key: str, result: Dict, title: str, body: str, prompt_version: str, model: str):
+        """分析結果を保存する（データベースへの書き込みは flush() で行う）"""
+        with self._lock:
+            self._pending[key] = {
+                'result': copy.deepcopy(result),
+                'title': title,
+                'body': body,
+                'prompt_version': prompt_version,
+                'model': model,
+                'created_at': datetime.now().isoformat()
+            }
+
+    def flush(self):
+        """未保存の分析結果をデータベースに書き込む"""
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+        if not pending:
+            return
+        try:
+            with transaction() as connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO analyses (key, result, title, body, prompt_version, model, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (key, dumps_str(entry['result']), entry['title'], entry['body'],
+                         entry['prompt_version'], entry['model'], entry['created_at'])
+                        for key, entry in pending.items()
+                    ]
+                )
+        except Exception as e:
+            logger.error(f"分析結果の保存エラー: {e}")
+            # 次回の flush() で再び書き込めるよう戻しておく
+            with self._lock:
+                for key, entry in pending.items():
+                    self._pending.setdefault(key, entry)
+
+    def stats(self) -> Dict:
+        """ヒット数・ミス数などの統計情報を返す"""
+        entries = get_connection().execute("SELECT COUNT(*) FROM analyses").fetchone()[0]
+        hits = int(ANALYSIS_STORE_LOOKUPS.value(result='hit'))
+        misses = int(ANALYSIS_STORE_LOOKUPS.value(result='miss'))
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            'entries': entries + pending,
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': hit_ratio(hits, misses)
+        }
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_analysis_store() -> AnalysisStore:
+    """共有の AnalysisStore を取得する"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = AnalysisStore()
+    return _store
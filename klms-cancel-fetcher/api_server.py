@@ -6,26 +6,73 @@ KLMS休講情報API サーバー
 """
 
 import os
-import json
-from datetime import datetime
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta
 from typing import Optional, Dict, Any
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 
-from canvas_api import get_courses, get_announcements
-from gpt_analyzer import analyze_announcement
-from cache_manager import load_cache, save_cache, get_new_announcements, update_cache_with_announcements
+from pipeline import run_pipeline
+from gpt_analyzer import tier_stats
+from jobs import Job, JobManager
+from analysis_store import get_analysis_store
+import text_preprocessor
+import dedup
+import relevance_model
+from cache_manager import announcement_cache_stats, namespace_for_token
+from http_cache import get_response_cache
+from latest_index import get_latest_index
+from result_store import get_latest_analyzed_at, get_latest_result as load_latest_result
+from event_bus import encode_event, get_event_bus
+from cancellation_index import encode_page, query_cancellations
+from compression import CompressionMiddleware, choose_encoding
+from serialization import dumps, get_backend
+from metrics import REFRESH_REQUESTS, registry
 from config import Config, get_logger
 
 logger = get_logger(__name__)
 
+API_VERSION = "1.0.0"
+
+# 休講情報取得パイプラインを実行するバックグラウンドジョブ
+job_manager = JobManager(max_workers=Config.JOB_MAX_WORKERS, max_history=Config.JOB_HISTORY_LIMIT)
+
+# /api/kyukou/latest で返す最新の結果（パイプラインが結果を保存すると通知で更新される）
+latest_index = get_latest_index()
+
+# /api/kyukou/stream で送る休講情報の変更イベント（パイプラインが結果を保存すると通知で追加される）
+event_bus = get_event_bus()
+
+class FastJSONResponse(JSONResponse):
+    """serialization のバックエンド（orjson があれば orjson）でシリアライズするJSONの応答"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """起動時にイベントの通知先を設定し、別プロセスが保存した結果の確認を開始する"""
+    event_bus.attach_loop(asyncio.get_running_loop())
+    watcher = asyncio.create_task(event_bus.watch(Config.LATEST_RESULT_CHECK_INTERVAL))
+    try:
+        yield
+    finally:
+        watcher.cancel()
+
 # FastAPIアプリケーション作成
 app = FastAPI(
     title="KLMS休講情報API",
     description="KLMS Canvas APIとGPTを使用して休講情報を取得するAPI",
-    version="1.0.0"
+    version=API_VERSION,
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse
 )
 
+# 一定サイズ以上の応答を brotli・gzip で圧縮（Accept-Encoding を送らないクライアントには圧縮しない本文を返す）
+app.add_middleware(CompressionMiddleware)
+
 # CORS設定（Unity等からのアクセスを許可）
 app.add_middleware(
     CORSMiddleware,
@@ -40,9 +87,16 @@ async def root():
     """APIのルートエンドポイント"""
     return {
         "message": "KLMS休講情報API",
-        "version": "1.0.0",
+        "version": API_VERSION,
         "endpoints": {
             "kyukou": "/api/kyukou - 休講情報を取得",
+            "refresh": "POST /api/kyukou/refresh - 休講情報の取得をバックグラウンドで開始",
+            "job": "/api/kyukou/jobs/{job_id} - バックグラウンド取得の状態と結果",
+            "latest": "/api/kyukou/latest - 最新の結果ファイルから休講情報を取得",
+            "cancellations": "/api/kyukou/cancellations?from=&to=&course_id=&period= - 現在有効な休講情報を期間・コース・時限で検索",
+            "stream": "/api/kyukou/stream - 新しい休講情報・変更された休講情報をServer-Sent Eventsで受け取る",
+            "stats": "/api/kyukou/stats - 分析結果・Canvas応答の再利用状況・トークン削減量",
+            "metrics": "/metrics - 処理時間・API呼び出し・キャッシュのヒット率（Prometheus形式）",
             "health": "/health - ヘルスチェック"
         }
     }
@@ -55,6 +109,57 @@ async def health_check():
         "timestamp": datetime.now().isoformat()
     }
 
+@app.get("/metrics")
+def get_metrics():
+    """処理時間・API呼び出し・トークン数・キャッシュのヒット率をPrometheusのテキスト形式で返す（サーバー起動後の累計）"""
+    return Response(content=registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+def _recent_result(namespace: str) -> Optional[Dict]:
+    """
+    前回の実行から REFRESH_MIN_INTERVAL 秒以内であれば、その結果を返す（それ以外は None）
+
+    summary の source は "recent_result"、next_refresh_at は次に実行できる時刻です。
+    """
+    if Config.REFRESH_MIN_INTERVAL <= 0:
+        return None
+    analyzed_at = get_latest_analyzed_at(namespace)
+    if analyzed_at is None:
+        return None
+    try:
+        next_refresh_at = datetime.fromisoformat(analyzed_at) + timedelta(seconds=Config.REFRESH_MIN_INTERVAL)
+    except ValueError:
+        return None
+    if datetime.now() >= next_refresh_at:
+        return None
+    result = load_latest_result(namespace)
+    if result is None:
+        return None
+    result['summary']['source'] = 'recent_result'
+    result['summary']['next_refresh_at'] = next_refresh_at.isoformat(timespec='seconds')
+    return result
+
+def _refresh(canvas_token: Optional[str], force_refresh: bool) -> Job:
+    """
+    ユーザーの休講情報の取得・分析を開始する
+
+    同じユーザーの実行が進行中であればそのジョブにまとめ（force_refresh の要求は force_refresh の実行にだけまとめ、
+    通常の要求はどちらの実行にもまとめる）、前回の実行から REFRESH_MIN_INTERVAL 秒以内であれば
+    実行せずに前回の結果を完了済みのジョブとして返します（force_refresh の場合も同じ）。
+    同時に何人が更新を押しても、Canvas API・OpenAI APIへの負荷はユーザーごとに1回分にとどまります。
+    """
+    namespace = namespace_for_token(canvas_token)
+    recent = _recent_result(namespace)
+    if recent is not None:
+        REFRESH_REQUESTS.inc(result='throttled')
+        return job_manager.add_finished(recent)
+    # キャッシュを使う実行の結果を force_refresh の要求に返さないよう、force_refresh かどうかもキーに含める
+    job, coalesced = job_manager.submit_once(
+        (namespace, force_refresh), run_pipeline, canvas_token, force_refresh,
+        join_keys=() if force_refresh else ((namespace, True),)
+    )
+    REFRESH_REQUESTS.inc(result='coalesced' if coalesced else 'started')
+    return job
+
 @app.get("/api/kyukou")
 async def get_kyukou_info(
     canvas_token: Optional[str] = Query(None, description="Canvas APIトークン"),
@@ -63,6 +168,10 @@ async def get_kyukou_info(
     """
     休講情報を取得するAPIエンドポイント
     
+    処理はバックグラウンドジョブとしてイベントループ外で実行し、完了を待って結果を返します。
+    同じユーザーの実行が進行中の場合はその完了を待って同じ結果を返し、前回の実行から REFRESH_MIN_INTERVAL 秒以内の場合は
+    実行せずに前回の結果（summary.source が "recent_result"）を返します。
+    
     Args:
         canvas_token: Canvas APIトークン（ユーザー提供）
         force_refresh: キャッシュを無視するかどうか
@@ -76,157 +185,208 @@ async def get_kyukou_info(
         # 結果を保存するディレクトリを作成
         os.makedirs(Config.RESULTS_DIR, exist_ok=True)
         
-        # キャッシュを読み込み
-        cache = load_cache()
-        if force_refresh:
-            logger.info("強制更新: キャッシュをクリア")
-            cache = {}
-        
-        # 現在の日時を取得
-        current_time = datetime.now()
-        
-        # 全体の結果を格納するリスト
-        all_results = []
-        
-        # 1. コース一覧を取得
-        logger.info("コース一覧を取得中...")
-        courses = get_courses(canvas_token)
-        if not courses:
+        # パイプラインはスレッドプールで実行し、イベントループをブロックせずに完了を待つ
+        job = _refresh(canvas_token, force_refresh)
+        response_data = await asyncio.wrap_future(job.future)
+        if response_data is None:
             raise HTTPException(status_code=500, detail="コースの取得に失敗しました")
         
-        logger.info(f"取得したコース数: {len(courses)}")
-        
-        # 2. 各コースのお知らせを取得・分析
-        for i, course in enumerate(courses, 1):
-            course_id = course.get('id')
-            course_name = course.get('name', 'Unknown')
-            
-            logger.debug(f"[{i}/{len(courses)}] コース: {course_name} (ID: {course_id})")
-            
-            if not course_id:
-                logger.warning("コースIDが取得できませんでした。スキップします。")
-                continue
-            
-            # お知らせを取得
-            announcements = get_announcements(course_id, canvas_token)
-            if not announcements:
-                logger.debug("お知らせが見つかりませんでした。")
-                continue
-            
-            # 新しいお知らせのみを抽出
-            new_announcements = get_new_announcements(course_id, announcements, cache)
-            if not new_announcements:
-                logger.debug("新しいお知らせはありません。")
-                # キャッシュは更新しておく
-                update_cache_with_announcements(course_id, announcements, cache)
-                continue
-            
-            logger.debug(f"新しいお知らせ数: {len(new_announcements)}")
-            
-            # 新しいお知らせのみを分析
-            for ann in new_announcements:
-                ann_title = ann.get('title', '')
-                ann_body = ann.get('message', '')
-                ann_id = ann.get('id')
-                
-                logger.debug(f"分析中: {ann_title}")
-                
-                # GPTで休講判定
-                analysis_result = analyze_announcement(ann_title, ann_body)
-                
-                # エラーチェック
-                if 'error' in analysis_result:
-                    logger.error(f"分析エラー: {analysis_result['error']}")
-                    continue
-                
-                # 結果に追加情報を付与
-                analysis_result['course_id'] = course_id
-                analysis_result['course_name'] = course_name
-                analysis_result['announcement_id'] = ann_id
-                analysis_result['announcement_title'] = ann_title
-                analysis_result['analyzed_at'] = current_time.isoformat()
-                
-                # 休講の場合のみ結果に追加
-                if analysis_result.get('canceled', False):
-                    all_results.append(analysis_result)
-                    logger.info(f"休講情報を検出: {analysis_result.get('date')} {analysis_result.get('period')}")
-            
-            # キャッシュを更新
-            update_cache_with_announcements(course_id, announcements, cache)
-        
-        # キャッシュを保存
-        save_cache(cache)
-        
-        # 3. レスポンスの作成
-        response_data = {
-            'summary': {
-                'total_courses': len(courses),
-                'total_cancellations': len(all_results),
-                'analyzed_at': current_time.isoformat(),
-                'api_version': '1.0.0'
-            },
-            'cancellations': all_results
-        }
+        response_data['summary']['api_version'] = API_VERSION
         
-        logger.info(f"API応答: {len(all_results)}件の休講情報を検出")
+        logger.info(f"API応答: {response_data['summary']['total_cancellations']}件の休講情報を検出")
         return response_data
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"API実行中にエラーが発生: {e}")
         raise HTTPException(status_code=500, detail=f"内部サーバーエラー: {str(e)}")
 
+@app.post("/api/kyukou/refresh", status_code=202)
+async def start_refresh(
+    canvas_token: Optional[str] = Query(None, description="Canvas APIトークン"),
+    force_refresh: bool = Query(False, description="キャッシュを無視して強制的に最新情報を取得")
+):
+    """
+    休講情報の取得・分析をバックグラウンドジョブとして開始する
+    
+    すぐにジョブIDを返すので、/api/kyukou/jobs/{job_id} で状態と結果を確認してください。
+    同じユーザーの実行が進行中の場合はそのジョブを、前回の実行から REFRESH_MIN_INTERVAL 秒以内の場合は
+    前回の結果を持つ完了済みのジョブを返します。
+    """
+    logger.info(f"バックグラウンド更新開始 - canvas_token: {'あり' if canvas_token else 'なし'}, force_refresh: {force_refresh}")
+    os.makedirs(Config.RESULTS_DIR, exist_ok=True)
+    
+    job = _refresh(canvas_token, force_refresh)
+    response_data = job.to_dict(include_result=False)
+    response_data['status_url'] = f"/api/kyukou/jobs/{job.job_id}"
+    return response_data
+
+@app.get("/api/kyukou/jobs/{job_id}")
+async def get_refresh_job(job_id: str):
+    """
+    バックグラウンドジョブの状態を取得する
+    
+    完了済み（succeeded）の場合は result に休講情報のJSONが含まれます。
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="指定されたジョブが見つかりません")
+    
+    response_data = job.to_dict()
+    if 'result' in response_data:
+        response_data['result']['summary']['api_version'] = API_VERSION
+    return response_data
+
+@app.get("/api/kyukou/stats")
+async def get_stats():
+    """分析結果ストアのヒット数・ミス数、本文の前処理によるトークン削減量、重複するお知らせの数、関連度モデルで除外した数、モデルごとの判定数・所要時間・トークン数などを返す（サーバー起動後の累計）"""
+    return {
+        'analysis_store': get_analysis_store().stats(),
+        'preprocess': text_preprocessor.stats.to_dict(),
+        'dedup': dedup.stats.to_dict(),
+        'relevance': relevance_model.stats(),
+        'analysis_tiers': tier_stats(),
+        'canvas_responses': get_response_cache().stats(),
+        'stream': event_bus.stats(),
+        'refresh': dict(
+            job_manager.stats(),
+            started=int(REFRESH_REQUESTS.value(result='started')),
+            throttled=int(REFRESH_REQUESTS.value(result='throttled'))
+        ),
+        'json_backend': get_backend().name,
+        'memory': {
+            'announcements': announcement_cache_stats(),
+            'latest_results': latest_index.stats()
+        }
+    }
+
 @app.get("/api/kyukou/latest")
-async def get_latest_result(
-    canvas_token: Optional[str] = Query(None, description="Canvas APIトークン（現在未使用）")
+def get_latest_result(
+    request: Request,
+    canvas_token: Optional[str] = Query(None, description="Canvas APIトークン（指定したユーザーの最新の結果を返す）")
 ):
     """
-    最新の結果ファイルから休講情報を取得（高速版）
+    最新の結果から休講情報を取得（高速版）
+    
+    canvas_token ごとに、そのユーザーで最後に実行した結果を返します。
+    トークンを指定しない場合で保存済みの結果がないときは、最新の結果ファイルを返します。
+    結果はシリアライズ済みのものをメモリに保持しており（latest_index）、
+    If-None-Match・If-Modified-Since が一致する場合は本文なしの 304 Not Modified を返します。
     """
     try:
-        results_dir = Config.RESULTS_DIR
-        if not os.path.exists(results_dir):
-            return {
-                'summary': {
-                    'total_courses': 0,
-                    'total_cancellations': 0,
-                    'analyzed_at': None,
-                    'source': 'no_data'
-                },
-                'cancellations': []
-            }
-        
-        # 最新のJSONファイルを取得
-        json_files = [f for f in os.listdir(results_dir) if f.endswith('.json')]
-        if not json_files:
-            return {
-                'summary': {
-                    'total_courses': 0,
-                    'total_cancellations': 0,
-                    'analyzed_at': None,
-                    'source': 'no_results'
-                },
-                'cancellations': []
-            }
-        
-        # ファイル名でソート（日時順）
-        json_files.sort(reverse=True)
-        latest_file = os.path.join(results_dir, json_files[0])
-        
-        # JSONファイルを読み込み
-        with open(latest_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        # source情報を追加
-        if 'summary' in data:
-            data['summary']['source'] = 'cached_file'
-            data['summary']['source_file'] = json_files[0]
-        
-        logger.info(f"キャッシュファイルから応答: {latest_file}")
-        return data
-        
+        entry = latest_index.get(namespace_for_token(canvas_token))
     except Exception as e:
-        logger.error(f"キャッシュファイル読み込みエラー: {e}")
+        logger.error(f"最新の結果の読み込みエラー: {e}")
         raise HTTPException(status_code=500, detail=f"キャッシュ読み込みエラー: {str(e)}")
+    
+    encoding = choose_encoding(request.headers.get('accept-encoding'))
+    if len(entry.body) < Config.RESPONSE_COMPRESSION_MIN_SIZE:
+        encoding = None
+    if entry.not_modified(request.headers.get('if-none-match'), request.headers.get('if-modified-since')):
+        headers = entry.headers(encoding)
+        headers.pop('Content-Encoding', None)
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry.encoded_body(encoding), media_type="application/json", headers=entry.headers(encoding))
+
+def _parse_date(value: Optional[str], name: str) -> Optional[str]:
+    """クエリの日付（YYYY-MM-DD）を検証する"""
+    if value is None:
+        return None
+    try:
+        return date.fromisoformat(value).isoformat()
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} は YYYY-MM-DD 形式で指定してください")
+
+@app.get("/api/kyukou/cancellations")
+def search_cancellations(
+    canvas_token: Optional[str] = Query(None, description="Canvas APIトークン（指定したユーザーの休講情報を検索する）"),
+    date_from: Optional[str] = Query(None, alias="from", description="この日付（YYYY-MM-DD）以降の休講情報"),
+    date_to: Optional[str] = Query(None, alias="to", description="この日付（YYYY-MM-DD）以前の休講情報"),
+    course_id: Optional[str] = Query(None, description="コースID"),
+    period: Optional[str] = Query(None, description="時限（例: 2限）"),
+    limit: int = Query(Config.CANCELLATIONS_PAGE_SIZE, ge=1, le=Config.CANCELLATIONS_MAX_PAGE_SIZE, description="1ページの件数"),
+    offset: int = Query(0, ge=0, description="先頭から読み飛ばす件数")
+):
+    """
+    現在有効な休講情報を期間・コース・時限で検索する
+    
+    これまでに判定したお知らせの休講情報（編集されて休講ではなくなったものを除く）を、
+    データベースのインデックスから日付・時限の順に返します。GPTやCanvas APIは呼びません。
+    続きがある場合は summary.next に次のページのオフセットが入ります。
+    """
+    date_from = _parse_date(date_from, 'from')
+    date_to = _parse_date(date_to, 'to')
+    try:
+        results, total = query_cancellations(
+            namespace_for_token(canvas_token), date_from, date_to, course_id, period, limit, offset
+        )
+    except Exception as e:
+        logger.error(f"休講情報の検索エラー: {e}")
+        raise HTTPException(status_code=500, detail=f"休講情報の検索エラー: {str(e)}")
+    
+    summary = {
+        'total_cancellations': total,
+        'count': len(results),
+        'offset': offset,
+        'next': offset + len(results) if offset + len(results) < total else None,
+        'from': date_from,
+        'to': date_to,
+        'api_version': API_VERSION
+    }
+    return Response(content=encode_page(results, summary), media_type="application/json")
+
+@app.get("/api/kyukou/stream")
+async def stream_events(
+    request: Request,
+    canvas_token: Optional[str] = Query(None, description="Canvas APIトークン（指定したユーザーの休講情報の変更を受け取る）"),
+    last_event_id: Optional[str] = Query(None, description="最後に受け取ったイベントのID（Last-Event-ID ヘッダーを送れない場合）")
+):
+    """
+    休講情報の変更をServer-Sent Eventsで受け取る
+    
+    新しく検出した休講情報・内容が変わった休講情報ごとに cancellation イベントを送ります。
+    イベントがない間は EVENT_STREAM_HEARTBEAT 秒ごとにコメント行（: ping）を送ります。
+    再接続時に Last-Event-ID（またはクエリの last_event_id）を送ると、その後のイベントから再開します。
+    再開できない場合（サーバーの再起動後など）は reset イベントを送るので、/api/kyukou/latest から取得し直してください。
+    接続直後には、再接続時に使うイベントIDを ready イベントで送ります。
+    """
+    namespace = namespace_for_token(canvas_token)
+    resume_from = request.headers.get('last-event-id') or last_event_id
+    await asyncio.to_thread(event_bus.subscribe, namespace)
+
+    async def generate():
+        try:
+            yield f"retry: {Config.EVENT_STREAM_RETRY_MS}\n\n".encode('utf-8')
+            last_id = resume_from
+            if last_id is None:
+                last_id = event_bus.current_id()
+                yield encode_event(last_id, 'ready', {})
+            while True:
+                # イベントを読む前に通知を受け取る Future を取得しておく（読んだ直後のイベントを取りこぼさない）
+                signal = event_bus.signal(namespace)
+                events, missed = event_bus.events_after(namespace, last_id)
+                if missed:
+                    last_id = event_bus.current_id()
+                    yield encode_event(last_id, 'reset', {'latest': '/api/kyukou/latest'})
+                    continue
+                for event in events:
+                    yield event.encoded
+                    last_id = event.event_id
+                if await request.is_disconnected():
+                    break
+                try:
+                    await asyncio.wait_for(asyncio.shield(signal), Config.EVENT_STREAM_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield b": ping\n\n"
+        finally:
+            event_bus.unsubscribe(namespace)
+
+    return StreamingResponse(
+        generate(),
+        media_type="text/event-stream",
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 if __name__ == "__main__":
     import uvicorn
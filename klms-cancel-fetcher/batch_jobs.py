@@ -0,0 +1,236 @@
+"""
+OpenAI Batch API による非同期分析
+
+夜間のバッチ実行（main.py --batch-submit）では、新しいお知らせの判定を1つのBatchジョブ（JSONL入力）として投入し、
+後から（main.py --batch-collect）結果のJSONLを回収します。
+投入中のジョブは data/pending_batches.json に記録し、回収するまで同じお知らせを再投入しません。
+"""
+
+import os
+import threading
+from datetime import datetime
+from typing import Dict, List, Set, Tuple
+
+from gpt_analyzer import (
+    analysis_tiers, batch_max_tokens, build_batch_messages, build_messages, completion_params, get_client,
+    lookup_analysis, parse_analysis_response, parse_batch_response, store_analysis
+)
+from relevance_model import screen
+from serialization import dumps, dumps_str, loads
+from config import Config, get_logger
+
+logger = get_logger(__name__)
+
+# Batchジョブの状態（これら以外は終了状態）
+BATCH_IN_PROGRESS_STATUSES = ("validating", "in_progress", "finalizing", "cancelling")
+
+_pending_lock = threading.Lock()
+
+def _load_pending() -> Dict[str, Dict]:
+    if not os.path.exists(Config.PENDING_BATCHES_FILE):
+        return {}
+    try:
+        with open(Config.PENDING_BATCHES_FILE, 'rb') as f:
+            return loads(f.read())
+    except (ValueError, IOError) as e:
+        logger.error(f"Batchジョブ記録ファイルの読み込みエラー: {e}")
+        return {}
+
+def _save_pending(pending: Dict[str, Dict]):
+    os.makedirs(os.path.dirname(Config.PENDING_BATCHES_FILE), exist_ok=True)
+    try:
+        with open(Config.PENDING_BATCHES_FILE, 'wb') as f:
+            f.write(dumps(pending))
+    except IOError as e:
+        logger.error(f"Batchジョブ記録ファイルの保存エラー: {e}")
+
+def _announcement_key(course_id, ann: Dict) -> str:
+    return f"{course_id}:{ann.get('id')}:{ann.get('updated_at')}"
+
+def pending_announcement_keys() -> Set[str]:
+    """投入済みで未回収のお知らせのキー（コースID:お知らせID:更新日時）を返す"""
+    with _pending_lock:
+        pending = _load_pending()
+    return {
+        item['key']
+        for job in pending.values()
+        for chunk in job['chunks'].values()
+        for item in chunk
+    }
+
+def build_batch_input(items: List[Dict], batch_size: int, model: str) -> Tuple[str, Dict[str, List[Dict]]]:
+    """
+    Batch APIの入力JSONLを作成する
+
+    batch_size 件ずつ1リクエストにまとめ、各行の custom_id で分析対象を対応付けます。
+    Batchジョブでは段階的な判定はせず、すべて model で判定します。
+
+    Returns:
+        (JSONL文字列, custom_id をキーとするお知らせのリスト)
+    """
+    lines = []
+    chunks = {}
+    for start in range(0, len(items), batch_size):
+        chunk = [dict(item, id=str(i)) for i, item in enumerate(items[start:start + batch_size])]
+        custom_id = f"chunk-{start // batch_size}"
+        if len(chunk) == 1:
+            body = completion_params(build_messages(chunk[0]['title'], chunk[0]['body']), model=model)
+        else:
+            body = completion_params(build_batch_messages(chunk), batch_max_tokens(len(chunk)), model)
+        lines.append(dumps_str({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": body
+        }))
+        chunks[custom_id] = chunk
+    return "\n".join(lines) + "\n", chunks
+
+def submit_batch_job(items: List[Dict]) -> str:
+    """
+    お知らせの判定をBatchジョブとして投入する
+
+    Args:
+        items: title, body, course_id, course_name, announcement をキーに持つ辞書のリスト
+
+    Returns:
+        BatchジョブのID
+    """
+    records = [
+        {
+            'key': _announcement_key(item['course_id'], item['announcement']),
+            'title': item['title'],
+            'body': item['body'],
+            'course_id': item['course_id'],
+            'course_name': item['course_name'],
+            'announcement': {
+                name: item['announcement'].get(name)
+                for name in ('id', 'title', 'updated_at', 'posted_at')
+            }
+        }
+        for item in items
+    ]
+    model = analysis_tiers()[-1]
+    jsonl, chunks = build_batch_input(records, Config.ANALYSIS_BATCH_SIZE, model)
+
+    client = get_client()
+    input_file = client.files.create(file=("klms_batch_input.jsonl", jsonl.encode("utf-8")), purpose="batch")
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+
+    with _pending_lock:
+        pending = _load_pending()
+        pending[batch.id] = {
+            'submitted_at': datetime.now().isoformat(),
+            'model': model,
+            'chunks': chunks
+        }
+        _save_pending(pending)
+
+    logger.info(f"Batchジョブを投入しました: {batch.id}（{len(records)}件, {len(chunks)}リクエスト）")
+    return batch.id
+
+def defer_to_batch(items: List[Dict]) -> List[Dict]:
+    """
+    run_pipeline の analyze_items として使う判定関数
+
+    APIを呼ばずに判定できるもの（ルールベース抽出・保存済み結果・関連度モデル）はその場で結果を返し、
+    残りはBatchジョブとして投入して deferred の結果を返します。
+    """
+    already_pending = pending_announcement_keys()
+    results = []
+    misses = []
+    for index, item in enumerate(items):
+        cached_result = lookup_analysis(item['title'], item['body'], item.get('course_name'), item.get('reference_date'))
+        results.append(cached_result)
+        if cached_result is None:
+            misses.append(index)
+
+    to_submit = []
+    for index, gated_result in zip(misses, screen([items[index] for index in misses])):
+        if gated_result is not None:
+            results[index] = gated_result
+            continue
+        results[index] = {'deferred': True}
+        item = items[index]
+        if _announcement_key(item['course_id'], item['announcement']) not in already_pending:
+            to_submit.append(item)
+
+    if to_submit:
+        submit_batch_job(to_submit)
+    else:
+        logger.info("Batchジョブに投入する新しいお知らせはありません。")
+    return results
+
+def _parse_output_line(line: Dict, chunk: List[Dict], model: str) -> Dict[str, Dict]:
+    """Batch出力の1行を、お知らせのid（チャンク内の番号）をキーとする判定結果に変換する（model は判定したモデル）"""
+    response = line.get('response') or {}
+    if line.get('error') or response.get('status_code') != 200:
+        error = line.get('error') or response.get('body', {}).get('error')
+        return {item['id']: {"error": f"Batchリクエストが失敗しました: {error}", "raw_response": 'N/A'} for item in chunk}
+
+    content = response['body']['choices'][0]['message']['content']
+    try:
+        if len(chunk) == 1:
+            results = {chunk[0]['id']: parse_analysis_response(content)}
+        else:
+            results = parse_batch_response(content)
+    except ValueError as e:
+        return {item['id']: {"error": str(e), "raw_response": content} for item in chunk}
+
+    for item in chunk:
+        if item['id'] in results:
+            store_analysis(item['title'], item['body'], results[item['id']], model)
+        else:
+            results[item['id']] = {"error": "応答に判定結果が含まれていませんでした", "raw_response": content}
+    return results
+
+def collect_batch_jobs() -> List[Tuple[Dict, Dict]]:
+    """
+    完了したBatchジョブの結果を回収する
+
+    完了・失敗したジョブは記録から削除します。失敗したお知らせはキャッシュに登録されていないため、
+    次回の実行で再び判定対象になります。
+
+    Returns:
+        (投入時のお知らせの情報, 判定結果) のリスト
+    """
+    with _pending_lock:
+        pending = _load_pending()
+
+    collected = []
+    finished = []
+    for batch_id, job in pending.items():
+        batch = get_client().batches.retrieve(batch_id)
+        if batch.status in BATCH_IN_PROGRESS_STATUSES:
+            logger.info(f"Batchジョブは処理中です: {batch_id}（{batch.status}）")
+            continue
+
+        finished.append(batch_id)
+        if batch.status != "completed" or not batch.output_file_id:
+            logger.error(f"Batchジョブが完了しませんでした: {batch_id}（{batch.status}）")
+            continue
+
+        output = get_client().files.content(batch.output_file_id).text
+        for raw_line in output.splitlines():
+            if not raw_line.strip():
+                continue
+            line = loads(raw_line)
+            chunk = job['chunks'].get(line.get('custom_id'))
+            if chunk is None:
+                continue
+            # model を記録していない（この変更より前に投入した）ジョブは OPENAI_MODEL で判定している
+            results = _parse_output_line(line, chunk, job.get('model', Config.OPENAI_MODEL))
+            collected.extend((item, results[item['id']]) for item in chunk)
+        logger.info(f"Batchジョブの結果を回収しました: {batch_id}")
+
+    if finished:
+        with _pending_lock:
+            pending = _load_pending()
+            for batch_id in finished:
+                pending.pop(batch_id, None)
+            _save_pending(pending)
+    return collected
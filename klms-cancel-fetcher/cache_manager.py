@@ -1,52 +1,231 @@
+"""
+お知らせキャッシュの管理モジュール
+
+前回までに取得したお知らせ（コースID・お知らせID・タイトル・更新日時）をSQLiteデータベース（database.py）に保存し、
+新しく追加・更新されたお知らせだけを判定対象にするために使います。
+書き込みはコース単位のトランザクションで行うため、複数のプロセスが同時に更新しても互いの更新を失いません。
+
+キャッシュはCanvasトークンのハッシュ値（名前空間）ごとに分かれているため、
+あるユーザーの実行や強制更新が他のユーザーの「既読」状態に影響することはありません。
+
+コースごとに、確認済みのお知らせの最新の投稿日時（high_water）と全期間を取得した時刻（last_full_sync）も記録し、
+次回はその投稿日時以降のお知らせだけを取得します（fetch_windows）。投稿日時では古いお知らせの編集を検出できないため、
+CANVAS_FULL_SYNC_INTERVAL_HOURS ごとに全期間を取得し直します。
+"""
+
+import hashlib
 import os
-import json
-from datetime import datetime
-from typing import Dict, List, Set
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional
+from database import DEFAULT_NAMESPACE, get_connection, transaction
+from lru import LRUCache
+from metrics import ANNOUNCEMENTS
 from config import Config, get_logger
 
 logger = get_logger(__name__)
 
+# (名前空間, コースID) ごとの保存済みのお知らせ（データベースの内容の写し。書き込み時に同時に更新する）
+_known_announcements = LRUCache(Config.ANNOUNCEMENT_CACHE_MAX_COURSES)
+
 def ensure_data_directory():
     """
     dataディレクトリが存在しない場合は作成する
     """
     os.makedirs(Config.DATA_DIR, exist_ok=True)
 
-def load_cache() -> Dict:
+def namespace_for_token(canvas_token: Optional[str]) -> str:
     """
-    キャッシュファイルから前回の取得データを読み込む
+    Canvasトークンからキャッシュの名前空間を作る
+
+    トークン自体は保存せず、SHA-256ハッシュ値の先頭32文字を使います。
+    トークンを指定しない場合（環境変数のトークンを使う場合）は default 名前空間です。
     """
-    ensure_data_directory()
-    
-    if not os.path.exists(Config.CACHE_FILE):
-        return {
-            'last_updated': None,
-            'announcements': {}
-        }
-    
+    if not canvas_token:
+        return DEFAULT_NAMESPACE
+    return hashlib.sha256(canvas_token.encode("utf-8")).hexdigest()[:32]
+
+def _utc_timestamp(value: Optional[str]) -> Optional[str]:
+    """Canvasの日時（ISO 8601）を比較できる形式（UTCの YYYY-MM-DDTHH:MM:SSZ）にそろえる（解釈できない場合は None）"""
+    if not value:
+        return None
     try:
-        with open(Config.CACHE_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (json.JSONDecodeError, IOError) as e:
-        logger.error(f"キャッシュファイルの読み込みエラー: {e}")
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def _high_water(announcements: List[Dict]) -> Optional[str]:
+    """お知らせの最新の投稿日時（Canvasの start_date で絞り込まれる posted_at）"""
+    timestamps = [_utc_timestamp(ann.get('posted_at')) for ann in announcements]
+    return max((timestamp for timestamp in timestamps if timestamp), default=None)
+
+class AnnouncementCache:
+    """
+    データベース上の1ユーザー分（名前空間）のお知らせキャッシュ
+
+    お知らせの情報はコースごとに必要になった時点でデータベースから読み込み、
+    件数上限付きでプロセス内にも保持します。
+
+    Args:
+        namespace: 名前空間（namespace_for_token で作成）
+        ignore_existing: 保存済みのお知らせを無視する（すべてのお知らせを新しいものとして扱う）かどうか
+    """
+
+    def __init__(self, namespace: str = DEFAULT_NAMESPACE, ignore_existing: bool = False):
+        self.namespace = namespace
+        self.ignore_existing = ignore_existing
+        if ignore_existing:
+            # 強制更新: このユーザーの分だけプロセス内の写しを捨てる
+            _known_announcements.discard_where(lambda key: key[0] == namespace)
+
+    def known_announcements(self, course_id) -> Dict[str, Dict]:
+        """コースの保存済みのお知らせを、お知らせIDをキーとする辞書で返す"""
+        if self.ignore_existing:
+            return {}
+        key = (self.namespace, str(course_id))
+        known = _known_announcements.get(key)
+        if known is None:
+            rows = get_connection().execute(
+                "SELECT announcement_id, title, updated_at, cached_at FROM announcements "
+                "WHERE namespace = ? AND course_id = ?",
+                (self.namespace, str(course_id))
+            ).fetchall()
+            known = {
+                row['announcement_id']: {'title': row['title'], 'updated_at': row['updated_at'], 'cached_at': row['cached_at']}
+                for row in rows
+            }
+            _known_announcements.put(key, known)
+        return dict(known)
+
+    def fetch_windows(self, course_ids: Iterable) -> Dict:
+        """
+        コースごとのお知らせの取得開始日時を返す
+
+        前回確認した最新の投稿日時から CANVAS_INCREMENTAL_OVERLAP_HOURS 時間さかのぼった日時（ISO 8601）を返します。
+        まだ全期間を取得していないコース、前回の全期間の取得から CANVAS_FULL_SYNC_INTERVAL_HOURS 時間以上たったコース、
+        強制更新時・差分取得が無効な場合は None（全期間を取得する）です。
+
+        Returns:
+            コースIDをキー、取得開始日時（または None）を値とする辞書
+        """
+        windows = {course_id: None for course_id in course_ids}
+        if self.ignore_existing or not Config.CANVAS_INCREMENTAL_FETCH or not windows:
+            return windows
+
+        rows = get_connection().execute(
+            "SELECT course_id, high_water, last_full_sync FROM courses WHERE namespace = ?", (self.namespace,)
+        ).fetchall()
+        synced = {row['course_id']: row for row in rows}
+        now = datetime.now(timezone.utc)
+        full_sync_due = now - timedelta(hours=Config.CANVAS_FULL_SYNC_INTERVAL_HOURS)
+        for course_id in windows:
+            row = synced.get(str(course_id))
+            if row is None or not row['last_full_sync']:
+                continue
+            if datetime.fromisoformat(row['last_full_sync']) <= full_sync_due:
+                continue
+            # お知らせがまだ1件もないコースは、最後に全期間を取得した時刻を基準にする
+            base = row['high_water'] or _utc_timestamp(row['last_full_sync'])
+            since = datetime.fromisoformat(base.replace('Z', '+00:00')) - timedelta(hours=Config.CANVAS_INCREMENTAL_OVERLAP_HOURS)
+            windows[course_id] = since.strftime("%Y-%m-%dT%H:%M:%SZ")
+        return windows
+
+    def upsert_course(self, course_id, announcements: List[Dict], advance_high_water: bool = False, full_sync: bool = False):
+        """
+        コースのお知らせを1つのトランザクションで追加・更新する
+
+        Args:
+            course_id: コースID
+            announcements: 保存するお知らせ
+            advance_high_water: お知らせの最新の投稿日時を次回の差分取得の基準にするかどうか
+                （取得したお知らせをすべて処理できた場合のみ True にする）
+            full_sync: 全期間を取得した結果かどうか（全期間を取得した時刻として記録する）
+        """
+        now = datetime.now().isoformat()
+        entries = {
+            str(ann.get('id')): {'title': ann.get('title'), 'updated_at': ann.get('updated_at'), 'cached_at': now}
+            for ann in announcements
+        }
+        high_water = _high_water(announcements) if advance_high_water else None
+        last_full_sync = datetime.now(timezone.utc).isoformat() if full_sync else None
+        with transaction() as connection:
+            connection.execute(
+                "INSERT INTO courses (namespace, course_id, last_updated, high_water, last_full_sync) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (namespace, course_id) DO UPDATE SET last_updated = excluded.last_updated, "
+                "high_water = CASE WHEN excluded.high_water IS NULL OR courses.high_water >= excluded.high_water "
+                "THEN courses.high_water ELSE excluded.high_water END, "
+                "last_full_sync = COALESCE(excluded.last_full_sync, courses.last_full_sync)",
+                (self.namespace, str(course_id), now, high_water, last_full_sync)
+            )
+            connection.executemany(
+                "INSERT INTO announcements (namespace, course_id, announcement_id, title, updated_at, cached_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (namespace, course_id, announcement_id) DO UPDATE SET "
+                "title = excluded.title, updated_at = excluded.updated_at, cached_at = excluded.cached_at",
+                [
+                    (self.namespace, str(course_id), ann_id, entry['title'], entry['updated_at'], now)
+                    for ann_id, entry in entries.items()
+                ]
+            )
+
+        key = (self.namespace, str(course_id))
+        known = _known_announcements.get(key)
+        if known is not None:
+            _known_announcements.put(key, {**known, **entries})
+
+    def mark_updated(self):
+        """最終更新時刻を記録する"""
+        with transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)",
+                (f"last_updated:{self.namespace}", datetime.now().isoformat())
+            )
+
+    def stats(self) -> Dict:
+        """キャッシュされたコース数・お知らせ数・最終更新時刻を返す"""
+        connection = get_connection()
+        last_updated = connection.execute(
+            "SELECT value FROM meta WHERE name = ?", (f"last_updated:{self.namespace}",)
+        ).fetchone()
         return {
-            'last_updated': None,
-            'announcements': {}
+            'courses': connection.execute(
+                "SELECT COUNT(*) FROM courses WHERE namespace = ?", (self.namespace,)
+            ).fetchone()[0],
+            'announcements': connection.execute(
+                "SELECT COUNT(*) FROM announcements WHERE namespace = ?", (self.namespace,)
+            ).fetchone()[0],
+            'last_updated': last_updated['value'] if last_updated else None
         }
 
-def save_cache(cache_data: Dict):
+def load_cache(namespace: str = DEFAULT_NAMESPACE, ignore_existing: bool = False) -> AnnouncementCache:
     """
-    現在の取得データをキャッシュファイルに保存する
+    前回までの取得データ（お知らせキャッシュ）を取得する
+
+    Args:
+        namespace: 名前空間（namespace_for_token で作成。省略時は default）
+        ignore_existing: 保存済みのお知らせを無視するかどうか（強制更新用。他の名前空間には影響しない）
     """
     ensure_data_directory()
-    
+    return AnnouncementCache(namespace, ignore_existing)
+
+def save_cache(cache: AnnouncementCache):
+    """
+    キャッシュの最終更新時刻を記録する
+
+    お知らせは update_cache_with_announcements の時点でコースごとに保存済みです。
+    """
     try:
-        with open(Config.CACHE_FILE, 'w', encoding='utf-8') as f:
-            json.dump(cache_data, f, ensure_ascii=False, indent=2)
-    except IOError as e:
-        logger.error(f"キャッシュファイルの保存エラー: {e}")
+        cache.mark_updated()
+    except Exception as e:
+        logger.error(f"キャッシュの保存エラー: {e}")
 
-def get_new_announcements(course_id: int, announcements: List[Dict], cache: Dict) -> List[Dict]:
+def announcement_cache_stats() -> Dict:
+    """プロセス内に保持しているお知らせ情報の統計を返す"""
+    return _known_announcements.stats()
+
+def get_new_announcements(course_id: int, announcements: List[Dict], cache: AnnouncementCache) -> List[Dict]:
     """
     前回取得時から新しく追加されたお知らせのみを返す
     
@@ -58,8 +237,7 @@ def get_new_announcements(course_id: int, announcements: List[Dict], cache: Dict
     Returns:
         新しいお知らせのリスト
     """
-    course_key = str(course_id)
-    cached_announcements = cache.get('announcements', {}).get(course_key, {})
+    cached_announcements = cache.known_announcements(course_id)
     
     new_announcements = []
     
@@ -81,51 +259,34 @@ def get_new_announcements(course_id: int, announcements: List[Dict], cache: Dict
             elif ann.get('title') != cached_announcements[ann_id].get('title'):
                 new_announcements.append(ann)
     
+    ANNOUNCEMENTS.inc(len(new_announcements), result='new')
+    ANNOUNCEMENTS.inc(len(announcements) - len(new_announcements), result='known')
     return new_announcements
 
-def update_cache_with_announcements(course_id: int, announcements: List[Dict], cache: Dict):
+def update_cache_with_announcements(course_id: int, announcements: List[Dict], cache: AnnouncementCache,
+                                    advance_high_water: bool = False, full_sync: bool = False):
     """
-    キャッシュに今回取得したお知らせ情報を更新する
+    キャッシュに今回取得したお知らせ情報を更新する（コース単位のトランザクションで保存）
     
     Args:
         course_id: コースID
         announcements: 今回取得したお知らせのリスト
-        cache: キャッシュデータ（更新される）
+        cache: キャッシュ
+        advance_high_water: お知らせの最新の投稿日時を次回の差分取得の基準にするかどうか
+        full_sync: 全期間を取得した結果かどうか
     """
-    course_key = str(course_id)
-    
-    if 'announcements' not in cache:
-        cache['announcements'] = {}
-    
-    if course_key not in cache['announcements']:
-        cache['announcements'][course_key] = {}
-    
-    # 今回取得したお知らせをキャッシュに追加/更新
-    for ann in announcements:
-        ann_id = str(ann.get('id'))
-        cache['announcements'][course_key][ann_id] = {
-            'title': ann.get('title'),
-            'updated_at': ann.get('updated_at'),
-            'cached_at': datetime.now().isoformat()
-        }
-    
-    # 最終更新時刻を記録
-    cache['last_updated'] = datetime.now().isoformat()
+    cache.upsert_course(course_id, announcements, advance_high_water, full_sync)
 
-def print_cache_stats(cache: Dict):
+def print_cache_stats(cache: AnnouncementCache):
     """
     キャッシュの統計情報を表示する
     """
-    total_courses = len(cache.get('announcements', {}))
-    total_announcements = sum(
-        len(course_cache) 
-        for course_cache in cache.get('announcements', {}).values()
-    )
+    stats = cache.stats()
     
     logger.info("キャッシュ統計:")
-    logger.info(f"  キャッシュされたコース数: {total_courses}")
-    logger.info(f"  キャッシュされたお知らせ数: {total_announcements}")
-    logger.info(f"  最終更新: {cache.get('last_updated', '未更新')}")
+    logger.info(f"  キャッシュされたコース数: {stats['courses']}")
+    logger.info(f"  キャッシュされたお知らせ数: {stats['announcements']}")
+    logger.info(f"  最終更新: {stats['last_updated'] or '未更新'}")
 
 if __name__ == "__main__":
     # テスト用のコード
@@ -0,0 +1,106 @@
+"""
+休講情報のインデックス（/api/kyukou/cancellations 用）
+
+最新の結果（latest_results）には1回の実行で新しく判定した休講情報しか含まれないため、
+判定したお知らせごとに「現在有効な休講情報」をデータベースの cancellations テーブルに保存しておきます。
+お知らせが編集されて休講ではなくなった場合は、再判定したときに削除します。
+
+テーブルは（名前空間, 日付）と（名前空間, コース, 日付）のインデックスを持つため、
+「今週の休講情報」のような期間での検索は、GPTやCanvas APIを呼ばずにインデックスだけで答えられます。
+休講情報は判定結果のJSONのまま保存し、応答ではそれを連結するだけで返します。
+"""
+
+from datetime import date, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from database import transaction, get_connection
+from serialization import dumps, dumps_str
+from config import Config, get_logger
+
+logger = get_logger(__name__)
+
+def update_cancellations(namespace: str, analyzed: Iterable[Dict]):
+    """
+    判定したお知らせの結果で休講情報のインデックスを更新する
+
+    Args:
+        namespace: 名前空間（namespace_for_token で作成）
+        analyzed: annotate_result で情報を付与した判定結果（休講ではないものも含めて渡す）。
+            同じお知らせの以前の休講情報は置き換え、休講ではなくなったお知らせの休講情報は削除する
+    """
+    analyzed = [result for result in analyzed if result.get('announcement_id') is not None]
+    retention_start = (date.today() - timedelta(days=Config.CANCELLATIONS_RETENTION_DAYS)).isoformat()
+    try:
+        with transaction() as connection:
+            connection.executemany(
+                "DELETE FROM cancellations WHERE namespace = ? AND course_id = ? AND announcement_id = ?",
+                [(namespace, str(result.get('course_id')), str(result['announcement_id'])) for result in analyzed]
+            )
+            connection.executemany(
+                "INSERT INTO cancellations "
+                "(namespace, course_id, announcement_id, date, period, course_name, result, analyzed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (namespace, str(result.get('course_id')), str(result['announcement_id']), result.get('date'),
+                     result.get('period'), result.get('course_name'), dumps_str(result),
+                     result.get('analyzed_at'))
+                    for result in analyzed
+                    if result.get('canceled', False)
+                ]
+            )
+            # 保持期間より前の日付の休講情報は削除する（日付のない休講情報は残す）
+            connection.execute("DELETE FROM cancellations WHERE date < ?", (retention_start,))
+    except Exception as e:
+        logger.error(f"休講情報のインデックスの更新エラー: {e}")
+
+def query_cancellations(namespace: str, date_from: Optional[str] = None, date_to: Optional[str] = None,
+                        course_id: Optional[str] = None, period: Optional[str] = None,
+                        limit: int = 100, offset: int = 0) -> Tuple[List[str], int]:
+    """
+    条件に合う休講情報を日付・時限の順に返す
+
+    Args:
+        namespace: 名前空間
+        date_from: この日付（YYYY-MM-DD）以降の休講情報に絞る
+        date_to: この日付（YYYY-MM-DD）以前の休講情報に絞る
+        course_id: コースIDで絞る
+        period: 時限（「2限」など、判定結果と同じ表記）で絞る
+        limit: 返す件数の上限
+        offset: 先頭から読み飛ばす件数
+
+    Returns:
+        (休講情報のJSON文字列のリスト, 条件に合う休講情報の総数)
+        期間を指定した場合、日付のわからない休講情報は含まない
+    """
+    conditions = ["namespace = ?"]
+    params: List = [namespace]
+    if date_from is not None:
+        conditions.append("date >= ?")
+        params.append(date_from)
+    if date_to is not None:
+        conditions.append("date <= ?")
+        params.append(date_to)
+    if course_id is not None:
+        conditions.append("course_id = ?")
+        params.append(str(course_id))
+    if period is not None:
+        conditions.append("period = ?")
+        params.append(period)
+    where = " AND ".join(conditions)
+
+    connection = get_connection()
+    total = connection.execute(f"SELECT COUNT(*) FROM cancellations WHERE {where}", params).fetchone()[0]
+    if total <= offset:
+        return [], total
+    rows = connection.execute(
+        f"SELECT result FROM cancellations WHERE {where} "
+        "ORDER BY date, period, course_id, announcement_id LIMIT ? OFFSET ?",
+        params + [limit, offset]
+    ).fetchall()
+    return [row['result'] for row in rows], total
+
+def encode_page(results: List[str], summary: Dict) -> bytes:
+    """保存済みの休講情報のJSONを、デコードし直さずに1つの応答本文にまとめる"""
+    return b''.join([
+        b'{"summary":', dumps(summary), b',"cancellations":[', ",".join(results).encode('utf-8'), b']}'
+    ])
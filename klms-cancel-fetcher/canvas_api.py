@@ -1,63 +1,311 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+from http_cache import cache_key, get_response_cache
+from metrics import CANVAS_ERRORS, CANVAS_REQUEST_SECONDS
 from config import Config, get_logger
 
 logger = get_logger(__name__)
 
-def get_courses(canvas_token=None):
+# keep-aliveで接続を使い回すための共有セッション
+_session = None
+_session_lock = threading.Lock()
+
+def get_session() -> requests.Session:
+    """
+    Canvas API用の共有セッションを取得します（初回呼び出し時に作成）。
+
+    同時実行数と同じ数の接続をプールしておき、TLSハンドシェイクを毎回行わないようにします。
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=Config.CANVAS_MAX_CONCURRENCY
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+def _auth_headers(token: Optional[str]) -> Dict[str, str]:
+    return {
+        "Authorization": f"Bearer {token}"
+    }
+
+def _request(url: str, headers: Dict[str, str], params: Optional[Dict]) -> requests.Response:
+    """GETリクエストを送る（所要時間とエラーを metrics に記録する）"""
+    try:
+        with CANVAS_REQUEST_SECONDS.time():
+            response = get_session().get(url, headers=headers, params=params, timeout=Config.CANVAS_REQUEST_TIMEOUT)
+    except requests.exceptions.RequestException:
+        CANVAS_ERRORS.inc()
+        raise
+    if response.status_code >= 400:
+        CANVAS_ERRORS.inc()
+    return response
+
+def _get_page(url: str, token: Optional[str], params: Optional[Dict] = None,
+              ttl: Optional[float] = None) -> Tuple[List[Dict], Optional[str]]:
+    """
+    1ページ分を取得し、(結果, 次のページのURL) を返します。
+
+    Config.CANVAS_RESPONSE_CACHE が有効な場合は、前回の応答の ETag・Last-Modified で条件付きリクエストを送り、
+    304 Not Modified なら保存済みの本文を使います。ttl（秒）を指定した場合は、保存から ttl 秒以内なら
+    リクエストを送らずに保存済みの本文を返します。
+    HTTPエラーは requests の例外としてそのまま送出します。
+    """
+    headers = _auth_headers(token)
+    if not Config.CANVAS_RESPONSE_CACHE:
+        response = _request(url, headers, params)
+        response.raise_for_status()  # HTTPエラーがあれば例外を発生させる
+        return response.json(), response.links.get("next", {}).get("url")
+
+    cache = get_response_cache()
+    key = cache_key(url, params, token)
+    cached = cache.lookup(key)
+    if cached is not None and ttl is not None and time.time() - cached.stored_at < ttl:
+        cache.record('fresh')
+        return cached.body, cached.next_url
+    if cached is not None:
+        headers.update(cached.conditional_headers())
+
+    response = _request(url, headers, params)
+    if response.status_code == 304 and cached is not None:
+        cache.touch(key)
+        cache.record('not_modified')
+        return cached.body, cached.next_url
+    response.raise_for_status()  # HTTPエラーがあれば例外を発生させる
+
+    body = response.json()
+    next_url = response.links.get("next", {}).get("url")
+    cache.record('miss')
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if etag or last_modified or ttl is not None:
+        cache.store(key, body, next_url, etag, last_modified)
+    return body, next_url
+
+def _get_all_pages(url: str, token: Optional[str], params: Optional[Dict] = None,
+                   ttl: Optional[float] = None) -> List[Dict]:
+    """
+    Linkヘッダーの rel="next" をたどり、全ページの結果を連結して返します。
+
+    2ページ目以降はnextのURLにクエリが含まれるため、paramsは最初のリクエストにのみ付与します。
+    HTTPエラーは requests の例外としてそのまま送出します。
+    """
+    items = []
+    next_url = url
+    next_params = params
+    while next_url:
+        page, next_url = _get_page(next_url, token, next_params, ttl)
+        items.extend(page)
+        next_params = None
+    return items
+
+def _announcement_date_range(since: Optional[str] = None):
+    """
+    お知らせ取得期間（開始日, 終了日）を返す
+
+    since（ISO 8601の日時）を指定した場合はそれ以降、指定しない場合は CANVAS_ANNOUNCEMENT_PERIOD_DAYS 日前からの全期間です。
+    """
+    end_date = datetime.now().strftime("%Y-%m-%d")
+    start_date = since or (datetime.now() - timedelta(days=Config.CANVAS_ANNOUNCEMENT_PERIOD_DAYS)).strftime("%Y-%m-%d")
+    return start_date, end_date
+
+def get_courses(canvas_token=None, use_cache: bool = True):
     """
     Canvas LMSからユーザーが登録しているコース一覧を取得します。
     
+    コース一覧は頻繁には変わらないため、前回の取得から Config.CANVAS_COURSES_TTL 秒以内であれば
+    保存済みの一覧を返します（Config.CANVAS_RESPONSE_CACHE が有効な場合）。
+    
     Args:
         canvas_token: Canvas APIトークン（Noneの場合は環境変数から取得）
+        use_cache: False の場合は保存済みの一覧を使わずに取得し直す
     """
     token = canvas_token or Config.CANVAS_ACCESS_TOKEN
-    headers = {
-        "Authorization": f"Bearer {token}"
-    }
     url = f"{Config.CANVAS_API_BASE_URL}courses"
+    params = {
+        "per_page": Config.CANVAS_PAGE_SIZE
+    }
     try:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()  # HTTPエラーがあれば例外を発生させる
-        return response.json()
+        return _get_all_pages(url, token, params, ttl=Config.CANVAS_COURSES_TTL if use_cache else None)
     except requests.exceptions.RequestException as e:
         logger.error(f"コースの取得中にエラーが発生しました: {e}")
         return None
 
-def get_announcements(course_id, canvas_token=None):
+def get_announcements(course_id, canvas_token=None, since: Optional[str] = None):
     """
-    指定されたコースの最新のお知らせを取得します。
+    指定されたコースのお知らせを取得します。
     
     Args:
         course_id: コースID
         canvas_token: Canvas APIトークン（Noneの場合は環境変数から取得）
+        since: この日時（ISO 8601）以降に投稿されたお知らせだけを取得する（Noneの場合は全期間）
     """
     token = canvas_token or Config.CANVAS_ACCESS_TOKEN
-    headers = {
-        "Authorization": f"Bearer {token}"
-    }
     url = f"{Config.CANVAS_API_BASE_URL}announcements"
     
-    # お知らせ取得期間を広げるため、開始日と終了日を設定
-    end_date = datetime.now().strftime("%Y-%m-%d")
-    start_date = (datetime.now() - timedelta(days=Config.CANVAS_ANNOUNCEMENT_PERIOD_DAYS)).strftime("%Y-%m-%d")
+    # お知らせ取得期間を設定（差分取得の場合は前回確認した投稿日時から）
+    start_date, end_date = _announcement_date_range(since)
 
     params = {
         "context_codes[]": f"course_{course_id}", # コースIDをcontext_codesとして渡す
-        "per_page": Config.CANVAS_MAX_ANNOUNCEMENTS_PER_COURSE, # 取得するお知らせの数
+        "per_page": Config.CANVAS_PAGE_SIZE,
         "include[]": "body", # お知らせの本文も取得
         "start_date": start_date,
         "end_date": end_date
     }
     try:
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
-        return response.json()
+        # 件数で打ち切ると、編集された古いお知らせの後ろに新しいお知らせが隠れるため、全ページをたどる
+        return _get_all_pages(url, token, params)
     except requests.exceptions.RequestException as e:
         logger.error(f"お知らせの取得中にエラーが発生しました（コースID: {course_id}）: {e}")
         return None
 
+def get_announcements_batch(course_ids: List[int], canvas_token=None,
+                            since: Optional[str] = None) -> Dict[int, Optional[List[Dict]]]:
+    """
+    複数コースのお知らせを1リクエストにまとめて取得します。
+
+    context_codes[] に複数コースを詰めて announcements エンドポイントを呼び出し、
+    ページネーションを最後までたどった結果をコースごとに振り分けます。
+
+    Args:
+        course_ids: コースIDのリスト（1リクエストにまとめる分）
+        canvas_token: Canvas APIトークン（Noneの場合は環境変数から取得）
+        since: この日時（ISO 8601）以降に投稿されたお知らせだけを取得する（Noneの場合は全期間）
+
+    Returns:
+        コースIDをキー、お知らせのリストを値とする辞書（エラー時は全コースの値が None）
+    """
+    token = canvas_token or Config.CANVAS_ACCESS_TOKEN
+    url = f"{Config.CANVAS_API_BASE_URL}announcements"
+    start_date, end_date = _announcement_date_range(since)
+
+    params = {
+        "context_codes[]": [f"course_{course_id}" for course_id in course_ids],
+        "per_page": Config.CANVAS_PAGE_SIZE,
+        "include[]": "body",
+        "start_date": start_date,
+        "end_date": end_date
+    }
+    try:
+        announcements = _get_all_pages(url, token, params)
+    except requests.exceptions.RequestException as e:
+        logger.error(f"お知らせの一括取得中にエラーが発生しました（コースID: {', '.join(map(str, course_ids))}）: {e}")
+        return {course_id: None for course_id in course_ids}
+
+    # context_code（"course_<id>"）でコースごとに振り分ける
+    by_course = {course_id: [] for course_id in course_ids}
+    by_context_code = {f"course_{course_id}": course_id for course_id in course_ids}
+    for ann in announcements:
+        course_id = by_context_code.get(ann.get('context_code'))
+        if course_id is not None:
+            by_course[course_id].append(ann)
+    return by_course
+
+def get_calendar_events(course_ids: List[int], canvas_token=None, start_date: Optional[str] = None,
+                        end_date: Optional[str] = None) -> Optional[Dict[int, List[Dict]]]:
+    """
+    複数コースのカレンダーの予定（授業回など。課題の締め切りは含まない）を取得します。
+
+    CANVAS_CALENDAR_BATCH_SIZE コースずつ context_codes[] にまとめて calendar_events エンドポイントを呼び出します。
+
+    Args:
+        course_ids: コースIDのリスト
+        canvas_token: Canvas APIトークン（Noneの場合は環境変数から取得）
+        start_date: この日（YYYY-MM-DD）以降の予定を取得する
+        end_date: この日（YYYY-MM-DD）以前の予定を取得する
+
+    Returns:
+        コースIDをキー、予定のリストを値とする辞書（エラー時は None）
+    """
+    token = canvas_token or Config.CANVAS_ACCESS_TOKEN
+    url = f"{Config.CANVAS_API_BASE_URL}calendar_events"
+    by_course = {course_id: [] for course_id in course_ids}
+    by_context_code = {f"course_{course_id}": course_id for course_id in course_ids}
+    batch_size = Config.CANVAS_CALENDAR_BATCH_SIZE
+    for start in range(0, len(course_ids), batch_size):
+        batch = course_ids[start:start + batch_size]
+        params = {
+            "type": "event",
+            "context_codes[]": [f"course_{course_id}" for course_id in batch],
+            "per_page": Config.CANVAS_PAGE_SIZE,
+            "start_date": start_date,
+            "end_date": end_date
+        }
+        try:
+            events = _get_all_pages(url, token, params)
+        except requests.exceptions.RequestException as e:
+            logger.error(f"カレンダーの予定の取得中にエラーが発生しました（コースID: {', '.join(map(str, batch))}）: {e}")
+            return None
+        for event in events:
+            course_id = by_context_code.get(event.get('context_code'))
+            if course_id is not None:
+                by_course[course_id].append(event)
+    return by_course
+
+def get_announcements_for_courses(course_ids: Iterable[int], canvas_token=None, max_workers: Optional[int] = None,
+                                  since: Optional[Dict[int, Optional[str]]] = None) -> Dict[int, Optional[List[Dict]]]:
+    """
+    複数コースのお知らせを並行して取得します。
+
+    Config.CANVAS_FETCH_MODE が "batch" の場合は CANVAS_ANNOUNCEMENT_BATCH_SIZE コースずつ
+    まとめて取得し（get_announcements_batch）、"per_course" の場合は1コースずつ取得します。
+    エラー時の扱いは get_announcements と同じで、失敗したコースの値は None になります。
+
+    since でコースごとの取得開始日時を指定した場合、まとめて取得するコースは開始日時の順に並べて組み分けし、
+    組の中で最も早い開始日時（全期間のコースが含まれる場合は全期間）で取得します。
+    開始日時より前のお知らせが返ってきても、既読かどうかは get_new_announcements で判定されます。
+
+    Args:
+        course_ids: コースIDのリスト
+        canvas_token: Canvas APIトークン（Noneの場合は環境変数から取得）
+        max_workers: 同時実行数（Noneの場合は Config.CANVAS_MAX_CONCURRENCY）
+        since: コースIDをキー、取得開始日時（ISO 8601。Noneの場合は全期間）を値とする辞書（Noneの場合はすべて全期間）
+
+    Returns:
+        コースIDをキー、お知らせのリストを値とする辞書
+    """
+    course_ids = [course_id for course_id in course_ids if course_id]
+    if not course_ids:
+        return {}
+    since = since or {}
+
+    if Config.CANVAS_FETCH_MODE == "batch":
+        batch_size = Config.CANVAS_ANNOUNCEMENT_BATCH_SIZE
+        # 全期間のコースを先に、差分取得のコースを開始日時の順に並べる
+        ordered = sorted(course_ids, key=lambda course_id: (since.get(course_id) is not None, since.get(course_id) or ""))
+        batches = [ordered[i:i + batch_size] for i in range(0, len(ordered), batch_size)]
+    else:
+        batches = [[course_id] for course_id in course_ids]
+
+    def batch_since(batch):
+        starts = [since.get(course_id) for course_id in batch]
+        return None if None in starts else min(starts)
+
+    def fetch(batch):
+        if Config.CANVAS_FETCH_MODE == "batch":
+            return get_announcements_batch(batch, canvas_token, batch_since(batch))
+        return {batch[0]: get_announcements(batch[0], canvas_token, since.get(batch[0]))}
+
+    workers = max(1, min(max_workers or Config.CANVAS_MAX_CONCURRENCY, len(batches)))
+    announcements_by_course = {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="canvas") as executor:
+        for result in executor.map(fetch, batches):
+            announcements_by_course.update(result)
+    return announcements_by_course
+
 if __name__ == "__main__":
     logger.info("Canvas APIテストを開始します...")
 
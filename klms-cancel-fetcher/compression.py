@@ -0,0 +1,152 @@
+"""
+APIの応答の圧縮
+
+クライアントの Accept-Encoding に応じて、一定サイズ（RESPONSE_COMPRESSION_MIN_SIZE）以上の応答を
+brotli（brotli パッケージがインストールされている場合）または gzip で圧縮します。
+
+CompressionMiddleware は本文が1回で送られる応答だけを圧縮し、ストリーミングの応答（/api/kyukou/stream など）は
+そのまま送ります。すでに Content-Encoding が付いている応答（latest_index が圧縮済みの本文を保持している
+/api/kyukou/latest など）も圧縮し直しません。
+"""
+
+import gzip
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from config import Config
+
+# 圧縮しない Content-Type（すでに圧縮されている形式・ストリーミング）
+SKIP_CONTENT_TYPES = ('text/event-stream', 'image/', 'video/', 'audio/', 'application/zip', 'application/gzip')
+
+_brotli = None
+_brotli_checked = False
+_brotli_lock = threading.Lock()
+
+def _get_brotli():
+    """brotli モジュール（インストールされていない場合は None）"""
+    global _brotli, _brotli_checked
+    if not _brotli_checked:
+        with _brotli_lock:
+            if not _brotli_checked:
+                try:
+                    import brotli
+                    _brotli = brotli
+                except ImportError:
+                    _brotli = None
+                _brotli_checked = True
+    return _brotli
+
+def _accepted(accept_encoding: str) -> Dict[str, float]:
+    """Accept-Encoding の符号化方式と q 値"""
+    accepted = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            accepted[name.strip().lower()] = q
+    return accepted
+
+def choose_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """
+    応答に使う圧縮方式（'br'・'gzip'。圧縮しない場合は None）
+
+    クライアントが両方を受け付ける場合は、圧縮率の高い brotli を優先します。
+    """
+    if not accept_encoding or not Config.RESPONSE_COMPRESSION:
+        return None
+    accepted = _accepted(accept_encoding)
+    wildcard = accepted.get('*', 0.0)
+    if accepted.get('br', wildcard) > 0 and _get_brotli() is not None:
+        return 'br'
+    if accepted.get('gzip', wildcard) > 0:
+        return 'gzip'
+    return None
+
+def compress(body: bytes, encoding: str) -> bytes:
+    """本文を指定した方式で圧縮する"""
+    if encoding == 'br':
+        return _get_brotli().compress(body, quality=Config.RESPONSE_BROTLI_QUALITY)
+    # mtime を固定して、同じ本文からは常に同じバイト列を作る
+    return gzip.compress(body, compresslevel=Config.RESPONSE_GZIP_LEVEL, mtime=0)
+
+def should_compress(headers: List[Tuple[bytes, bytes]], size: int) -> bool:
+    """応答ヘッダーと本文のサイズから、圧縮するかどうかを決める"""
+    if size < Config.RESPONSE_COMPRESSION_MIN_SIZE:
+        return False
+    for name, value in headers:
+        if name == b'content-encoding':
+            return False
+        if name == b'content-type' and value.decode('latin-1').startswith(SKIP_CONTENT_TYPES):
+            return False
+    return True
+
+def weak_etag(etag: str) -> str:
+    """圧縮した応答の ETag（圧縮前と内容は同じなので弱い ETag にする）"""
+    return etag if etag.startswith('W/') else f"W/{etag}"
+
+class CompressionMiddleware:
+    """一定サイズ以上の応答を brotli・gzip で圧縮するASGIミドルウェア"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        accept_encoding = None
+        for name, value in scope.get('headers', []):
+            if name == b'accept-encoding':
+                accept_encoding = value.decode('latin-1')
+                break
+        encoding = choose_encoding(accept_encoding)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start_message, passthrough
+            if passthrough:
+                await send(message)
+                return
+            if message['type'] == 'http.response.start':
+                # 本文を見るまで送信を保留する
+                start_message = message
+                return
+            if message['type'] != 'http.response.body':
+                await send(message)
+                return
+
+            body = message.get('body', b'')
+            headers = list(start_message.get('headers', []))
+            if message.get('more_body', False) or not should_compress(headers, len(body)):
+                # ストリーミングの応答・小さい応答・圧縮済みの応答はそのまま送る
+                passthrough = True
+                await send(start_message)
+                await send(message)
+                return
+
+            compressed = compress(body, encoding)
+            headers = [(name, value) for name, value in headers if name != b'content-length']
+            headers = [
+                (name, weak_etag(value.decode('latin-1')).encode('latin-1') if name == b'etag' else value)
+                for name, value in headers
+            ]
+            headers.append((b'content-encoding', encoding.encode('latin-1')))
+            headers.append((b'content-length', str(len(compressed)).encode('latin-1')))
+            headers.append((b'vary', b'Accept-Encoding'))
+            passthrough = True
+            await send(dict(start_message, headers=headers))
+            await send({'type': 'http.response.body', 'body': compressed})
+
+        await self.app(scope, receive, send_compressed)
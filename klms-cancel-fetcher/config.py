@@ -2,36 +2,165 @@
 KLMS休講情報取得モジュール設定管理
 
 このファイルでは、システム全体で使用される設定値を一元管理します。
+
+インポートしただけでは .env の読み込み・必須の環境変数の検証・ディレクトリの作成は行いません。
+環境変数から読む設定値は初めて参照したときに .env を読み込んで確定し、必須の環境変数は
+それを使う処理（main.py の実行、OpenAIクライアントの作成）の直前に検証します。
+ログファイルとそのディレクトリは、最初のログが出力されたときに作成します。
 """
 
 import os
 import logging
-from dotenv import load_dotenv
+import threading
+
+_env_loaded = False
+_env_lock = threading.Lock()
+
+def load_env():
+    """.envファイルから環境変数を読み込む（プロセスごとに1回）"""
+    global _env_loaded
+    if _env_loaded:
+        return
+    with _env_lock:
+        if not _env_loaded:
+            from dotenv import load_dotenv
+            load_dotenv()
+            _env_loaded = True
+
+def _flag(value: str) -> bool:
+    return value.lower() == "true"
+
+def _optional_float(value: str):
+    # .env に「NAME=」とだけ書いた場合は未設定として扱う
+    return float(value) if value.strip() else None
+
+def _names(value: str) -> list:
+    return [name.strip() for name in value.split(",") if name.strip()]
 
-# .envファイルから環境変数を読み込む
-load_dotenv()
+class _Env:
+    """
+    環境変数から読む設定値
+
+    初めて参照したときに .env を読み込んで値を確定し、以後はクラス属性として値をそのまま返します
+    （テストなどで Config.X = ... と上書きした場合はその値が使われます）。
+    """
+
+    def __init__(self, name: str, default=None, cast=None):
+        self.name = name
+        self.default = default
+        self.cast = cast
+
+    def __set_name__(self, owner, attr):
+        self.attr = attr
+
+    def __get__(self, instance, owner):
+        load_env()
+        value = os.getenv(self.name, self.default)
+        if value is not None and self.cast is not None:
+            value = self.cast(value)
+        setattr(owner, self.attr, value)
+        return value
 
 class Config:
     """設定値を管理するクラス"""
     
     # API設定
-    CANVAS_API_BASE_URL = "https://lms.keio.jp/api/v1/"
-    CANVAS_ACCESS_TOKEN = os.getenv("CANVAS_ACCESS_TOKEN")
-    OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+    CANVAS_API_BASE_URL = _Env("CANVAS_API_BASE_URL", "https://lms.keio.jp/api/v1/")  # 末尾の / まで含める
+    CANVAS_ACCESS_TOKEN = _Env("CANVAS_ACCESS_TOKEN")
+    OPENAI_API_KEY = _Env("OPENAI_API_KEY")
     
     # Canvas API設定
-    CANVAS_MAX_ANNOUNCEMENTS_PER_COURSE = 10
-    CANVAS_ANNOUNCEMENT_PERIOD_DAYS = 365
+    CANVAS_ANNOUNCEMENT_PERIOD_DAYS = 365  # 全期間の取得でさかのぼる日数
+    CANVAS_INCREMENTAL_FETCH = _Env("CANVAS_INCREMENTAL_FETCH", "true", _flag)  # 前回確認した投稿日時以降のお知らせだけを取得するかどうか
+    CANVAS_INCREMENTAL_OVERLAP_HOURS = 24  # 差分取得で前回確認した投稿日時からさかのぼる時間（投稿日時の遅れ・時計のずれ対策）
+    CANVAS_FULL_SYNC_INTERVAL_HOURS = _Env("CANVAS_FULL_SYNC_INTERVAL_HOURS", "24", int)  # 全期間を取得し直して古いお知らせの編集を確認する間隔
+    CANVAS_MAX_CONCURRENCY = _Env("CANVAS_MAX_CONCURRENCY", "8", int)  # お知らせ取得の同時実行数
+    CANVAS_REQUEST_TIMEOUT = 30  # 秒
+    CANVAS_PAGE_SIZE = 50  # ページネーション時の1ページあたりの件数
+    CANVAS_FETCH_MODE = _Env("CANVAS_FETCH_MODE", "batch")  # "batch"（複数コースをまとめて取得）または "per_course"
+    CANVAS_ANNOUNCEMENT_BATCH_SIZE = 20  # 1リクエストにまとめるコース数
+    CANVAS_CALENDAR_BATCH_SIZE = 10  # カレンダーの予定の1リクエストにまとめるコース数（Canvas の context_codes の上限）
+    CANVAS_RESPONSE_CACHE = _Env("CANVAS_RESPONSE_CACHE", "true", _flag)  # 応答を保存して条件付きリクエストを使うかどうか
+    CANVAS_COURSES_TTL = _Env("CANVAS_COURSES_TTL", "21600", int)  # 秒（コース一覧を取得し直すまでの時間）
+    CANVAS_RESPONSE_CACHE_MAX_AGE = 7 * 24 * 3600  # 秒（これより長く使われていない応答は削除する）
     
     # OpenAI設定
+    OPENAI_BASE_URL = _Env("OPENAI_BASE_URL")  # 未設定の場合は api.openai.com
     OPENAI_MODEL = "gpt-4o"
+    ANALYSIS_CASCADE_MODELS = _Env("ANALYSIS_CASCADE_MODELS", "", _names)  # 段階的に判定するモデル（カンマ区切りで安い順。例: gpt-4o-mini,gpt-4o。空の場合は OPENAI_MODEL だけで判定する）
+    ANALYSIS_CASCADE_MIN_CONFIDENCE = _Env("ANALYSIS_CASCADE_MIN_CONFIDENCE", "0.8", float)  # 最後以外のモデルの結果を採用する確信度の下限（下回れば次のモデルで判定し直す）
+    ANALYSIS_CASCADE_ESCALATE_INCOMPLETE = _Env("ANALYSIS_CASCADE_ESCALATE_INCOMPLETE", "true", _flag)  # 休講と判定したのに日付・時限が欠けている結果も次のモデルで判定し直す
     OPENAI_TEMPERATURE = 0.1
     OPENAI_MAX_TOKENS = 500
+    OPENAI_MAX_CONCURRENCY = _Env("OPENAI_MAX_CONCURRENCY", "4", int)  # 同時に実行するGPT分析数
+    OPENAI_REQUESTS_PER_MINUTE = _Env("OPENAI_REQUESTS_PER_MINUTE", "500", int)
+    OPENAI_TOKENS_PER_MINUTE = _Env("OPENAI_TOKENS_PER_MINUTE", "30000", int)
+    OPENAI_MAX_RETRIES = 5  # 429・5xx・タイムアウト時の再試行回数
+    OPENAI_RETRY_BASE_DELAY = 1.0  # 秒（指数バックオフの初期値）
+    OPENAI_RETRY_MAX_DELAY = 60.0  # 秒
+    ANALYSIS_BATCH_SIZE = _Env("ANALYSIS_BATCH_SIZE", "1", int)  # 1回のリクエストで判定するお知らせ数（1の場合は1件ずつ）
+    PROMPT_BODY_TOKEN_BUDGET = _Env("PROMPT_BODY_TOKEN_BUDGET", "400", int)  # プロンプトに入れる本文のトークン数の上限
+    PROMPT_KEYWORD_WINDOW_CHARS = 150  # 本文が長い場合にキーワードの前後に残す文字数
+    ANNOUNCEMENT_DEDUP = _Env("ANNOUNCEMENT_DEDUP", "true", _flag)  # 内容が同じ（コース名だけが違う）お知らせを1回だけ判定する
+    DEDUP_SIMHASH_DISTANCE = 8  # ほぼ一致とみなす SimHash のハミング距離の上限（0の場合は完全一致だけをまとめる）
+    DEDUP_SHINGLE_SIZE = 4  # SimHash に使う文字 n-gram の長さ
+    RELEVANCE_GATE = _Env("RELEVANCE_GATE", "true", _flag)  # 関連度モデルで休講ではないと判定できたお知らせはGPTに送らない（モデルファイルがある場合のみ）
+    RELEVANCE_MODEL_FILE = _Env("RELEVANCE_MODEL_FILE", "data/relevance_model.json")  # tools/train_relevance.py で学習したモデル
+    RELEVANCE_THRESHOLD = _Env("RELEVANCE_THRESHOLD", None, _optional_float)  # 未設定の場合はモデルに保存したしきい値（学習時に再現率の目標から決めたもの）
+    RELEVANCE_RECALL_TARGET = _Env("RELEVANCE_RECALL_TARGET", "0.99", float)  # 学習時のしきい値の決め方（休講のお知らせのうちGPTに送る割合）
+    
+    # デーモンモード設定（main.py --daemon）
+    DAEMON_ACTIVE_INTERVAL = _Env("DAEMON_ACTIVE_INTERVAL", "300", int)  # 秒（最近お知らせがあったコース・今日授業があるコースの取得間隔）
+    DAEMON_DEFAULT_INTERVAL = _Env("DAEMON_DEFAULT_INTERVAL", "1800", int)  # 秒（それ以外のコースの取得間隔）
+    DAEMON_DORMANT_INTERVAL = _Env("DAEMON_DORMANT_INTERVAL", "21600", int)  # 秒（長い間お知らせがないコースの取得間隔）
+    DAEMON_RECENT_DAYS = 3  # この日数以内にお知らせがあったコースは頻繁に取得する
+    DAEMON_DORMANT_DAYS = 30  # この日数以上お知らせがないコースはまれにしか取得しない
+    DAEMON_CALENDAR_INTERVAL = _Env("DAEMON_CALENDAR_INTERVAL", "86400", int)  # 秒（授業日を知るためにCanvasのカレンダーを取得し直す間隔。0 で取得しない）
+    DAEMON_CALENDAR_DAYS = 7  # 今日の前後この日数のカレンダーの予定から授業日（曜日）を決める
+    DAEMON_MAX_SLEEP = 60  # 秒（次の取得予定までの待ち時間の上限。コース一覧の変化もこの間隔で確認する）
+    DAEMON_ERROR_BACKOFF = 60  # 秒（コース一覧の取得に失敗した場合などに待つ時間）
+    
+    # バックグラウンドジョブ設定（APIサーバー）
+    JOB_MAX_WORKERS = _Env("JOB_MAX_WORKERS", "4", int)  # 同時に実行するパイプライン数
+    JOB_HISTORY_LIMIT = 100  # 保持する完了済みジョブ数
+    REFRESH_MIN_INTERVAL = _Env("REFRESH_MIN_INTERVAL", "60", int)  # 秒（同じユーザーの前回の実行からこの時間内の更新要求には、実行せずに最新の結果を返す。0で無効）
+    
+    # イベントストリーム設定（/api/kyukou/stream）
+    EVENT_STREAM_BUFFER_SIZE = 256  # ユーザーごとに保持するイベント数（再接続時にこの件数まで再送できる）
+    EVENT_STREAM_MAX_TRACKED = 65536  # 内容の変化を判定するために覚えておく休講情報の件数
+    EVENT_STREAM_HEARTBEAT = _Env("EVENT_STREAM_HEARTBEAT", "15", float)  # 秒（イベントがないときに接続維持のコメントを送る間隔）
+    EVENT_STREAM_RETRY_MS = 5000  # 切断時にクライアントが再接続するまでの時間（ミリ秒）
+    
+    # 休講情報の検索設定（/api/kyukou/cancellations）
+    CANCELLATIONS_PAGE_SIZE = 100  # 1ページに返す休講情報の件数（既定）
+    CANCELLATIONS_MAX_PAGE_SIZE = 500  # 1ページに返す休講情報の件数の上限
+    CANCELLATIONS_RETENTION_DAYS = _Env("CANCELLATIONS_RETENTION_DAYS", "180", int)  # 過去の休講情報を保持する日数
+    
+    # シリアライズ・圧縮設定
+    JSON_BACKEND = _Env("JSON_BACKEND", "auto")  # auto: orjson があれば使う / orjson / json（標準ライブラリ）
+    COMPACT_STORAGE = _Env("COMPACT_STORAGE", "true", _flag)  # Canvas APIの応答キャッシュなどの本文を圧縮して保存する
+    COMPACT_STORAGE_LEVEL = 6  # 保存する本文の zlib の圧縮レベル
+    RESPONSE_COMPRESSION = _Env("RESPONSE_COMPRESSION", "true", _flag)  # APIの応答を gzip・brotli で圧縮する
+    RESPONSE_COMPRESSION_MIN_SIZE = _Env("RESPONSE_COMPRESSION_MIN_SIZE", "1024", int)  # バイト（これより小さい応答は圧縮しない）
+    RESPONSE_GZIP_LEVEL = 6
+    RESPONSE_BROTLI_QUALITY = 5
     
     # ファイル・ディレクトリ設定
     DATA_DIR = "data"
+    DATABASE_FILE = _Env("KLMS_DATABASE_FILE", "data/klms.sqlite3")  # キャッシュ・分析結果のデータベース
+    DATABASE_BUSY_TIMEOUT = 30.0  # 秒（他のプロセスが書き込み中の場合に待つ時間）
+    ANNOUNCEMENT_CACHE_MAX_COURSES = _Env("ANNOUNCEMENT_CACHE_MAX_COURSES", "4096", int)  # メモリに保持するお知らせ情報の上限（ユーザー×コース数）
+    LATEST_RESULTS_CACHE_MAX_USERS = _Env("LATEST_RESULTS_CACHE_MAX_USERS", "256", int)  # メモリに保持する最新の結果の上限（ユーザー数）
+    LATEST_RESULT_CHECK_INTERVAL = _Env("LATEST_RESULT_CHECK_INTERVAL", "2.0", float)  # 秒（別プロセスが保存した最新の結果を確認する間隔）
+    # 以前のバージョンのキャッシュ・分析結果ファイル（初回起動時にデータベースへ移行する）
     CACHE_FILE = "data/cache.json"
+    ANALYSIS_STORE_FILE = "data/analysis_store.json"
+    PENDING_BATCHES_FILE = "data/pending_batches.json"
     RESULTS_DIR = "results"
+    RESULTS_LOG_FILE = "results/klms_results.ndjson"  # 実行結果を追記するログ
+    RESULTS_INDEX_FILE = "results/klms_results.idx"   # 結果ログのインデックス
+    RESULTS_RETENTION_DAYS = _Env("RESULTS_RETENTION_DAYS", "30", int)  # 結果ログの保持期間（日）
+    METRICS_FILE = _Env("METRICS_FILE", "results/klms_metrics.prom")  # main.py が実行の終わりに書き出すメトリクス（Prometheus形式）
     
     # ログ設定
     LOG_LEVEL = "INFO"
@@ -39,14 +168,9 @@ class Config:
     LOG_FILE = "logs/klms.log"
     
     @classmethod
-    def validate_required_env_vars(cls):
-        """必須の環境変数が設定されているかチェック"""
-        missing_vars = []
-        
-        if not cls.CANVAS_ACCESS_TOKEN:
-            missing_vars.append("CANVAS_ACCESS_TOKEN")
-        if not cls.OPENAI_API_KEY:
-            missing_vars.append("OPENAI_API_KEY")
+    def validate_required_env_vars(cls, names=("CANVAS_ACCESS_TOKEN", "OPENAI_API_KEY")):
+        """必須の環境変数が設定されているかチェック（names で確認する環境変数を指定できる）"""
+        missing_vars = [name for name in names if not getattr(cls, name)]
         
         if missing_vars:
             raise ValueError(
@@ -62,7 +186,7 @@ class Config:
     
     @classmethod
     def setup_logging(cls):
-        """ログシステムを設定"""
+        """ログシステムを設定（ログファイルは最初のログが出力されたときに作成する）"""
         # ログレベルを設定
         log_level = getattr(logging, cls.LOG_LEVEL.upper(), logging.INFO)
         
@@ -71,16 +195,30 @@ class Config:
             level=log_level,
             format=cls.LOG_FORMAT,
             handlers=[
-                logging.FileHandler(cls.LOG_FILE, encoding='utf-8'),
+                _DeferredFileHandler(cls.LOG_FILE, encoding='utf-8'),
                 logging.StreamHandler()  # コンソール出力も維持
             ]
         )
 
-def get_logger(name: str):
-    """モジュール名を指定してロガーを取得"""
-    return logging.getLogger(name)
+class _DeferredFileHandler(logging.FileHandler):
+    """最初のログが出力されたときに、ディレクトリとファイルを作成する FileHandler"""
+
+    def __init__(self, filename: str, encoding: str):
+        super().__init__(filename, encoding=encoding, delay=True)
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        return super()._open()
 
-# 設定の検証と初期化
-Config.validate_required_env_vars()
-Config.ensure_directories()
-Config.setup_logging()
\ No newline at end of file
+_logging_configured = False
+_logging_lock = threading.Lock()
+
+def get_logger(name: str):
+    """モジュール名を指定してロガーを取得（初回呼び出し時にログシステムを設定する）"""
+    global _logging_configured
+    if not _logging_configured:
+        with _logging_lock:
+            if not _logging_configured:
+                Config.setup_logging()
+                _logging_configured = True
+    return logging.getLogger(name)
\ No newline at end of file
@@ -0,0 +1,257 @@
+"""
+デーモンモード（main.py --daemon）
+
+プロセスを常駐させ、お知らせのキャッシュ・Canvas APIの接続・OpenAIクライアントを使い回しながら、
+コースごとに決めた間隔でお知らせを取得・判定します。
+
+取得間隔はコースごとに次のように決めます。
+- 今日が授業日のコース、最近（DAEMON_RECENT_DAYS 日以内）お知らせがあったコース: DAEMON_ACTIVE_INTERVAL
+- 長い間（DAEMON_DORMANT_DAYS 日以上）お知らせがないコース: DAEMON_DORMANT_INTERVAL
+- それ以外: DAEMON_DEFAULT_INTERVAL
+授業日（曜日）は、Canvasのカレンダーにあるコースの予定（今日の前後 DAEMON_CALENDAR_DAYS 日。
+DAEMON_CALENDAR_INTERVAL 秒ごとに取得し直す）の曜日と、そのコースで検出した休講情報の日付の曜日から決めます。
+カレンダーに授業回の予定を登録していないコースは、休講情報を検出するまで授業日が分かりません
+（その間は最新のお知らせの投稿日時だけで取得間隔を決めます）。
+
+次の取得予定時刻はデータベース（poll_schedule テーブル）に保存するため、再起動しても続きから取得します。
+取得・判定を行うたびに、プロセス起動後の累計のメトリクスを METRICS_FILE に書き出します。
+SIGINT・SIGTERM を受け取ると、実行中の取得・判定を終えてから停止します。
+"""
+
+import signal
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Callable, Dict, Iterable, List, Optional
+
+from canvas_api import get_calendar_events, get_courses
+from cache_manager import namespace_for_token
+from database import get_connection, transaction
+from pipeline import run_pipeline
+from metrics import write_metrics_file
+from config import Config, get_logger
+
+logger = get_logger(__name__)
+
+def poll_interval(high_water: Optional[str], class_weekdays: int, now: datetime) -> int:
+    """
+    コースの取得間隔（秒）を決める
+
+    Args:
+        high_water: コースの最新のお知らせの投稿日時（ISO 8601。お知らせがない場合は None）
+        class_weekdays: 授業がある曜日のビットマスク（月曜日が 1 << 0）
+        now: 現在時刻（タイムゾーン付き）
+    """
+    if class_weekdays & (1 << now.weekday()):
+        return Config.DAEMON_ACTIVE_INTERVAL
+    if high_water is None:
+        return Config.DAEMON_DORMANT_INTERVAL
+    age = now - datetime.fromisoformat(high_water.replace('Z', '+00:00'))
+    if age <= timedelta(days=Config.DAEMON_RECENT_DAYS):
+        return Config.DAEMON_ACTIVE_INTERVAL
+    if age >= timedelta(days=Config.DAEMON_DORMANT_DAYS):
+        return Config.DAEMON_DORMANT_INTERVAL
+    return Config.DAEMON_DEFAULT_INTERVAL
+
+def _weekday_bit(cancellation_date: Optional[str]) -> int:
+    """休講日（YYYY-MM-DD）の曜日のビット（日付がない・解釈できない場合は 0）"""
+    try:
+        return 1 << date.fromisoformat(cancellation_date).weekday() if cancellation_date else 0
+    except ValueError:
+        return 0
+
+def _event_weekday_bit(start_at: Optional[str]) -> int:
+    """カレンダーの予定の開始日時（ISO 8601）の、ローカル時刻での曜日のビット（解釈できない場合は 0）"""
+    try:
+        parsed = datetime.fromisoformat(start_at.replace('Z', '+00:00')) if start_at else None
+    except ValueError:
+        return 0
+    return 1 << parsed.astimezone().weekday() if parsed else 0
+
+def calendar_weekdays(events_by_course: Dict) -> Dict[str, int]:
+    """コースID（文字列）をキー、カレンダーの予定がある曜日のビットマスクを値とする辞書を返す"""
+    weekdays = {}
+    for course_id, events in events_by_course.items():
+        mask = 0
+        for event in events:
+            mask |= _event_weekday_bit(event.get('start_at'))
+        weekdays[str(course_id)] = mask
+    return weekdays
+
+class PollSchedule:
+    """
+    1ユーザー分（名前空間）のコースの取得予定（poll_schedule テーブル）
+
+    Args:
+        namespace: 名前空間（namespace_for_token で作成）
+    """
+
+    def __init__(self, namespace: str):
+        self.namespace = namespace
+
+    def load(self) -> Dict[str, Dict]:
+        """コースID（文字列）をキー、次の取得予定時刻（UNIX時刻）と授業のある曜日を値とする辞書を返す"""
+        rows = get_connection().execute(
+            "SELECT course_id, next_poll_at, class_weekdays FROM poll_schedule WHERE namespace = ?", (self.namespace,)
+        ).fetchall()
+        return {
+            row['course_id']: {'next_poll_at': row['next_poll_at'], 'class_weekdays': row['class_weekdays']}
+            for row in rows
+        }
+
+    def reschedule(self, course_ids: Iterable, cancellations: List[Dict],
+                   calendar: Optional[Dict[str, int]] = None) -> Dict[str, Dict]:
+        """
+        取得したコースの次の取得予定時刻を決めて保存し、更新後の取得予定（load と同じ形式）を返す
+
+        検出した休講情報の日付の曜日は、そのコースの授業日として記録します。
+        calendar（コースIDをキー、カレンダーの予定がある曜日のビットマスクを値とする辞書）の曜日も
+        授業日として取得間隔を決めますが、学期が変わると変わるため記録はしません。
+        """
+        course_ids = [str(course_id) for course_id in course_ids]
+        learned = {}
+        for cancellation in cancellations:
+            course_id = str(cancellation.get('course_id'))
+            learned[course_id] = learned.get(course_id, 0) | _weekday_bit(cancellation.get('date'))
+
+        connection = get_connection()
+        high_waters = {
+            row['course_id']: row['high_water']
+            for row in connection.execute(
+                "SELECT course_id, high_water FROM courses WHERE namespace = ?", (self.namespace,)
+            )
+        }
+        schedule = self.load()
+        polled_at = time.time()
+        now = datetime.now(timezone.utc).astimezone()
+        calendar = calendar or {}
+        rows = []
+        for course_id in course_ids:
+            class_weekdays = schedule.get(course_id, {}).get('class_weekdays', 0) | learned.get(course_id, 0)
+            next_poll_at = polled_at + poll_interval(
+                high_waters.get(course_id), class_weekdays | calendar.get(course_id, 0), now
+            )
+            schedule[course_id] = {'next_poll_at': next_poll_at, 'class_weekdays': class_weekdays}
+            rows.append((self.namespace, course_id, next_poll_at, polled_at, class_weekdays))
+
+        with transaction() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO poll_schedule (namespace, course_id, next_poll_at, last_polled_at, class_weekdays) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+        return schedule
+
+class Daemon:
+    """
+    コースごとの取得予定に従ってお知らせの取得・判定を繰り返す
+
+    Args:
+        canvas_token: Canvas APIトークン（Noneの場合は環境変数から取得）
+        on_result: 休講情報を検出したときに結果（run_pipeline の戻り値）を受け取る関数
+        stop_event: セットされたら停止するイベント
+    """
+
+    def __init__(self, canvas_token=None, on_result: Optional[Callable[[Dict], None]] = None,
+                 stop_event: Optional[threading.Event] = None):
+        self.canvas_token = canvas_token
+        self.on_result = on_result
+        self.stop_event = stop_event or threading.Event()
+        self.schedule = PollSchedule(namespace_for_token(canvas_token))
+        # カレンダーの予定から決めたコースごとの授業日（曜日のビットマスク）と、その取得時刻・対象のコース
+        self.calendar: Dict[str, int] = {}
+        self._calendar_checked_at = 0.0
+        self._calendar_courses: frozenset = frozenset()
+
+    def run(self):
+        """stop_event がセットされるまで取得・判定を繰り返す"""
+        logger.info("デーモンモードを開始します...")
+        while not self.stop_event.is_set():
+            try:
+                wait = self.run_once()
+            except Exception as e:
+                logger.error(f"デーモンの実行中にエラーが発生しました: {e}")
+                wait = Config.DAEMON_ERROR_BACKOFF
+            self.stop_event.wait(wait)
+        logger.info("デーモンモードを停止しました。")
+
+    def refresh_calendar(self, courses: List[Dict]):
+        """
+        前回の取得から DAEMON_CALENDAR_INTERVAL 秒たった場合やコースが変わった場合に、カレンダーの予定から授業日を決め直す
+
+        取得に失敗した場合は、前回の授業日のまま DAEMON_CALENDAR_INTERVAL 秒後に取得し直します。
+        """
+        if Config.DAEMON_CALENDAR_INTERVAL <= 0:
+            return
+        course_ids = frozenset(course['id'] for course in courses)
+        now = time.time()
+        if course_ids == self._calendar_courses and now - self._calendar_checked_at < Config.DAEMON_CALENDAR_INTERVAL:
+            return
+        self._calendar_checked_at = now
+        self._calendar_courses = course_ids
+
+        today = date.today()
+        events = get_calendar_events(
+            sorted(course_ids), self.canvas_token,
+            start_date=(today - timedelta(days=Config.DAEMON_CALENDAR_DAYS)).isoformat(),
+            end_date=(today + timedelta(days=Config.DAEMON_CALENDAR_DAYS)).isoformat()
+        )
+        if events is None:
+            return
+        self.calendar = calendar_weekdays(events)
+        known = sum(1 for mask in self.calendar.values() if mask)
+        logger.info(f"カレンダーの予定から授業日が分かったコース: {known}/{len(course_ids)}")
+
+    def run_once(self) -> float:
+        """
+        取得予定の時刻を過ぎたコースのお知らせを取得・判定する
+
+        Returns:
+            次に実行するまでの待ち時間（秒）
+        """
+        courses = [course for course in get_courses(self.canvas_token) or [] if course.get('id')]
+        if not courses:
+            logger.error("コースの取得に失敗しました。")
+            return Config.DAEMON_ERROR_BACKOFF
+
+        self.refresh_calendar(courses)
+        schedule = self.schedule.load()
+        now = time.time()
+        due = [
+            course for course in courses
+            if schedule.get(str(course['id']), {}).get('next_poll_at', 0) <= now
+        ]
+        if due:
+            logger.info(f"取得予定のコース: {len(due)}/{len(courses)}")
+            # 最新の結果（/api/kyukou/latest など）の総コース数は、今回処理したコースではなく全コースの数にする
+            result = run_pipeline(self.canvas_token, courses=due, total_courses=len(courses))
+            if result['cancellations'] and self.on_result is not None:
+                self.on_result(result)
+            schedule = self.schedule.reschedule(
+                [course['id'] for course in due], result['cancellations'], self.calendar
+            )
+            write_metrics_file()
+
+        next_poll_at = min(schedule[str(course['id'])]['next_poll_at'] for course in courses)
+        return min(max(next_poll_at - time.time(), 1.0), Config.DAEMON_MAX_SLEEP)
+
+def run_daemon(canvas_token=None, on_result: Optional[Callable[[Dict], None]] = None):
+    """
+    デーモンモードで実行する（SIGINT・SIGTERM で停止するまで戻らない）
+
+    Args:
+        canvas_token: Canvas APIトークン（Noneの場合は環境変数から取得）
+        on_result: 休講情報を検出したときに結果を受け取る関数（結果ログへの追記など）
+    """
+    stop_event = threading.Event()
+
+    def handle_signal(signum, frame):
+        logger.info(f"{signal.Signals(signum).name} を受け取りました。実行中の処理を終えてから停止します...")
+        stop_event.set()
+
+    # シグナルハンドラーはメインスレッドでしか登録できない
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGINT, handle_signal)
+        signal.signal(signal.SIGTERM, handle_signal)
+
+    Daemon(canvas_token, on_result, stop_event).run()
@@ -0,0 +1,286 @@
+"""
+SQLiteデータベースモジュール
+
+お知らせのキャッシュ（courses・announcements テーブル）、GPTの分析結果（analyses テーブル）、
+ユーザーごとの最新の結果（latest_results テーブル）、デーモンモードのコースごとの取得予定（poll_schedule テーブル）、
+Canvas APIの応答キャッシュ（http_cache テーブル）、ユーザーごとの現在有効な休講情報（cancellations テーブル）を
+1つのSQLiteファイルに保存します。
+キャッシュと最新の結果はCanvasトークンのハッシュ値（名前空間）ごとに分けて保存し、
+分析結果はお知らせの内容から作ったキーで全ユーザー共通に保存します。
+WALモードで開くため、main.py と api_server.py が同時に読み書きしても互いの更新を上書きしません。
+
+以前のバージョンの data/cache.json・data/analysis_store.json があれば、初回接続時にデータベース
+（default 名前空間）へ移行し、元のファイルは .migrated を付けた名前に変更します。
+"""
+
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from config import Config, get_logger
+
+logger = get_logger(__name__)
+
+# スキーマのバージョン（PRAGMA user_version に記録する）
+SCHEMA_VERSION = 4
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS courses (
+    namespace TEXT NOT NULL,
+    course_id TEXT NOT NULL,
+    last_updated TEXT,
+    high_water TEXT,
+    last_full_sync TEXT,
+    PRIMARY KEY (namespace, course_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS announcements (
+    namespace TEXT NOT NULL,
+    course_id TEXT NOT NULL,
+    announcement_id TEXT NOT NULL,
+    title TEXT,
+    updated_at TEXT,
+    cached_at TEXT,
+    PRIMARY KEY (namespace, course_id, announcement_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS analyses (
+    key TEXT PRIMARY KEY,
+    result TEXT NOT NULL,
+    title TEXT,
+    body TEXT,
+    prompt_version TEXT,
+    model TEXT,
+    created_at TEXT
+);
+CREATE TABLE IF NOT EXISTS latest_results (
+    namespace TEXT PRIMARY KEY,
+    result TEXT NOT NULL,
+    analyzed_at TEXT
+);
+CREATE TABLE IF NOT EXISTS poll_schedule (
+    namespace TEXT NOT NULL,
+    course_id TEXT NOT NULL,
+    next_poll_at REAL NOT NULL,
+    last_polled_at REAL,
+    class_weekdays INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (namespace, course_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS http_cache (
+    key TEXT PRIMARY KEY,
+    body TEXT NOT NULL,
+    next_url TEXT,
+    etag TEXT,
+    last_modified TEXT,
+    stored_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cancellations (
+    namespace TEXT NOT NULL,
+    course_id TEXT NOT NULL,
+    announcement_id TEXT NOT NULL,
+    date TEXT,
+    period TEXT,
+    course_name TEXT,
+    result TEXT NOT NULL,
+    analyzed_at TEXT,
+    PRIMARY KEY (namespace, course_id, announcement_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS cancellations_by_date ON cancellations (namespace, date, period);
+CREATE INDEX IF NOT EXISTS cancellations_by_course ON cancellations (namespace, course_id, date, period);
+"""
+
+# バージョン1（名前空間なし）のデータベースを2に更新する（既存の内容は default 名前空間に移す）
+UPGRADE_TO_V2 = """
+BEGIN IMMEDIATE;
+ALTER TABLE courses RENAME TO courses_v1;
+ALTER TABLE announcements RENAME TO announcements_v1;
+{schema}
+INSERT INTO courses (namespace, course_id, last_updated)
+    SELECT 'default', course_id, last_updated FROM courses_v1;
+INSERT INTO announcements (namespace, course_id, announcement_id, title, updated_at, cached_at)
+    SELECT 'default', course_id, announcement_id, title, updated_at, cached_at FROM announcements_v1;
+UPDATE meta SET name = 'last_updated:default' WHERE name = 'last_updated';
+DROP TABLE courses_v1;
+DROP TABLE announcements_v1;
+PRAGMA user_version = 2;
+COMMIT;
+"""
+
+# バージョン2のデータベースを3に更新する（お知らせの差分取得用の列を追加する）
+UPGRADE_TO_V3 = """
+BEGIN IMMEDIATE;
+ALTER TABLE courses ADD COLUMN high_water TEXT;
+ALTER TABLE courses ADD COLUMN last_full_sync TEXT;
+PRAGMA user_version = 3;
+COMMIT;
+"""
+
+# バージョン3以前のデータベースでは、保存済みの最新の結果の休講情報を cancellations テーブルに取り込む
+BACKFILL_CANCELLATIONS = """
+BEGIN IMMEDIATE;
+INSERT OR REPLACE INTO cancellations
+    (namespace, course_id, announcement_id, date, period, course_name, result, analyzed_at)
+    SELECT latest_results.namespace,
+           CAST(json_extract(item.value, '$.course_id') AS TEXT),
+           CAST(json_extract(item.value, '$.announcement_id') AS TEXT),
+           json_extract(item.value, '$.date'),
+           json_extract(item.value, '$.period'),
+           json_extract(item.value, '$.course_name'),
+           item.value,
+           json_extract(item.value, '$.analyzed_at')
+    FROM latest_results, json_each(latest_results.result, '$.cancellations') AS item
+    WHERE json_extract(item.value, '$.announcement_id') IS NOT NULL
+      AND json_extract(item.value, '$.canceled');
+COMMIT;
+"""
+
+# 名前空間を指定しない場合（環境変数のCanvasトークンを使う main.py など）の名前空間
+DEFAULT_NAMESPACE = "default"
+
+_local = threading.local()
+_initialized_paths = set()
+_init_lock = threading.Lock()
+
+def _connect(path: str) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # 自動トランザクションは使わず、transaction() で明示的に BEGIN/COMMIT する
+    connection = sqlite3.connect(path, timeout=Config.DATABASE_BUSY_TIMEOUT, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+def get_connection() -> sqlite3.Connection:
+    """
+    現在のスレッド用のデータベース接続を返す
+
+    sqlite3 の接続はスレッド間で共有できないため、スレッドごとに1つの接続を使い回します。
+    """
+    path = Config.DATABASE_FILE
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    connection = connections.get(path)
+    if connection is None:
+        connection = _connect(path)
+        _initialize(connection, path)
+        connections[path] = connection
+    return connection
+
+@contextmanager
+def transaction() -> Iterator[sqlite3.Connection]:
+    """
+    書き込み用のトランザクションを開始する（例外が発生した場合はロールバック）
+
+    BEGIN IMMEDIATE で書き込みロックを先に取得するため、同時に書き込む別プロセスとはここで順番待ちになります。
+    """
+    connection = get_connection()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        yield connection
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+
+def _initialize(connection: sqlite3.Connection, path: str):
+    """テーブルを作成し、以前のJSONファイルがあれば移行する（プロセスごとに1回）"""
+    with _init_lock:
+        if path in _initialized_paths:
+            return
+        _upgrade_schema(connection)
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            migrated = _migrate_json_files(connection)
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        # 取り込みをコミットしてから元のファイルを退避する（次回以降は移行しない）
+        for migrated_path in migrated:
+            os.replace(migrated_path, f"{migrated_path}.migrated")
+            logger.info(f"{migrated_path} をデータベース（{path}）に移行しました。")
+        _initialized_paths.add(path)
+
+def _upgrade_schema(connection: sqlite3.Connection):
+    """テーブルを作成し、古いバージョンのデータベースを現在のスキーマに更新する"""
+    version = connection.execute("PRAGMA user_version").fetchone()[0]
+    if version < 2:
+        columns = [row['name'] for row in connection.execute("PRAGMA table_info(announcements)")]
+        if columns and 'namespace' not in columns:
+            connection.executescript(UPGRADE_TO_V2.format(schema=SCHEMA))
+            logger.info("データベースをバージョン2（ユーザーごとの名前空間）に更新しました。")
+    if version < 3:
+        columns = [row['name'] for row in connection.execute("PRAGMA table_info(courses)")]
+        if columns and 'high_water' not in columns:
+            connection.executescript(UPGRADE_TO_V3)
+            logger.info("データベースをバージョン3（お知らせの差分取得）に更新しました。")
+    connection.executescript(SCHEMA)
+    if version < 4:
+        connection.executescript(BACKFILL_CANCELLATIONS)
+        count = connection.execute("SELECT COUNT(*) FROM cancellations").fetchone()[0]
+        if count:
+            logger.info(f"保存済みの最新の結果から休講情報 {count}件をインデックスに取り込みました。")
+    connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+def _read_json(path: str) -> Optional[Dict]:
+    """移行元のJSONファイルを読み込む（読み込めない場合は None を返し、ファイルはそのまま残す）"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (json.JSONDecodeError, IOError) as e:
+        logger.error(f"移行元ファイルの読み込みエラー（{path}）: {e}")
+        return None
+
+def _migrate_json_files(connection: sqlite3.Connection) -> List[str]:
+    """
+    data/cache.json・data/analysis_store.json の内容をデータベースに取り込む
+
+    Returns:
+        取り込んだファイルのパスのリスト
+    """
+    migrated = []
+
+    cache = _read_json(Config.CACHE_FILE) if os.path.exists(Config.CACHE_FILE) else None
+    if cache is not None:
+        last_updated = cache.get('last_updated')
+        for course_key, course_cache in cache.get('announcements', {}).items():
+            connection.execute(
+                "INSERT OR IGNORE INTO courses (namespace, course_id, last_updated) VALUES (?, ?, ?)",
+                (DEFAULT_NAMESPACE, str(course_key), last_updated)
+            )
+            connection.executemany(
+                "INSERT OR IGNORE INTO announcements "
+                "(namespace, course_id, announcement_id, title, updated_at, cached_at) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (DEFAULT_NAMESPACE, str(course_key), str(ann_id), entry.get('title'), entry.get('updated_at'), entry.get('cached_at'))
+                    for ann_id, entry in course_cache.items()
+                ]
+            )
+        if last_updated:
+            connection.execute(
+                "INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)",
+                (f"last_updated:{DEFAULT_NAMESPACE}", last_updated)
+            )
+        migrated.append(Config.CACHE_FILE)
+
+    entries = _read_json(Config.ANALYSIS_STORE_FILE) if os.path.exists(Config.ANALYSIS_STORE_FILE) else None
+    if entries is not None:
+        connection.executemany(
+            "INSERT OR IGNORE INTO analyses (key, result, title, body, prompt_version, model, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (key, json.dumps(entry['result'], ensure_ascii=False), entry.get('title'), entry.get('body'),
+                 entry.get('prompt_version'), entry.get('model'), entry.get('created_at'))
+                for key, entry in entries.items()
+                if 'result' in entry
+            ]
+        )
+        migrated.append(Config.ANALYSIS_STORE_FILE)
+
+    return migrated
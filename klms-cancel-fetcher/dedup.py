@@ -0,0 +1,188 @@
+"""
+コースをまたいだお知らせの重複の判定
+
+合同授業や、同じ教員が複数のコースに同じお知らせを投稿した場合、内容が同じ（またはコース名だけが違う）
+お知らせをコースごとに判定すると、同じ判定のためにGPTを何度も呼ぶことになります。
+判定の前にお知らせをグループにまとめて、グループごとに1件（代表）だけを判定し、
+その結果をグループ内の全お知らせに、それぞれのコース名を付けて配ります。
+
+- 完全一致: 自分のコース名を置き換えて正規化したタイトル・本文が同じもの
+- ほぼ一致: 正規化したタイトル・本文の文字 n-gram の SimHash（64ビット）のハミング距離が
+  DEDUP_SIMHASH_DISTANCE 以下で、文中の数字（日付・時限など）と休講に関わるキーワード（休講・延期・補講など）の
+  並びが同じもの。短いお知らせの SimHash は「休講とします」「通常通り行います」の違いでも近くなるため、
+  判定結果が変わりうる違いのあるお知らせはまとめない
+"""
+
+import copy
+import hashlib
+import re
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from analysis_store import normalize_text
+from metrics import DEDUP_ANNOUNCEMENTS, DEDUP_GPT_CALLS_SAVED, STAGE_SECONDS
+from rule_extractor import extract_cancellation
+from text_preprocessor import KEYWORD_PATTERN
+from config import Config, get_logger
+
+logger = get_logger(__name__)
+
+# 正規化したテキストでコース名を置き換える文字列
+COURSE_PLACEHOLDER = "\x00"
+
+DIGITS_PATTERN = re.compile(r"\d+")
+
+SIMHASH_BITS = 64
+
+class DedupStats:
+    """重複の判定の累計（metrics の klms_dedup_announcements_total・klms_dedup_gpt_calls_saved_total）"""
+
+    def to_dict(self) -> Dict:
+        unique = int(DEDUP_ANNOUNCEMENTS.value(kind='unique'))
+        exact = int(DEDUP_ANNOUNCEMENTS.value(kind='exact'))
+        near = int(DEDUP_ANNOUNCEMENTS.value(kind='near'))
+        return {
+            'announcements': unique + exact + near,
+            'unique': unique,
+            'exact_duplicates': exact,
+            'near_duplicates': near,
+            'gpt_calls_saved': int(DEDUP_GPT_CALLS_SAVED.value())
+        }
+
+stats = DedupStats()
+
+def normalize_content(title: str, body: str, course_name: Optional[str]) -> str:
+    """タイトル・本文を正規化し、お知らせ自身のコース名を共通の文字列に置き換える"""
+    text = f"{normalize_text(title)}\n{normalize_text(body)}"
+    course_name = normalize_text(course_name)
+    if course_name:
+        text = text.replace(course_name, COURSE_PLACEHOLDER)
+    return text
+
+def fingerprint(content: str) -> str:
+    """normalize_content したテキストのハッシュ値（完全一致の判定用）"""
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def simhash(content: str, shingle_size: Optional[int] = None) -> int:
+    """文字 n-gram（重複を除く）の SimHash（64ビット）"""
+    shingle_size = shingle_size or Config.DEDUP_SHINGLE_SIZE
+    shingles = {content[i:i + shingle_size] for i in range(max(len(content) - shingle_size + 1, 1))}
+    hashes = [
+        int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big')
+        for shingle in shingles
+    ]
+    threshold = len(hashes) / 2
+    value = 0
+    for bit in range(SIMHASH_BITS):
+        mask = 1 << bit
+        if sum(1 for h in hashes if h & mask) > threshold:
+            value |= mask
+    return value
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+def group_items(items: List[Dict]) -> Tuple[List[int], List[int], List[str]]:
+    """
+    お知らせを重複のグループにまとめる
+
+    Args:
+        items: title, body, course_name をキーに持つ辞書のリスト
+
+    Returns:
+        (代表のお知らせの位置のリスト, お知らせごとのグループ（代表のリストでの位置）,
+         お知らせごとの種類（unique=代表, exact=完全一致, near=ほぼ一致）)
+    """
+    representatives: List[int] = []
+    assignment: List[int] = [0] * len(items)
+    kinds: List[str] = ['unique'] * len(items)
+    max_distance = Config.DEDUP_SIMHASH_DISTANCE
+
+    by_fingerprint: Dict[str, int] = {}
+    # ほぼ一致の候補は数字・キーワードの並びが同じ代表どうしに限る。SimHash は比べる相手ができたときに初めて計算する
+    # （[グループ, 正規化したテキスト, SimHash] のリスト）
+    candidates: Dict[Tuple, List[List]] = defaultdict(list)
+    for index, item in enumerate(items):
+        content = normalize_content(item['title'], item['body'], item.get('course_name'))
+        key = fingerprint(content)
+        group = by_fingerprint.get(key)
+        if group is not None:
+            assignment[index] = group
+            kinds[index] = 'exact'
+            continue
+
+        if max_distance > 0:
+            bucket = candidates[(tuple(DIGITS_PATTERN.findall(content)), tuple(KEYWORD_PATTERN.findall(content)))]
+            signature = simhash(content) if bucket else None
+            group = None
+            for candidate in bucket:
+                if candidate[2] is None:
+                    candidate[2] = simhash(candidate[1])
+                if hamming_distance(signature, candidate[2]) <= max_distance:
+                    group = candidate[0]
+                    break
+            if group is not None:
+                by_fingerprint[key] = group
+                assignment[index] = group
+                kinds[index] = 'near'
+                continue
+            bucket.append([len(representatives), content, signature])
+
+        by_fingerprint[key] = len(representatives)
+        assignment[index] = len(representatives)
+        representatives.append(index)
+    return representatives, assignment, kinds
+
+def fan_out(result: Dict, representative: Dict, item: Dict) -> Dict:
+    """代表の判定結果を、同じグループの別のお知らせ用にコピーする（代表のコース名をそのお知らせのコース名にする）"""
+    result = copy.deepcopy(result)
+    source_name = representative.get('course_name')
+    target_name = item.get('course_name')
+    if source_name and target_name and source_name != target_name:
+        if result.get('course') == source_name:
+            result['course'] = target_name
+        if isinstance(result.get('message'), str) and len(source_name) > 1:
+            result['message'] = result['message'].replace(source_name, target_name)
+    return result
+
+def analyze_deduplicated(items: List[Dict], analyze_items: Callable[[List[Dict]], List[Dict]]) -> List[Dict]:
+    """
+    重複のグループごとに代表だけを analyze_items で判定し、入力と同じ順序の判定結果を返す
+
+    ANNOUNCEMENT_DEDUP が無効な場合は、すべてのお知らせを analyze_items で判定します。
+    """
+    if not Config.ANNOUNCEMENT_DEDUP or len(items) < 2:
+        DEDUP_ANNOUNCEMENTS.inc(len(items), kind='unique')
+        return analyze_items(items)
+
+    with STAGE_SECONDS.time(stage='dedup'):
+        representatives, assignment, kinds = group_items(items)
+    representative_results = analyze_items([items[index] for index in representatives])
+
+    results = []
+    duplicates: Dict[str, int] = defaultdict(int)
+    gpt_calls_saved = 0
+    for index, item in enumerate(items):
+        group = assignment[index]
+        representative = items[representatives[group]]
+        result = representative_results[group]
+        kind = kinds[index]
+        duplicates[kind] += 1
+        if kind == 'unique':
+            results.append(result)
+            continue
+        # ルールベース抽出で判定できるお知らせは、重複していなくてもGPTを呼ばないため数えない
+        # （以前に判定した内容と同じで、保存済みの結果を使えたお知らせは数に含まれる）
+        if extract_cancellation(item['title'], item['body'], item.get('course_name'), item.get('reference_date')) is None:
+            gpt_calls_saved += 1
+        results.append(fan_out(result, representative, item))
+
+    for kind, count in duplicates.items():
+        DEDUP_ANNOUNCEMENTS.inc(count, kind=kind)
+    DEDUP_GPT_CALLS_SAVED.inc(gpt_calls_saved)
+    if len(representatives) < len(items):
+        logger.info(
+            f"重複するお知らせ: {len(items)}件 → {len(representatives)}グループ"
+            f"（完全一致 {duplicates['exact']}件, ほぼ一致 {duplicates['near']}件, GPT呼び出しの削減 {gpt_calls_saved}回）"
+        )
+    return results
@@ -0,0 +1,231 @@
+"""
+休講情報の変更イベント（/api/kyukou/stream 用）
+
+パイプラインの結果が保存されるたびに（result_store の通知）、新しく検出した休講情報と内容が変わった休講情報を
+小さなイベントにして、ユーザー（名前空間）ごとのリングバッファに追加します。
+SSEの接続はイベントが追加されるまで待機しているだけなので、待機中の接続にはほとんどコストがかかりません。
+
+イベントIDは「プロセスの起動時刻-連番」の形式です。再接続時に Last-Event-ID を受け取ると、
+それより後のイベントをバッファから再送します。バッファから消えたイベント・別のプロセスで振ったIDを指定された場合は
+reset イベントを送り、クライアントに /api/kyukou/latest から取得し直してもらいます。
+
+別プロセス（main.py の定期実行・デーモンモード）が保存した結果は、接続中のユーザーの分だけ
+一定間隔ごとに分析時刻を確認して検出します（watch）。
+"""
+
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from lru import LRUCache
+from result_store import add_listener, get_latest_analyzed_at, get_latest_result
+from results_log import cancellation_key
+from serialization import dumps
+from config import Config, get_logger
+
+logger = get_logger(__name__)
+
+# イベントに含める休講情報の項目
+EVENT_FIELDS = ('course_id', 'course_name', 'announcement_id', 'date', 'period', 'canceled', 'message')
+
+def encode_event(event_id: str, name: str, data: Dict) -> bytes:
+    """SSEのイベント1件分のバイト列"""
+    return b''.join([f"id: {event_id}\nevent: {name}\ndata: ".encode('utf-8'), dumps(data), b"\n\n"])
+
+class Event:
+    """送信する形式（SSEのバイト列）で保持するイベント"""
+
+    __slots__ = ('event_id', 'seq', 'encoded')
+
+    def __init__(self, event_id: str, seq: int, name: str, data: Dict):
+        self.event_id = event_id
+        self.seq = seq
+        self.encoded = encode_event(event_id, name, data)
+
+class _Buffer:
+    """1ユーザー分のイベントのリングバッファ"""
+
+    __slots__ = ('events', 'dropped_seq')
+
+    def __init__(self, size: int):
+        self.events = deque(maxlen=size)
+        self.dropped_seq = 0  # バッファからあふれた最後のイベントの連番
+
+    def append(self, event: Event):
+        if len(self.events) == self.events.maxlen:
+            self.dropped_seq = self.events[0].seq
+        self.events.append(event)
+
+def _fingerprint(cancellation: Dict) -> str:
+    """休講情報の内容が変わったかどうかを判定するための値"""
+    content = json.dumps([cancellation.get(field) for field in EVENT_FIELDS], ensure_ascii=False, default=str)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()[:16]
+
+class EventBus:
+    """
+    ユーザーごとの休講情報の変更イベントのバッファと、待機中の接続への通知
+
+    Args:
+        buffer_size: ユーザーごとに保持するイベント数（これより古いイベントからは再開できない）
+        max_tracked: 内容を覚えておく休講情報の件数の上限（あふれた休講情報が再び届いた場合は新しいものとして送る）
+    """
+
+    def __init__(self, buffer_size: int, max_tracked: int):
+        self.buffer_size = buffer_size
+        self.epoch = format(int(time.time()), 'x')
+        self._seq = 0
+        self._buffers: Dict[str, _Buffer] = {}
+        # 送信済みの休講情報の内容（(名前空間, 休講情報のキー) → fingerprint）
+        self._sent = LRUCache(max_tracked)
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._signals: Dict[str, asyncio.Future] = {}
+        self._subscribers: Dict[str, int] = {}
+        self._analyzed_at: Dict[str, Optional[str]] = {}
+
+    def attach_loop(self, loop: asyncio.AbstractEventLoop):
+        """待機中の接続に通知するイベントループを設定する（サーバーの起動時に呼ぶ）"""
+        self._loop = loop
+
+    def publish_result(self, namespace: str, result: Dict):
+        """
+        保存された結果から、新しい休講情報・内容が変わった休講情報のイベントを追加する（result_store のリスナー）
+
+        どのスレッドから呼んでもかまいません。
+        """
+        self._analyzed_at[namespace] = result.get('summary', {}).get('analyzed_at')
+        published = 0
+        with self._lock:
+            buffer = self._buffers.get(namespace)
+            if buffer is None:
+                buffer = self._buffers[namespace] = _Buffer(self.buffer_size)
+            for cancellation in result.get('cancellations', []):
+                key = (namespace, cancellation_key(cancellation))
+                fingerprint = _fingerprint(cancellation)
+                previous = self._sent.get(key)
+                if previous == fingerprint:
+                    continue
+                self._sent.put(key, fingerprint)
+                self._seq += 1
+                data = {field: cancellation.get(field) for field in EVENT_FIELDS}
+                data['changed'] = previous is not None
+                buffer.append(Event(f"{self.epoch}-{self._seq}", self._seq, 'cancellation', data))
+                published += 1
+
+        if published and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._notify, namespace)
+
+    def _notify(self, namespace: str):
+        """待機中の接続を起こす（イベントループのスレッドで呼ばれる）"""
+        signal = self._signals.pop(namespace, None)
+        if signal is not None and not signal.done():
+            signal.set_result(None)
+
+    def signal(self, namespace: str) -> asyncio.Future:
+        """次にイベントが追加されたときに完了する Future（イベントを読む前に取得しておく）"""
+        signal = self._signals.get(namespace)
+        if signal is None or signal.done():
+            signal = self._signals[namespace] = asyncio.get_running_loop().create_future()
+        return signal
+
+    def current_id(self) -> str:
+        """最後に追加したイベントのID（まだイベントがない場合は連番 0）"""
+        with self._lock:
+            return f"{self.epoch}-{self._seq}"
+
+    def events_after(self, namespace: str, last_event_id: str) -> Tuple[List[Event], bool]:
+        """
+        last_event_id より後のイベントを返す
+
+        Returns:
+            (イベントのリスト, 取りこぼしがあるかどうか)。取りこぼしがある場合はクライアントに取得し直してもらう
+        """
+        epoch, _, seq = last_event_id.partition('-')
+        with self._lock:
+            if epoch != self.epoch or not seq.isdigit() or int(seq) > self._seq:
+                return [], True
+            buffer = self._buffers.get(namespace)
+            if buffer is None:
+                return [], False
+            seq = int(seq)
+            return [event for event in buffer.events if event.seq > seq], seq < buffer.dropped_seq
+
+    def subscribe(self, namespace: str):
+        """
+        接続を登録する（別プロセスの結果を確認する対象にする）
+
+        初めての名前空間ではデータベースを読むため、イベントループのスレッド以外から呼びます。
+        """
+        with self._lock:
+            self._subscribers[namespace] = self._subscribers.get(namespace, 0) + 1
+            if namespace not in self._analyzed_at:
+                self._analyzed_at[namespace] = None
+                first = True
+            else:
+                first = False
+        if first:
+            # 接続した時点の結果は送信済みとして扱う（以後の変更だけを送る）
+            self._baseline(namespace)
+
+    def unsubscribe(self, namespace: str):
+        with self._lock:
+            count = self._subscribers.get(namespace, 0) - 1
+            if count > 0:
+                self._subscribers[namespace] = count
+            else:
+                self._subscribers.pop(namespace, None)
+
+    def _baseline(self, namespace: str):
+        result = get_latest_result(namespace)
+        if result is None:
+            return
+        self._analyzed_at[namespace] = result.get('summary', {}).get('analyzed_at')
+        for cancellation in result.get('cancellations', []):
+            key = (namespace, cancellation_key(cancellation))
+            if self._sent.get(key) is None:
+                self._sent.put(key, _fingerprint(cancellation))
+
+    async def watch(self, interval: float):
+        """別プロセスが保存した結果を、接続中のユーザーの分だけ一定間隔で確認する"""
+        while True:
+            await asyncio.sleep(interval)
+            with self._lock:
+                namespaces = list(self._subscribers)
+            for namespace in namespaces:
+                try:
+                    analyzed_at = await asyncio.to_thread(get_latest_analyzed_at, namespace)
+                    if analyzed_at is None or analyzed_at == self._analyzed_at.get(namespace):
+                        continue
+                    result = await asyncio.to_thread(get_latest_result, namespace)
+                    if result is not None:
+                        self.publish_result(namespace, result)
+                except Exception as e:
+                    logger.error(f"最新の結果の確認エラー: {e}")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'subscribers': sum(self._subscribers.values()),
+                'namespaces': len(self._subscribers),
+                'last_event_seq': self._seq,
+                'buffered_events': sum(len(buffer.events) for buffer in self._buffers.values()),
+                'tracked_cancellations': len(self._sent)
+            }
+
+_bus = None
+_bus_lock = threading.Lock()
+
+def get_event_bus() -> EventBus:
+    """共有の EventBus を取得する（初回呼び出し時に result_store の通知を登録する）"""
+    global _bus
+    if _bus is None:
+        with _bus_lock:
+            if _bus is None:
+                bus = EventBus(Config.EVENT_STREAM_BUFFER_SIZE, Config.EVENT_STREAM_MAX_TRACKED)
+                add_listener(bus.publish_result)
+                _bus = bus
+    return _bus
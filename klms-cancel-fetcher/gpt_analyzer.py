@@ -1,68 +1,439 @@
-from openai import OpenAI
 import json
+import threading
+from datetime import date
+from typing import Callable, Dict, List, Optional, Tuple
+from analysis_store import get_analysis_store, make_analysis_key
+from rule_extractor import extract_cancellation
+from metrics import GPT_REQUEST_SECONDS, GPT_TIER_RESULTS, GPT_TOKENS
 from config import Config, get_logger
 
 logger = get_logger(__name__)
 
-# OpenAI クライアントを初期化
-client = OpenAI(api_key=Config.OPENAI_API_KEY)
+# プロンプトの内容を変更したら更新する（保存済みの分析結果を無効化するため）
+PROMPT_VERSION = "3"
 
-def analyze_announcement(title: str, body: str) -> dict:
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
     """
-    OpenAI APIを使用して、お知らせが休講情報であるかを判定し、構造化された情報を返します。
+    共有の OpenAI クライアントを取得する（初回呼び出し時に作成）
+
+    openai パッケージの読み込みとクライアントの作成は、GPTでの判定が初めて必要になったときまで遅らせます。
+    OPENAI_BASE_URL を設定するとローカルのスタンドインサーバーなどに接続できます。
+    OPENAI_API_KEY が設定されていない場合は ValueError を送出します。
     """
-    prompt = f"""以下の授業のお知らせが休講情報であるか判定し、もし休講情報であれば以下のJSON形式で情報を抽出してください。
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                Config.validate_required_env_vars(("OPENAI_API_KEY",))
+                from openai import OpenAI
+                _client = OpenAI(api_key=Config.OPENAI_API_KEY, base_url=Config.OPENAI_BASE_URL)
+    return _client
+
+# プロンプトの固定部分（指示と出力形式）は、プロバイダー側のプロンプトキャッシュが効くように
+# 常にメッセージの先頭に同じ内容で置き、お知らせごとに変わる部分はその後ろに置く
+INSTRUCTIONS = """授業のお知らせが休講情報であるか判定し、もし休講情報であれば情報を抽出してください。
 休講でなければ、canceledをfalseとしてください。
 
 情報が不足している場合は、該当フィールドをnullとしてください。
 日付はYYYY-MM-DD形式で、時限は「1限」「2限」のように記述してください。
+confidenceには、判定の確からしさを0から1の数値で記述してください。
+"""
 
-お知らせのタイトル: {title}
-お知らせの本文: {body}
-
-出力JSON形式:
-```json
-{{
-  "course": "授業名",
+RESULT_FIELDS = """  "course": "授業名",
   "date": "YYYY-MM-DD",
   "period": "時限",
   "canceled": true/false,
   "source": "KLMS",
-  "message": "休講に関する短いメッセージ"
+  "message": "休講に関する短いメッセージ",
+  "confidence": 0.0〜1.0"""
+
+SYSTEM_PROMPT = f"""{INSTRUCTIONS}
+出力JSON形式:
+```json
+{{
+{RESULT_FIELDS}
 }}
 ```
 
 JSONのみを出力してください。追加のテキストや説明は含めないでください。
 """
 
+BATCH_SYSTEM_PROMPT = f"""{INSTRUCTIONS}
+複数のお知らせが {{"announcements": [{{"id": ..., "title": ..., "body": ...}}, ...]}} の形式で与えられます。
+すべてのお知らせについて判定し、入力の id をそのまま付けて以下のJSON形式で出力してください。
+
+出力JSON形式:
+```json
+{{
+  "results": [
+    {{
+  "id": "入力のid",
+{RESULT_FIELDS}
+    }}
+  ]
+}}
+```
+
+JSONのみを出力してください。追加のテキストや説明は含めないでください。
+"""
+
+class AnalysisResponseError(ValueError):
+    """GPTの応答をJSONとして解析できなかったときの例外"""
+
+    def __init__(self, message: str, raw_response: str):
+        super().__init__(message)
+        self.raw_response = raw_response
+
+def build_messages(title: str, body: str) -> List[Dict]:
+    """1件のお知らせを判定するためのメッセージを作成する"""
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f"お知らせのタイトル: {title}\nお知らせの本文: {body}"}
+    ]
+
+def build_batch_messages(items: List[Dict]) -> List[Dict]:
+    """
+    複数のお知らせをまとめて判定するためのメッセージを作成する
+
+    Args:
+        items: id, title, body をキーに持つ辞書のリスト
+    """
+    announcements = [
+        {"id": str(item['id']), "title": item['title'], "body": item['body']}
+        for item in items
+    ]
+    return [
+        {"role": "system", "content": BATCH_SYSTEM_PROMPT},
+        {"role": "user", "content": json.dumps({"announcements": announcements}, ensure_ascii=False)}
+    ]
+
+def analysis_tiers() -> List[str]:
+    """
+    判定に使うモデルのリスト（安い順）
+
+    ANALYSIS_CASCADE_MODELS を設定した場合は、先頭のモデルから順に判定し、確信度が低い結果や
+    日付・時限が欠けた休講の結果だけを次のモデルで判定し直します（最後のモデルの結果は常に採用する）。
+    """
+    return list(Config.ANALYSIS_CASCADE_MODELS) or [Config.OPENAI_MODEL]
+
+def completion_params(messages: List[Dict], max_tokens: Optional[int] = None, model: Optional[str] = None) -> Dict:
+    """
+    Chat Completions API に渡すパラメータを作成する（Batch APIの入力にもそのまま使う）
+
+    model を指定しない場合は、判定に使うモデルのうち最後の（最も精度の高い）モデルを使います。
+    """
+    return {
+        "model": model or analysis_tiers()[-1],
+        "messages": messages,
+        "temperature": Config.OPENAI_TEMPERATURE,
+        "max_tokens": max_tokens or Config.OPENAI_MAX_TOKENS
+    }
+
+def batch_max_tokens(count: int) -> int:
+    """まとめて判定するときの最大出力トークン数（1件あたり OPENAI_MAX_TOKENS）"""
+    return Config.OPENAI_MAX_TOKENS * count
+
+def _strip_code_block(analysis_result_str: str) -> str:
+    """マークダウンのコードブロックを除去する"""
+    if analysis_result_str.startswith("```json"):
+        analysis_result_str = analysis_result_str[7:]  # ```json を除去
+    if analysis_result_str.startswith("```"):
+        analysis_result_str = analysis_result_str[3:]  # ``` を除去
+    if analysis_result_str.endswith("```"):
+        analysis_result_str = analysis_result_str[:-3]  # ``` を除去
+    return analysis_result_str.strip()
+
+def parse_analysis_response(analysis_result_str: str) -> dict:
+    """GPTの応答からJSON部分を取り出して辞書に変換する"""
     try:
-        response = client.chat.completions.create(
-            model=Config.OPENAI_MODEL,
-            messages=[
-                {"role": "user", "content": prompt}
-            ],
-            temperature=Config.OPENAI_TEMPERATURE,
-            max_tokens=Config.OPENAI_MAX_TOKENS
+        return json.loads(_strip_code_block(analysis_result_str))
+    except json.JSONDecodeError as e:
+        raise AnalysisResponseError(str(e), analysis_result_str) from e
+
+def parse_batch_response(analysis_result_str: str) -> Dict[str, dict]:
+    """
+    まとめて判定したときの応答を、お知らせのidをキーとする辞書に変換する
+    """
+    parsed = parse_analysis_response(analysis_result_str)
+    results = parsed.get('results') if isinstance(parsed, dict) else parsed
+    if not isinstance(results, list):
+        raise AnalysisResponseError("results が配列ではありません", analysis_result_str)
+
+    by_id = {}
+    for result in results:
+        if isinstance(result, dict) and result.get('id') is not None:
+            result = dict(result)
+            by_id[str(result.pop('id'))] = result
+    return by_id
+
+def store_analysis(title: str, body: str, analysis_result: dict, model: str):
+    """OpenAI APIで得た判定結果を、判定したモデルの分析結果として分析結果ストアに保存する"""
+    key = make_analysis_key(title, body, PROMPT_VERSION, model)
+    get_analysis_store().put(key, analysis_result, title, body, PROMPT_VERSION, model)
+
+def lookup_analysis(title: str, body: str, course_name: Optional[str] = None,
+                    reference_date: Optional[date] = None) -> Optional[dict]:
+    """
+    OpenAI APIを呼ばずに得られる判定結果を返す
+    
+    日付・時限がはっきり書かれた休講のお知らせはルールベースで抽出し、
+    同じ内容のお知らせを分析済みの場合は保存済みの結果を返します。どちらでもなければ None を返します。
+    保存済みの結果は判定に使うモデルの上位から順に探し、最後以外のモデルの結果は、今の設定でも
+    次のモデルで判定し直す必要がない（needs_escalation が False の）場合だけ使います。
+    """
+    rule_result = extract_cancellation(title, body, course_name, reference_date)
+    if rule_result is not None:
+        logger.debug(f"ルールベースで休講情報を抽出しました: {title}")
+        return rule_result
+
+    tiers = list(reversed(analysis_tiers()))
+    cached_result = get_analysis_store().get_first(
+        [make_analysis_key(title, body, PROMPT_VERSION, model) for model in tiers],
+        lambda position, result: position == 0 or not needs_escalation(result)
+    )
+    if cached_result is not None:
+        logger.debug(f"保存済みの分析結果を使用します: {title}")
+    return cached_result
+
+def _api(max_retries: Optional[int]):
+    client = get_client()
+    return client if max_retries is None else client.with_options(max_retries=max_retries)
+
+def _record_usage(response, model: str) -> int:
+    """応答のトークン使用量を metrics に記録し、合計トークン数を返す"""
+    usage = response.usage
+    if not usage:
+        return 0
+    GPT_TOKENS.inc(usage.prompt_tokens or 0, kind='prompt', model=model)
+    GPT_TOKENS.inc(usage.completion_tokens or 0, kind='completion', model=model)
+    return usage.total_tokens
+
+def _confidence(analysis_result: dict) -> Optional[float]:
+    value = analysis_result.get('confidence')
+    if isinstance(value, bool):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def needs_escalation(analysis_result: dict) -> bool:
+    """
+    最後以外のモデルの判定結果を、次のモデルで判定し直すべきかどうか
+
+    確信度がない・ANALYSIS_CASCADE_MIN_CONFIDENCE より低い結果と、休講と判定したのに
+    日付・時限が欠けている結果（ANALYSIS_CASCADE_ESCALATE_INCOMPLETE が有効な場合）は判定し直します。
+    """
+    confidence = _confidence(analysis_result)
+    if confidence is None or confidence < Config.ANALYSIS_CASCADE_MIN_CONFIDENCE:
+        return True
+    return (Config.ANALYSIS_CASCADE_ESCALATE_INCOMPLETE and bool(analysis_result.get('canceled'))
+            and not (analysis_result.get('date') and analysis_result.get('period')))
+
+def run_cascade(call: Callable[[str], dict]) -> Tuple[dict, str]:
+    """
+    analysis_tiers のモデルで順に判定し、(採用した判定結果, その結果を返したモデル) を返す
+
+    Args:
+        call: モデル名を受け取り、そのモデルで1件のお知らせを判定した結果を返す関数
+            （レート制限・再試行は呼び出し側で行う）
+    """
+    tiers = analysis_tiers()
+    for model in tiers[:-1]:
+        try:
+            analysis_result = call(model)
+        except AnalysisResponseError as e:
+            logger.debug(f"{model} の応答を解析できなかったため次のモデルで判定します: {e}")
+            GPT_TIER_RESULTS.inc(model=model, result='escalated')
+            continue
+        if not needs_escalation(analysis_result):
+            GPT_TIER_RESULTS.inc(model=model, result='accepted')
+            return analysis_result, model
+        GPT_TIER_RESULTS.inc(model=model, result='escalated')
+    analysis_result = call(tiers[-1])
+    GPT_TIER_RESULTS.inc(model=tiers[-1], result='accepted')
+    return analysis_result, tiers[-1]
+
+def run_cascade_batch(items: List[Dict],
+                      call: Callable[[str, List[Dict]], Dict[str, dict]]) -> Tuple[Dict[str, dict], Dict[str, str]]:
+    """
+    analysis_tiers のモデルで順に複数のお知らせをまとめて判定する
+
+    次のモデルで判定し直すのは、判定し直すべき結果と応答に含まれなかったお知らせだけです。
+    最後のモデルの応答にも含まれなかったお知らせは結果の辞書に含まれません。
+
+    Args:
+        items: id, title, body をキーに持つ辞書のリスト
+        call: モデル名とお知らせのリストを受け取り、お知らせのidをキーとする判定結果を返す関数
+
+    Returns:
+        (お知らせのidをキーとする採用した判定結果, お知らせのidをキーとするその結果を返したモデル)
+    """
+    tiers = analysis_tiers()
+    results: Dict[str, dict] = {}
+    models: Dict[str, str] = {}
+    remaining = items
+    for position, model in enumerate(tiers):
+        final = position == len(tiers) - 1
+        try:
+            tier_results = call(model, remaining)
+        except AnalysisResponseError as e:
+            if final:
+                raise
+            logger.debug(f"{model} の応答を解析できなかったため次のモデルで判定します: {e}")
+            tier_results = {}
+
+        escalated = []
+        for item in remaining:
+            analysis_result = tier_results.get(str(item['id']))
+            if analysis_result is not None and (final or not needs_escalation(analysis_result)):
+                results[str(item['id'])] = analysis_result
+                models[str(item['id'])] = model
+            else:
+                escalated.append(item)
+        GPT_TIER_RESULTS.inc(len(remaining) - len(escalated), model=model, result='accepted')
+        if not final:
+            GPT_TIER_RESULTS.inc(len(escalated), model=model, result='escalated')
+        remaining = escalated
+        if not remaining:
+            break
+    return results, models
+
+def request_model_analysis(title: str, body: str, model: str, max_retries: Optional[int] = None) -> Tuple[dict, int]:
+    """
+    指定したモデルで1件のお知らせを休講判定する（分析結果ストアには保存しない）
+
+    APIエラーは openai の例外、応答の解析エラーは AnalysisResponseError としてそのまま送出します。
+
+    Returns:
+        (判定結果, 消費したトークン数)
+    """
+    with GPT_REQUEST_SECONDS.time(mode='single', model=model):
+        response = _api(max_retries).chat.completions.create(
+            **completion_params(build_messages(title, body), model=model)
         )
-        
-        # 応答からJSON文字列を抽出し、パースする
-        analysis_result_str = response.choices[0].message.content
-        
-        # マークダウンのコードブロックを除去
-        if analysis_result_str.startswith("```json"):
-            analysis_result_str = analysis_result_str[7:]  # ```json を除去
-        if analysis_result_str.startswith("```"):
-            analysis_result_str = analysis_result_str[3:]  # ``` を除去
-        if analysis_result_str.endswith("```"):
-            analysis_result_str = analysis_result_str[:-3]  # ``` を除去
-        
-        analysis_result_str = analysis_result_str.strip()
-        analysis_result = json.loads(analysis_result_str)
+    total_tokens = _record_usage(response, model)
+
+    # 応答からJSON文字列を抽出し、パースする
+    return parse_analysis_response(response.choices[0].message.content), total_tokens
+
+def request_model_analysis_batch(items: List[Dict], model: str,
+                                 max_retries: Optional[int] = None) -> Tuple[Dict[str, dict], int]:
+    """
+    指定したモデルで複数のお知らせを1回のAPI呼び出しでまとめて休講判定する（分析結果ストアには保存しない）
+
+    Returns:
+        (お知らせのidをキーとする判定結果の辞書, 消費したトークン数)
+    """
+    params = completion_params(build_batch_messages(items), batch_max_tokens(len(items)), model)
+    with GPT_REQUEST_SECONDS.time(mode='batch', model=model):
+        response = _api(max_retries).chat.completions.create(**params)
+    total_tokens = _record_usage(response, model)
+    return parse_batch_response(response.choices[0].message.content), total_tokens
+
+def request_analysis(title: str, body: str, max_retries: Optional[int] = None) -> Tuple[dict, int]:
+    """
+    OpenAI APIで休講判定を行い、結果を分析結果ストアに保存する
+    
+    ANALYSIS_CASCADE_MODELS を設定した場合は、安いモデルから順に判定します（run_cascade）。
+    APIエラーは openai の例外、応答の解析エラーは AnalysisResponseError としてそのまま送出します。
+    
+    Args:
+        title: お知らせのタイトル
+        body: お知らせの本文
+        max_retries: SDK内部での再試行回数（Noneの場合はSDKの既定値。呼び出し側で再試行する場合は0）
+    
+    Returns:
+        (判定結果, 消費したトークン数（すべてのモデルの合計）)
+    """
+    total_tokens = 0
+
+    def call(model: str) -> dict:
+        nonlocal total_tokens
+        analysis_result, used_tokens = request_model_analysis(title, body, model, max_retries)
+        total_tokens += used_tokens
+        return analysis_result
+
+    analysis_result, model = run_cascade(call)
+    store_analysis(title, body, analysis_result, model)
+    return analysis_result, total_tokens
+
+def request_analysis_batch(items: List[Dict], max_retries: Optional[int] = None) -> Tuple[Dict[str, dict], int]:
+    """
+    複数のお知らせを1回のOpenAI API呼び出しでまとめて休講判定する
+    
+    指示と出力形式を1回分だけ送るため、1件ずつ判定するより入力トークンとリクエスト数を節約できます。
+    ANALYSIS_CASCADE_MODELS を設定した場合は、安いモデルから順に判定します（run_cascade_batch）。
+    応答に含まれなかったお知らせは結果の辞書に含まれません。
+    
+    Args:
+        items: id, title, body をキーに持つ辞書のリスト
+        max_retries: SDK内部での再試行回数（Noneの場合はSDKの既定値）
+    
+    Returns:
+        (お知らせのidをキーとする判定結果の辞書, 消費したトークン数（すべてのモデルの合計）)
+    """
+    total_tokens = 0
+
+    def call(model: str, chunk: List[Dict]) -> Dict[str, dict]:
+        nonlocal total_tokens
+        chunk_results, used_tokens = request_model_analysis_batch(chunk, model, max_retries)
+        total_tokens += used_tokens
+        return chunk_results
+
+    results, models = run_cascade_batch(items, call)
+    for item in items:
+        analysis_result = results.get(str(item['id']))
+        if analysis_result is not None:
+            store_analysis(item['title'], item['body'], analysis_result, models[str(item['id'])])
+    return results, total_tokens
+
+def tier_stats() -> List[Dict]:
+    """判定に使うモデルごとのリクエスト数・平均所要時間・トークン数・採用数・判定し直した数（プロセス起動後の累計）"""
+    stats = []
+    for model in analysis_tiers():
+        requests = sum(GPT_REQUEST_SECONDS.count(mode=mode, model=model) for mode in ('single', 'batch'))
+        seconds = sum(GPT_REQUEST_SECONDS.sum(mode=mode, model=model) for mode in ('single', 'batch'))
+        stats.append({
+            'model': model,
+            'requests': requests,
+            'mean_latency_ms': round(seconds / requests * 1000, 1) if requests else None,
+            'prompt_tokens': int(GPT_TOKENS.value(kind='prompt', model=model)),
+            'completion_tokens': int(GPT_TOKENS.value(kind='completion', model=model)),
+            'accepted': int(GPT_TIER_RESULTS.value(model=model, result='accepted')),
+            'escalated': int(GPT_TIER_RESULTS.value(model=model, result='escalated'))
+        })
+    return stats
+
+def analyze_announcement(title: str, body: str, course_name: Optional[str] = None,
+                         reference_date: Optional[date] = None) -> dict:
+    """
+    OpenAI APIを使用して、お知らせが休講情報であるかを判定し、構造化された情報を返します。
+    
+    日付・時限がはっきり書かれた休講のお知らせはルールベースで抽出し、
+    同じ内容のお知らせを分析済みの場合は保存済みの結果を返します（どちらもAPIは呼びません）。
+    多数のお知らせを分析する場合は、レート制限と再試行を行う analysis_scheduler を使用してください。
+    
+    Args:
+        title: お知らせのタイトル
+        body: お知らせの本文
+        course_name: 授業名（ルールベース抽出の結果に使用）
+        reference_date: 日付の年を推定するときの基準日（通常はお知らせの投稿日）
+    """
+    cached_result = lookup_analysis(title, body, course_name, reference_date)
+    if cached_result is not None:
+        return cached_result
+
+    try:
+        analysis_result, _ = request_analysis(title, body)
         return analysis_result
     except Exception as e:
         logger.error(f"OpenAI APIエラーまたはJSON解析エラーが発生しました: {e}")
         # より詳細なエラー情報を表示するために、元のエラーメッセージと生レスポンスを含める
-        return {"error": str(e), "raw_response": response.choices[0].message.content if 'response' in locals() and response.choices else 'N/A'}
+        return {"error": str(e), "raw_response": getattr(e, 'raw_response', 'N/A')}
 
 if __name__ == "__main__":
     logger.info("OpenAI GPTによる休講判定テストを開始します...")
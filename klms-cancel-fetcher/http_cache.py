@@ -0,0 +1,135 @@
+"""
+Canvas APIの応答キャッシュ
+
+Canvas APIの応答本文を ETag・Last-Modified とともにデータベースの http_cache テーブルに保存し、
+次回の同じリクエストでは If-None-Match・If-Modified-Since を付けて送ります。
+304 Not Modified が返ってきた場合は保存済みの本文をそのまま使います。
+有効期限（TTL）を指定したリクエスト（コース一覧など）は、期限内であればリクエスト自体を省略します。
+
+main.py は実行ごとに新しいプロセスで動くため、キャッシュはメモリではなくデータベースに保存します。
+COMPACT_STORAGE が有効な場合、本文は圧縮して保存します（serialization.compress_blob）。
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+from urllib.parse import urlencode
+
+from database import get_connection, transaction
+from metrics import CANVAS_RESPONSES
+from serialization import compress_blob, decompress_blob, dumps, loads
+from config import get_logger
+
+logger = get_logger(__name__)
+
+class CachedResponse:
+    """保存済みの応答"""
+
+    __slots__ = ('body', 'next_url', 'etag', 'last_modified', 'stored_at')
+
+    def __init__(self, body, next_url: Optional[str], etag: Optional[str], last_modified: Optional[str], stored_at: float):
+        self.body = body
+        self.next_url = next_url
+        self.etag = etag
+        self.last_modified = last_modified
+        self.stored_at = stored_at
+
+    def conditional_headers(self) -> Dict[str, str]:
+        """条件付きリクエストのヘッダー"""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+def cache_key(url: str, params: Optional[Dict], token: Optional[str]) -> str:
+    """
+    応答キャッシュのキーを作る
+
+    ユーザーごとに応答が異なるため、トークンのハッシュ値も含めます（トークン自体は保存しません）。
+    """
+    query = urlencode(sorted((params or {}).items()), doseq=True)
+    payload = "\x1f".join([hashlib.sha256((token or "").encode("utf-8")).hexdigest(), url, query])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """データベースに保存する応答キャッシュと、その利用状況の統計（metrics の klms_canvas_responses_total）"""
+
+    # 統計の種類: fresh（期限内でリクエストを省略）, not_modified（304で保存済みの本文を使用）,
+    # miss（本文を取得）
+    KINDS = ('fresh', 'not_modified', 'miss')
+
+    def lookup(self, key: str) -> Optional[CachedResponse]:
+        """保存済みの応答を返す（存在しない場合・読み込めない場合は None）"""
+        try:
+            row = get_connection().execute(
+                "SELECT body, next_url, etag, last_modified, stored_at FROM http_cache WHERE key = ?", (key,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"応答キャッシュの読み込みエラー: {e}")
+            return None
+        if row is None:
+            return None
+        return CachedResponse(loads(decompress_blob(row['body'])), row['next_url'], row['etag'], row['last_modified'], row['stored_at'])
+
+    def store(self, key: str, body, next_url: Optional[str], etag: Optional[str], last_modified: Optional[str]):
+        """応答を保存する（保存に失敗してもリクエスト自体は成功として扱う）"""
+        try:
+            with transaction() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO http_cache (key, body, next_url, etag, last_modified, stored_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, compress_blob(dumps(body)), next_url, etag, last_modified, time.time())
+                )
+        except sqlite3.Error as e:
+            logger.error(f"応答キャッシュの保存エラー: {e}")
+
+    def touch(self, key: str):
+        """304で内容が変わっていないことを確認できたときに、保存時刻を更新する"""
+        try:
+            with transaction() as connection:
+                connection.execute("UPDATE http_cache SET stored_at = ? WHERE key = ?", (time.time(), key))
+        except sqlite3.Error as e:
+            logger.error(f"応答キャッシュの保存エラー: {e}")
+
+    def purge(self, max_age_seconds: float) -> int:
+        """max_age_seconds より前に保存・確認された応答を削除し、削除した件数を返す"""
+        try:
+            with transaction() as connection:
+                cursor = connection.execute("DELETE FROM http_cache WHERE stored_at < ?", (time.time() - max_age_seconds,))
+                return cursor.rowcount
+        except sqlite3.Error as e:
+            logger.error(f"応答キャッシュの削除エラー: {e}")
+            return 0
+
+    def record(self, kind: str):
+        CANVAS_RESPONSES.inc(result=kind)
+
+    def stats(self) -> Dict:
+        """プロセス起動後の累計（fresh・not_modified・miss の件数とヒット率）"""
+        counts = {kind: int(CANVAS_RESPONSES.value(result=kind)) for kind in self.KINDS}
+        total = sum(counts.values())
+        counts['hit_ratio'] = (counts['fresh'] + counts['not_modified']) / total if total else None
+        return counts
+
+def stats_since(before: Dict, after: Dict) -> Dict:
+    """2つの stats() の差（1回の実行分の統計）を返す"""
+    counts = {kind: after[kind] - before[kind] for kind in ResponseCache.KINDS}
+    total = sum(counts.values())
+    counts['hit_ratio'] = (counts['fresh'] + counts['not_modified']) / total if total else None
+    return counts
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_response_cache() -> ResponseCache:
+    """共有の ResponseCache を取得する"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache()
+    return _cache
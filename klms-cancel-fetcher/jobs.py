@@ -0,0 +1,175 @@
+"""
+バックグラウンドジョブ管理
+
+休講情報の取得・分析はGPT呼び出しを含み数十秒かかることがあるため、
+APIサーバーのイベントループ外（専用スレッドプール）で実行し、状態と結果をジョブとして保持します。
+
+submit_once でキー（ユーザーの名前空間など）を指定すると、同じキーのジョブが実行中の間は新しいジョブを作らず、
+実行中のジョブを返します（同じユーザーの同時の更新要求は1回の実行にまとめ、全員が同じ結果を受け取る）。
+"""
+
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, Hashable, Optional, Sequence, Tuple
+
+from config import get_logger
+
+logger = get_logger(__name__)
+
+# ジョブの状態
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+
+class Job:
+    """1回分のバックグラウンド実行を表すクラス"""
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.status = JOB_QUEUED
+        self.created_at = datetime.now()
+        self.started_at: Optional[datetime] = None
+        self.finished_at: Optional[datetime] = None
+        self.result: Optional[Dict] = None
+        self.error: Optional[str] = None
+        self.future: Optional[Future] = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in (JOB_SUCCEEDED, JOB_FAILED)
+
+    def to_dict(self, include_result: bool = True) -> Dict:
+        """APIレスポンス用の辞書に変換する"""
+        data = {
+            'job_id': self.job_id,
+            'status': self.status,
+            'created_at': self.created_at.isoformat(),
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+        if self.error:
+            data['error'] = self.error
+        if include_result and self.result is not None:
+            data['result'] = self.result
+        return data
+
+class JobManager:
+    """
+    ジョブをスレッドプールで実行し、状態を管理するクラス
+
+    完了済みのジョブは新しいものから max_history 件まで保持します。
+    """
+
+    def __init__(self, max_workers: int, max_history: int):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        # キーごとの実行中のジョブ（submit_once 用）
+        self._in_flight: Dict[Hashable, Job] = {}
+        self._lock = threading.Lock()
+        self._max_history = max_history
+        self._coalesced = 0
+
+    def submit(self, fn: Callable[..., Optional[Dict]], *args, **kwargs) -> Job:
+        """
+        関数をバックグラウンドで実行するジョブを登録する
+
+        fn が None を返した場合は失敗として扱います。
+        """
+        job = Job(uuid.uuid4().hex)
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._prune()
+        job.future = self._executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def submit_once(self, key: Hashable, fn: Callable[..., Optional[Dict]], *args,
+                    join_keys: Sequence[Hashable] = (), **kwargs) -> Tuple[Job, bool]:
+        """
+        同じキーのジョブが実行中でなければ submit と同じくジョブを登録し、実行中であればそのジョブを返す
+
+        Args:
+            join_keys: key のジョブが実行中でない場合に、まとめてよい実行中のジョブのキー
+
+        Returns:
+            (ジョブ, 実行中のジョブにまとめた場合は True)
+        """
+        with self._lock:
+            for running_key in (key, *join_keys):
+                running = self._in_flight.get(running_key)
+                if running is not None and not running.done:
+                    self._coalesced += 1
+                    return running, True
+            job = Job(uuid.uuid4().hex)
+            self._jobs[job.job_id] = job
+            self._in_flight[key] = job
+            self._prune()
+            # ロックを持ったまま投入し、まとめる側が必ず future の設定されたジョブを受け取るようにする
+            job.future = self._executor.submit(self._run, job, fn, args, kwargs, key)
+        return job, False
+
+    def add_finished(self, result: Dict) -> Job:
+        """実行せずに結果が決まったジョブ（最近の結果を返す場合など）を完了済みとして登録する"""
+        job = Job(uuid.uuid4().hex)
+        job.started_at = job.finished_at = job.created_at
+        job.result = result
+        job.status = JOB_SUCCEEDED
+        job.future = Future()
+        job.future.set_result(result)
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._prune()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """ジョブIDからジョブを取得する"""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self) -> Dict:
+        """実行中のジョブ数と、実行中のジョブにまとめた要求の数（起動後の累計）"""
+        with self._lock:
+            return {
+                'in_flight': len(self._in_flight),
+                'coalesced': self._coalesced
+            }
+
+    def _run(self, job: Job, fn, args, kwargs, key: Optional[Hashable] = None) -> Optional[Dict]:
+        job.status = JOB_RUNNING
+        job.started_at = datetime.now()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            logger.error(f"ジョブ実行中にエラーが発生しました（ジョブID: {job.job_id}）: {e}")
+            job.error = str(e)
+            job.finished_at = datetime.now()
+            job.status = JOB_FAILED
+            self._release(key, job)
+            raise
+
+        job.finished_at = datetime.now()
+        if result is None:
+            job.error = "処理に失敗しました"
+            job.status = JOB_FAILED
+        else:
+            job.result = result
+            job.status = JOB_SUCCEEDED
+        self._release(key, job)
+        return result
+
+    def _release(self, key: Optional[Hashable], job: Job):
+        """完了したジョブを実行中のジョブから外す"""
+        if key is None:
+            return
+        with self._lock:
+            if self._in_flight.get(key) is job:
+                del self._in_flight[key]
+
+    def _prune(self):
+        """古い完了済みジョブを削除する（ロック取得済みで呼び出すこと）"""
+        finished = [job_id for job_id, job in self._jobs.items() if job.done]
+        for job_id in finished[:max(0, len(finished) - self._max_history)]:
+            del self._jobs[job_id]
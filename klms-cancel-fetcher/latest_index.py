@@ -0,0 +1,198 @@
+"""
+最新の結果のインデックス（/api/kyukou/latest 用）
+
+ユーザー（名前空間）ごとの最新の結果を、シリアライズ済みのJSONのバイト列と ETag・Last-Modified の組として
+プロセス内に保持します。同じプロセスで結果が保存されたときは result_store からの通知で置き換え、
+別プロセス（main.py の定期実行など）が保存した結果は、一定間隔ごとに分析時刻だけを確認して検出します。
+結果ログ（results/）を返す場合は、インデックスの更新時刻が変わったときだけ読み直します。
+圧縮した本文（gzip・brotli）も最初に要求されたときに作って保持するため、同じ結果を圧縮し直しません。
+"""
+
+import hashlib
+import os
+import threading
+import time
+from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Any, Dict, Optional, Tuple
+
+from database import DEFAULT_NAMESPACE
+from compression import compress, weak_etag
+from lru import LRUCache
+from result_store import add_listener, get_latest_analyzed_at, get_latest_result
+from results_log import get_results_log, legacy_result_files
+from serialization import dumps, loads
+from config import Config, get_logger
+
+logger = get_logger(__name__)
+
+class LatestEntry:
+    """シリアライズ済みの最新の結果"""
+
+    __slots__ = ('body', 'etag', 'last_modified', 'version', 'checked_at', '_encoded')
+
+    def __init__(self, data: Dict[str, Any], version: Tuple, last_modified: Optional[float]):
+        self.body = dumps(data)
+        self.etag = f'"{hashlib.sha256(self.body).hexdigest()[:32]}"'
+        self.last_modified = last_modified
+        self.version = version
+        self.checked_at = time.monotonic()
+        self._encoded: Dict[str, bytes] = {}
+
+    def encoded_body(self, encoding: Optional[str]) -> bytes:
+        """指定した方式で圧縮した本文（None の場合は圧縮しない本文）。圧縮した本文は保持して使い回す"""
+        if encoding is None:
+            return self.body
+        body = self._encoded.get(encoding)
+        if body is None:
+            body = self._encoded[encoding] = compress(self.body, encoding)
+        return body
+
+    def headers(self, encoding: Optional[str] = None) -> Dict[str, str]:
+        """ETag・Last-Modified などの応答ヘッダー（圧縮した本文の場合は Content-Encoding と弱い ETag）"""
+        headers = {'ETag': self.etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+        if encoding is not None:
+            headers['ETag'] = weak_etag(self.etag)
+            headers['Content-Encoding'] = encoding
+        if self.last_modified is not None:
+            headers['Last-Modified'] = formatdate(self.last_modified, usegmt=True)
+        return headers
+
+    def not_modified(self, if_none_match: Optional[str], if_modified_since: Optional[str]) -> bool:
+        """
+        条件付きリクエストに対して 304 Not Modified を返せるかどうか
+
+        If-None-Match がある場合はそれだけで判定し、ない場合に If-Modified-Since を使います。
+        """
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or any(tag.removeprefix('W/') == self.etag for tag in tags)
+        if if_modified_since is not None and self.last_modified is not None:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(self.last_modified) <= int(since)
+        return False
+
+def _empty_result(source: str) -> Dict[str, Any]:
+    return {
+        'summary': {
+            'total_courses': 0,
+            'total_cancellations': 0,
+            'analyzed_at': None,
+            'source': source
+        },
+        'cancellations': []
+    }
+
+def _timestamp(analyzed_at: Optional[str]) -> Optional[float]:
+    if not analyzed_at:
+        return None
+    try:
+        return datetime.fromisoformat(analyzed_at).timestamp()
+    except ValueError:
+        return None
+
+class LatestResultIndex:
+    """
+    ユーザーごとの最新の結果をシリアライズ済みで保持するインデックス
+
+    Args:
+        max_entries: 保持するユーザー数の上限
+        check_interval: 別プロセスによる更新を確認する間隔（秒）
+        results_dir: 保存済みの結果がない場合に参照する結果ファイルのディレクトリ
+    """
+
+    def __init__(self, max_entries: int, check_interval: float, results_dir: str):
+        self.check_interval = check_interval
+        self.results_dir = results_dir
+        self._entries = LRUCache(max_entries)
+
+    def get(self, namespace: str) -> LatestEntry:
+        """名前空間の最新の結果を返す（必要な場合だけ読み込み・シリアライズし直す）"""
+        entry = self._entries.get(namespace)
+        if entry is not None and time.monotonic() - entry.checked_at < self.check_interval:
+            return entry
+
+        version = self._current_version(namespace)
+        if entry is not None and entry.version == version:
+            entry.checked_at = time.monotonic()
+            return entry
+
+        entry = self._load(namespace, version)
+        self._entries.put(namespace, entry)
+        return entry
+
+    def update(self, namespace: str, result: Dict[str, Any]):
+        """新しい結果が保存されたときに呼ばれる（result_store のリスナー）"""
+        analyzed_at = result.get('summary', {}).get('analyzed_at')
+        self._entries.put(namespace, self._make_entry(result, ('db', analyzed_at), analyzed_at))
+
+    def stats(self) -> Dict:
+        return self._entries.stats()
+
+    def _current_version(self, namespace: str) -> Tuple:
+        """結果が更新されたかどうかを判定するための値（データベースの分析時刻、または結果ログ・結果ディレクトリの更新時刻）"""
+        analyzed_at = get_latest_analyzed_at(namespace)
+        if analyzed_at is not None:
+            return ('db', analyzed_at)
+        if namespace != DEFAULT_NAMESPACE:
+            return ('none',)
+        try:
+            return ('file', get_results_log().version(), os.stat(self.results_dir).st_mtime_ns)
+        except FileNotFoundError:
+            return ('no_data',)
+
+    def _load(self, namespace: str, version: Tuple) -> LatestEntry:
+        kind = version[0]
+        if kind == 'db':
+            result = get_latest_result(namespace)
+            if result is not None:
+                return self._make_entry(result, version, version[1])
+            return LatestEntry(_empty_result('no_results'), ('none',), None)
+        if kind == 'file':
+            return self._load_latest_file(version)
+        return LatestEntry(_empty_result('no_data' if kind == 'no_data' else 'no_results'), version, None)
+
+    def _make_entry(self, result: Dict[str, Any], version: Tuple, analyzed_at: Optional[str]) -> LatestEntry:
+        data = dict(result, summary=dict(result.get('summary', {}), source='latest_result'))
+        return LatestEntry(data, version, _timestamp(analyzed_at))
+
+    def _load_latest_file(self, version: Tuple) -> LatestEntry:
+        """結果ログ（main.py の出力）の最新の結果を読み込む（ログがなければ以前のバージョンの結果ファイルを読む）"""
+        data = get_results_log().latest()
+        source_file = os.path.basename(Config.RESULTS_LOG_FILE)
+        if data is None:
+            legacy_files = legacy_result_files(self.results_dir)
+            if not legacy_files:
+                return LatestEntry(_empty_result('no_results'), version, None)
+            with open(legacy_files[-1], 'rb') as f:
+                data = loads(f.read())
+            source_file = os.path.basename(legacy_files[-1])
+
+        # source情報を追加
+        if 'summary' in data:
+            data['summary']['source'] = 'cached_file'
+            data['summary']['source_file'] = source_file
+
+        logger.info(f"結果ファイルを読み込みました: {source_file}")
+        return LatestEntry(data, version, _timestamp(data.get('summary', {}).get('analyzed_at')))
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_latest_index() -> LatestResultIndex:
+    """共有の LatestResultIndex を取得する（初回呼び出し時に result_store の通知を登録する）"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                index = LatestResultIndex(
+                    max_entries=Config.LATEST_RESULTS_CACHE_MAX_USERS,
+                    check_interval=Config.LATEST_RESULT_CHECK_INTERVAL,
+                    results_dir=Config.RESULTS_DIR
+                )
+                add_listener(index.update)
+                _index = index
+    return _index
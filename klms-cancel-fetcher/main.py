@@ -1,147 +1,144 @@
 #!/usr/bin/env python3
 import os
-import json
+import argparse
 from datetime import datetime
-from canvas_api import get_courses, get_announcements
-from gpt_analyzer import analyze_announcement
-from cache_manager import load_cache, save_cache, get_new_announcements, update_cache_with_announcements, print_cache_stats
+from pipeline import run_pipeline, annotate_result
+from batch_jobs import collect_batch_jobs, defer_to_batch
+from daemon import run_daemon
+from cache_manager import load_cache, save_cache, update_cache_with_announcements
+from analysis_store import get_analysis_store
+from result_store import save_latest_result
+from cancellation_index import update_cancellations
+from results_log import get_results_log
+from database import DEFAULT_NAMESPACE
+from metrics import write_metrics_file
 from config import Config, get_logger
 
 logger = get_logger(__name__)
 
-def main(canvas_token=None):
+def collect_batch_results():
+    """
+    完了したBatchジョブの結果を回収し、休講情報の結果とキャッシュに反映する
+    
+    Returns:
+        summary と cancellations を持つ結果の辞書
+    """
+    current_time = datetime.now()
+    collected = collect_batch_jobs()
+    
+    cache = load_cache()
+    all_results = []
+    analyzed = []
+    course_ids = set()
+    for item, analysis_result in collected:
+        course_ids.add(item['course_id'])
+        
+        # エラーになったお知らせはキャッシュに登録せず、次回の実行で再び判定する
+        if 'error' in analysis_result:
+            logger.error(f"  エラー（{item['course_name']}: {item['title']}）: {analysis_result['error']}")
+            continue
+        
+        update_cache_with_announcements(item['course_id'], [item['announcement']], cache)
+        analyzed.append(annotate_result(
+            analysis_result, item['course_id'], item['course_name'], item['announcement'], current_time
+        ))
+        if analysis_result.get('canceled', False):
+            all_results.append(analysis_result)
+    save_cache(cache)
+    get_analysis_store().flush()
+    
+    result = {
+        'summary': {
+            'total_courses': len(course_ids),
+            'total_cancellations': len(all_results),
+            'analyzed_at': current_time.isoformat()
+        },
+        'cancellations': all_results
+    }
+    update_cancellations(DEFAULT_NAMESPACE, analyzed)
+    save_latest_result(DEFAULT_NAMESPACE, result)
+    return result
+
+def save_result(result):
+    """結果を結果ログ（NDJSON）に追記し、結果サマリーを表示する"""
+    summary = result['summary']
+    all_results = result['cancellations']
+    
+    # 結果を結果ログ（NDJSON）に追記
+    output_file = Config.RESULTS_LOG_FILE
+    logger.info(f"結果を保存中: {output_file}")
+    get_results_log().append(result)
+    
+    # 結果サマリーを表示
+    logger.info("=== 実行結果 ===")
+    logger.info(f"分析対象コース数: {summary['total_courses']}")
+    logger.info(f"検出した休講情報: {len(all_results)}件")
+    logger.info(f"結果ログ: {output_file}")
+    
+    if all_results:
+        logger.info("検出した休講情報:")
+        for result in all_results:
+            logger.info(f"  - {result.get('course', 'Unknown')}: {result.get('date')} {result.get('period')}")
+
+def main(canvas_token=None, batch_mode=None, daemon=False):
     """
     KLMS休講情報取得メインスクリプト
     1. Canvas APIでコース一覧を取得
     2. 各コースのお知らせを取得
     3. GPTで休講判定を実行
-    4. 結果をJSONファイルに保存
+    4. 結果を結果ログ（results/klms_results.ndjson）に追記
+    
+    終了時に、処理時間・API呼び出し・キャッシュのヒット率などのメトリクスを METRICS_FILE に書き出します。
     
     Args:
         canvas_token: Canvas APIトークン（Noneの場合は環境変数から取得）
+        batch_mode: None の場合はその場で判定する。
+            "submit" の場合はGPTでの判定をOpenAI Batchジョブとして投入し、
+            "collect" の場合は完了したBatchジョブの結果を回収する
+        daemon: True の場合は常駐し、コースごとの取得間隔で 1.〜4. を繰り返す（daemon.py。
+            休講情報を検出したときだけ結果ログに追記する）
     """
     logger.info("KLMS休講情報取得を開始します...")
     
     # 結果を保存するディレクトリを作成
     os.makedirs(Config.RESULTS_DIR, exist_ok=True)
     
-    # キャッシュを読み込み
-    logger.info("前回のキャッシュを読み込み中...")
-    cache = load_cache()
-    print_cache_stats(cache)
-    
-    # 現在の日時を取得（ファイル名用）
-    current_time = datetime.now()
-    timestamp = current_time.strftime("%Y-%m-%d_%H-%M-%S")
-    output_file = f"{Config.RESULTS_DIR}/klms_results_{timestamp}.json"
-    
-    # 全体の結果を格納するリスト
-    all_results = []
+    if daemon:
+        run_daemon(canvas_token, on_result=save_result)
+        return
     
     try:
-        # 1. コース一覧を取得
-        logger.info("コース一覧を取得中...")
-        courses = get_courses(canvas_token)
-        if not courses:
-            logger.error("コースの取得に失敗しました。")
+        # 1.〜3. コース・お知らせの取得と休講判定
+        if batch_mode == "collect":
+            result = collect_batch_results()
+        elif batch_mode == "submit":
+            result = run_pipeline(canvas_token, analyze_items=defer_to_batch)
+        else:
+            result = run_pipeline(canvas_token)
+        if result is None:
             return
         
-        logger.info(f"取得したコース数: {len(courses)}")
-        
-        # 2. 各コースのお知らせを取得・分析
-        for i, course in enumerate(courses, 1):
-            course_id = course.get('id')
-            course_name = course.get('name', 'Unknown')
-            
-            logger.info(f"[{i}/{len(courses)}] コース: {course_name} (ID: {course_id})")
-            
-            if not course_id:
-                logger.warning("  コースIDが取得できませんでした。スキップします。")
-                continue
-            
-            # お知らせを取得
-            announcements = get_announcements(course_id, canvas_token)
-            if not announcements:
-                logger.debug("  お知らせが見つかりませんでした。")
-                continue
-            
-            logger.debug(f"  お知らせ数: {len(announcements)}")
-            
-            # 新しいお知らせのみを抽出
-            new_announcements = get_new_announcements(course_id, announcements, cache)
-            if not new_announcements:
-                logger.debug("  新しいお知らせはありません。")
-                # キャッシュは更新しておく
-                update_cache_with_announcements(course_id, announcements, cache)
-                continue
-            
-            logger.info(f"  新しいお知らせ数: {len(new_announcements)}")
-            
-            # 新しいお知らせのみを分析
-            for ann in new_announcements:
-                ann_title = ann.get('title', '')
-                ann_body = ann.get('message', '')
-                ann_id = ann.get('id')
-                
-                logger.debug(f"    分析中: {ann_title}")
-                
-                # GPTで休講判定
-                analysis_result = analyze_announcement(ann_title, ann_body)
-                
-                # エラーチェック
-                if 'error' in analysis_result:
-                    logger.error(f"    エラー: {analysis_result['error']}")
-                    continue
-                
-                # 結果に追加情報を付与
-                analysis_result['course_id'] = course_id
-                analysis_result['course_name'] = course_name
-                analysis_result['announcement_id'] = ann_id
-                analysis_result['announcement_title'] = ann_title
-                analysis_result['analyzed_at'] = current_time.isoformat()
-                
-                # 休講の場合のみ結果に追加
-                if analysis_result.get('canceled', False):
-                    all_results.append(analysis_result)
-                    logger.info(f"    ✓ 休講情報を検出: {analysis_result.get('date')} {analysis_result.get('period')}")
-                else:
-                    logger.debug("    - 休講ではありません")
-            
-            # キャッシュを更新
-            update_cache_with_announcements(course_id, announcements, cache)
-        
-        # 3. 結果をJSONファイルに保存
-        logger.info(f"結果を保存中: {output_file}")
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump({
-                'summary': {
-                    'total_courses': len(courses),
-                    'total_cancellations': len(all_results),
-                    'analyzed_at': current_time.isoformat()
-                },
-                'cancellations': all_results
-            }, f, ensure_ascii=False, indent=2)
-        
-        # 4. 結果サマリーを表示
-        logger.info("=== 実行結果 ===")
-        logger.info(f"分析対象コース数: {len(courses)}")
-        logger.info(f"検出した休講情報: {len(all_results)}件")
-        logger.info(f"結果ファイル: {output_file}")
-        
-        if all_results:
-            logger.info("検出した休講情報:")
-            for result in all_results:
-                logger.info(f"  - {result.get('course', 'Unknown')}: {result.get('date')} {result.get('period')}")
+        # 4. 結果を結果ログ（NDJSON）に追記
+        save_result(result)
         
     except Exception as e:
         logger.error(f"実行中にエラーが発生しました: {e}")
         return
     finally:
-        # キャッシュを保存
-        logger.info("キャッシュを保存中...")
-        save_cache(cache)
+        write_metrics_file()
     
     logger.info("KLMS休講情報取得を完了しました。")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="KLMS休講情報取得")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--batch-submit", action="store_const", const="submit", dest="batch_mode",
+                       help="GPTでの判定をOpenAI Batchジョブとして投入する（結果は --batch-collect で回収）")
+    group.add_argument("--batch-collect", action="store_const", const="collect", dest="batch_mode",
+                       help="完了したOpenAI Batchジョブの結果を回収する")
+    group.add_argument("--daemon", action="store_true",
+                       help="常駐して、コースごとの取得間隔でお知らせの取得・判定を繰り返す（SIGINT・SIGTERMで停止）")
+    args = parser.parse_args()
+    
+    Config.validate_required_env_vars()
+    main(batch_mode=args.batch_mode, daemon=args.daemon)
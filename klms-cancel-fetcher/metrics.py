@@ -0,0 +1,323 @@
+"""
+処理の計測値（メトリクス）
+
+パイプラインの各段階の所要時間（ヒストグラム）、Canvas API・OpenAI APIの呼び出し回数・エラー・再試行・トークン数、
+キャッシュのヒット率などをプロセス内で集計し、Prometheus のテキスト形式で出力します。
+APIサーバーは /metrics で返し、main.py は実行の終わりに METRICS_FILE に書き出します
+（node_exporter の textfile collector で読み込めます）。
+
+外部パッケージ（prometheus_client）は使わず、必要な Counter・Gauge・Histogram だけを実装しています。
+"""
+
+import abc
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from config import Config, get_logger
+
+logger = get_logger(__name__)
+
+# 所要時間のヒストグラムの既定の区切り（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(labels: Sequence[Tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in labels) + "}"
+
+class _Metric(abc.ABC):
+    """ラベルの組ごとに値を持つメトリクスの共通部分"""
+
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} のラベルは {self.labelnames} です: {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: Tuple[str, ...]) -> List[Tuple[str, str]]:
+        return list(zip(self.labelnames, key))
+
+    @abc.abstractmethod
+    def samples(self) -> List[Tuple[str, List[Tuple[str, str]], float]]:
+        """(サンプル名, ラベル, 値) のリスト"""
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+class Counter(_Metric):
+    """増えるだけの値（回数・トークン数など）"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        key = self._key(labels)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        if not self.labelnames and not values:
+            # ラベルのないカウンターは、まだ一度も増えていなくても 0 を出力する
+            values[()] = 0
+        return [(self.name, self._labels(key), value) for key, value in sorted(values.items())]
+
+class Gauge(_Metric):
+    """出力するときに関数で求める値（ヒット率など）"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._functions: Dict[Tuple[str, ...], Callable[[], Optional[float]]] = {}
+
+    def set_function(self, function: Callable[[], Optional[float]], **labels):
+        """出力のたびに function() の値を使う（None を返した場合は出力しない）"""
+        with self._lock:
+            self._functions[self._key(labels)] = function
+
+    def samples(self):
+        with self._lock:
+            functions = sorted(self._functions.items())
+        samples = []
+        for key, function in functions:
+            value = function()
+            if value is not None:
+                samples.append((self.name, self._labels(key), value))
+        return samples
+
+class Histogram(_Metric):
+    """所要時間などの分布"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # ラベルの組ごとの [区切りごとの件数, 合計, 件数]
+        self._values: Dict[Tuple[str, ...], List] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """with ブロックの所要時間（秒）を記録する（例外で抜けた場合も記録する）"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return entry[2] if entry else 0
+
+    def sum(self, **labels) -> float:
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return entry[1] if entry else 0.0
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                labels = self._labels(key)
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    samples.append((f"{self.name}_bucket", labels + [('le', _format_value(bound))], cumulative))
+                samples.append((f"{self.name}_sum", labels, total))
+                samples.append((f"{self.name}_count", labels, count))
+        return samples
+
+class Registry:
+    """メトリクスの一覧"""
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Prometheus のテキスト形式（text/plain; version=0.0.4）"""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+# パイプラインの段階ごとの所要時間
+# stage: course_list, announcement_fetch, dedup, gpt_analysis, cache_load, cache_save, pipeline（全体）
+STAGE_SECONDS = registry.register(Histogram(
+    "klms_stage_duration_seconds", "パイプラインの段階ごとの所要時間（秒）", ("stage",)
+))
+PIPELINE_RUNS = registry.register(Counter(
+    "klms_pipeline_runs_total", "パイプラインの実行回数（result: ok, failed）", ("result",)
+))
+
+# Canvas API
+CANVAS_REQUEST_SECONDS = registry.register(Histogram(
+    "klms_canvas_request_duration_seconds", "Canvas APIへの1リクエストの所要時間（秒）"
+))
+CANVAS_RESPONSES = registry.register(Counter(
+    "klms_canvas_responses_total",
+    "Canvas APIの応答の使い方（result: fresh=期限内でリクエスト省略, not_modified=304, miss=本文を取得）",
+    ("result",)
+))
+CANVAS_ERRORS = registry.register(Counter(
+    "klms_canvas_errors_total", "Canvas APIのエラー（HTTPエラー・接続エラー）の件数"
+))
+
+# OpenAI API
+GPT_REQUEST_SECONDS = registry.register(Histogram(
+    "klms_gpt_request_duration_seconds", "OpenAI APIへの1リクエストの所要時間（秒）（mode: single, batch）", ("mode", "model")
+))
+GPT_REQUESTS = registry.register(Counter(
+    "klms_gpt_requests_total", "OpenAI APIへのリクエスト数（再試行を含む）"
+))
+GPT_TOKENS = registry.register(Counter(
+    "klms_gpt_tokens_total", "OpenAI APIで消費したトークン数（kind: prompt, completion）", ("kind", "model")
+))
+GPT_RETRIES = registry.register(Counter(
+    "klms_gpt_retries_total", "OpenAI APIのエラーで再試行した回数"
+))
+GPT_ERRORS = registry.register(Counter(
+    "klms_gpt_errors_total", "判定できなかったお知らせの件数（APIエラー・応答の解析エラー）"
+))
+GPT_TIER_RESULTS = registry.register(Counter(
+    "klms_gpt_tier_results_total",
+    "段階的な判定（ANALYSIS_CASCADE_MODELS）の各モデルの判定結果の扱い"
+    "（result: accepted=採用, escalated=確信度が低い・日付か時限が欠けているため次のモデルで判定し直した）",
+    ("model", "result")
+))
+GPT_SKIPPED = registry.register(Counter(
+    "klms_gpt_skipped_total", "OpenAI APIを呼ばずに判定したお知らせの件数（ルールベース抽出・保存済みの分析結果）"
+))
+
+# APIサーバーの更新要求（/api/kyukou・/api/kyukou/refresh）
+REFRESH_REQUESTS = registry.register(Counter(
+    "klms_refresh_requests_total",
+    "更新要求の扱い（result: started=実行, coalesced=実行中の同じユーザーの実行にまとめた, throttled=最近の結果を返した）",
+    ("result",)
+))
+
+# 重複するお知らせ（dedup.py）
+DEDUP_ANNOUNCEMENTS = registry.register(Counter(
+    "klms_dedup_announcements_total",
+    "判定したお知らせの重複の判定（kind: unique=グループの代表, exact=完全一致, near=ほぼ一致）", ("kind",)
+))
+DEDUP_GPT_CALLS_SAVED = registry.register(Counter(
+    "klms_dedup_gpt_calls_saved_total", "重複するお知らせを判定しなかったことで省略したGPT呼び出しの数"
+))
+
+# 関連度モデルによる絞り込み（relevance_model.py）
+RELEVANCE_GATE = registry.register(Counter(
+    "klms_relevance_gate_total",
+    "関連度モデルで採点したお知らせ（result: skipped=休講ではないと判定しGPTを呼ばなかった, passed=GPTで判定した）",
+    ("result",)
+))
+
+# キャッシュ
+ANNOUNCEMENTS = registry.register(Counter(
+    "klms_announcements_total", "取得したお知らせの件数（result: new=新しいお知らせ, known=確認済み）", ("result",)
+))
+ANALYSIS_STORE_LOOKUPS = registry.register(Counter(
+    "klms_analysis_store_lookups_total", "保存済みの分析結果の検索（result: hit, miss）", ("result",)
+))
+PREPROCESS_TOKENS = registry.register(Counter(
+    "klms_preprocess_tokens_total", "お知らせ本文の前処理の前後のトークン数（stage: before, after）", ("stage",)
+))
+PREPROCESS_DOCUMENTS = registry.register(Counter(
+    "klms_preprocess_documents_total", "前処理したお知らせ本文の件数"
+))
+
+def hit_ratio(hits: float, misses: float) -> Optional[float]:
+    total = hits + misses
+    return hits / total if total else None
+
+CACHE_HIT_RATIO = registry.register(Gauge(
+    "klms_cache_hit_ratio", "キャッシュのヒット率（プロセス起動後の累計）", ("cache",)
+))
+CACHE_HIT_RATIO.set_function(
+    lambda: hit_ratio(ANNOUNCEMENTS.value(result='known'), ANNOUNCEMENTS.value(result='new')), cache='announcements'
+)
+CACHE_HIT_RATIO.set_function(
+    lambda: hit_ratio(ANALYSIS_STORE_LOOKUPS.value(result='hit'), ANALYSIS_STORE_LOOKUPS.value(result='miss')),
+    cache='analysis_store'
+)
+CACHE_HIT_RATIO.set_function(
+    lambda: hit_ratio(
+        CANVAS_RESPONSES.value(result='fresh') + CANVAS_RESPONSES.value(result='not_modified'),
+        CANVAS_RESPONSES.value(result='miss')
+    ),
+    cache='canvas_responses'
+)
+
+def write_metrics_file(path: Optional[str] = None):
+    """
+    メトリクスをファイルに書き出す（一時ファイルに書いてから置き換えるため、読み込み側が途中の内容を読むことはない）
+
+    書き込みに失敗しても処理自体は成功として扱います。
+    """
+    path = path or Config.METRICS_FILE
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(registry.render())
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.error(f"メトリクスファイルの書き込みエラー: {e}")
@@ -0,0 +1,273 @@
+"""
+休講情報取得パイプライン
+
+コース一覧の取得 → お知らせの取得 → GPTによる休講判定 → キャッシュ更新 までの一連の処理を
+main.py（バッチ実行）と api_server.py（WebAPI）で共通利用するためのモジュールです。
+"""
+
+from datetime import date, datetime
+from typing import Callable, Dict, List, Optional
+
+from canvas_api import get_courses, get_announcements_for_courses
+from analysis_scheduler import get_scheduler
+from analysis_store import get_analysis_store
+from cache_manager import (
+    load_cache, save_cache, get_new_announcements, update_cache_with_announcements, print_cache_stats,
+    namespace_for_token
+)
+from http_cache import get_response_cache, stats_since
+from metrics import PIPELINE_RUNS, STAGE_SECONDS
+from result_store import save_latest_result
+from cancellation_index import update_cancellations
+from text_preprocessor import prepare_body
+from dedup import analyze_deduplicated
+from config import Config, get_logger
+
+logger = get_logger(__name__)
+
+def _posted_date(ann: Dict) -> Optional[date]:
+    """お知らせの投稿日（posted_at）を日付として返す"""
+    posted_at = ann.get('posted_at')
+    if not posted_at:
+        return None
+    try:
+        return datetime.fromisoformat(posted_at.replace('Z', '+00:00')).date()
+    except ValueError:
+        return None
+
+def annotate_result(analysis_result: Dict, course_id, course_name: str, ann: Dict, analyzed_at: datetime) -> Dict:
+    """判定結果にコース・お知らせの情報を付与する"""
+    analysis_result['course_id'] = course_id
+    analysis_result['course_name'] = course_name
+    analysis_result['announcement_id'] = ann.get('id')
+    analysis_result['announcement_title'] = ann.get('title', '')
+    analysis_result['analyzed_at'] = analyzed_at.isoformat()
+    return analysis_result
+
+def build_analysis_items(pending: List) -> List[Dict]:
+    """
+    新しいお知らせを判定用の辞書に変換する
+
+    本文はHTMLをテキストにし、定型部分を除いてトークン数の上限内に収めたもの（text_preprocessor）を使います。
+    """
+    items = []
+    tokens_before = 0
+    tokens_after = 0
+    for course_id, course_name, _, new_announcements in pending:
+        for ann in new_announcements:
+            body, before, after = prepare_body(ann.get('message', ''))
+            tokens_before += before
+            tokens_after += after
+            items.append({
+                'title': ann.get('title', ''),
+                'body': body,
+                'course_name': course_name,
+                'reference_date': _posted_date(ann),
+                'course_id': course_id,
+                'announcement': ann
+            })
+    if items:
+        logger.info(
+            f"本文の前処理: {tokens_before} → {tokens_after}トークン"
+            f"（{(1 - tokens_after / tokens_before) * 100 if tokens_before else 0:.1f}%削減, {len(items)}件）"
+        )
+    return items
+
+def analyze_with_scheduler(items: List[Dict]) -> List[Dict]:
+    """analysis_scheduler で休講判定を行う（run_pipeline の既定の判定方法）"""
+    results, _ = get_scheduler().analyze_many(items)
+    return results
+
+def log_response_cache_stats(stats: Dict):
+    """Canvas APIの応答キャッシュの利用状況をログに出力する"""
+    if stats['hit_ratio'] is None:
+        return
+    logger.info(
+        f"Canvas応答キャッシュ: 期限内 {stats['fresh']}件 / 304 {stats['not_modified']}件 / 取得 {stats['miss']}件"
+        f"（ヒット率 {stats['hit_ratio'] * 100:.1f}%）"
+    )
+
+def run_pipeline(canvas_token=None, force_refresh: bool = False,
+                 analyze_items: Callable[[List[Dict]], List[Dict]] = analyze_with_scheduler,
+                 courses: Optional[List[Dict]] = None, total_courses: Optional[int] = None) -> Optional[Dict]:
+    """
+    休講情報の取得・分析を実行し、結果を返す
+
+    1. Canvas APIでコース一覧を取得
+    2. 全コースのお知らせを取得
+    3. 新しいお知らせをGPTで休講判定（重複するお知らせは dedup でまとめ、analysis_scheduler で並行実行）
+    4. キャッシュを更新・保存し、結果をユーザーの最新の結果・休講情報のインデックスに保存
+
+    キャッシュと最新の結果は canvas_token ごと（トークンのハッシュ値の名前空間ごと）に分けて保存します。
+
+    Args:
+        canvas_token: Canvas APIトークン（Noneの場合は環境変数から取得）
+        force_refresh: キャッシュを無視してすべてのお知らせを分析するかどうか（このトークンのキャッシュのみ）
+        analyze_items: 新しいお知らせ（title, body, course_name, reference_date, course_id, announcement を
+            キーに持つ辞書）のリストを受け取り、同じ順序で判定結果を返す関数。
+            結果に deferred が含まれるお知らせは後で判定するものとして扱い、キャッシュには登録しない
+        courses: 処理するコースのリスト（Canvas APIのコース情報）。指定した場合はコース一覧を取得せず、
+            これらのコースのお知らせだけを処理する（デーモンモードで期限が来たコースだけを処理する場合など）
+        total_courses: 結果の summary.total_courses に入れるコース数（courses で一部のコースだけを処理する場合に、
+            ユーザーの全コース数を指定する。省略した場合は処理したコースの数）
+
+    Returns:
+        summary と cancellations を持つ結果の辞書（コース一覧の取得に失敗した場合は None）
+    """
+    # 全体と段階ごとの所要時間・実行結果は metrics に記録する
+    try:
+        with STAGE_SECONDS.time(stage='pipeline'):
+            result = _run_pipeline(canvas_token, force_refresh, analyze_items, courses, total_courses)
+    except Exception:
+        PIPELINE_RUNS.inc(result='failed')
+        raise
+    PIPELINE_RUNS.inc(result='ok' if result is not None else 'failed')
+    return result
+
+def _run_pipeline(canvas_token, force_refresh: bool, analyze_items: Callable[[List[Dict]], List[Dict]],
+                  courses: Optional[List[Dict]], total_courses: Optional[int]) -> Optional[Dict]:
+    # キャッシュを読み込み
+    logger.info("前回のキャッシュを読み込み中...")
+    namespace = namespace_for_token(canvas_token)
+    with STAGE_SECONDS.time(stage='cache_load'):
+        cache = load_cache(namespace, ignore_existing=force_refresh)
+    if force_refresh:
+        logger.info("強制更新: 保存済みのお知らせを無視します")
+    else:
+        print_cache_stats(cache)
+
+    # 現在の日時を取得
+    current_time = datetime.now()
+
+    # 全体の結果を格納するリスト
+    all_results = []
+    # 判定できたお知らせの結果（休講ではないものも含む。休講情報のインデックスの更新に使う）
+    analyzed = []
+
+    response_cache = get_response_cache()
+    response_stats_before = response_cache.stats()
+
+    try:
+        # 1. コース一覧を取得（強制更新時は保存済みのコース一覧を使わない）
+        if courses is None:
+            logger.info("コース一覧を取得中...")
+            with STAGE_SECONDS.time(stage='course_list'):
+                courses = get_courses(canvas_token, use_cache=not force_refresh)
+            if not courses:
+                logger.error("コースの取得に失敗しました。")
+                return None
+
+        logger.info(f"取得したコース数: {len(courses)}")
+
+        # お知らせを全コース分まとめて並行取得（前回確認した投稿日時以降の差分のみ。定期的に全期間を取得し直す）
+        logger.info("お知らせを取得中...")
+        windows = cache.fetch_windows([course.get('id') for course in courses if course.get('id')])
+        full_sync_count = sum(1 for since in windows.values() if since is None)
+        logger.info(f"お知らせの取得範囲: 差分 {len(windows) - full_sync_count}コース / 全期間 {full_sync_count}コース")
+        with STAGE_SECONDS.time(stage='announcement_fetch'):
+            announcements_by_course = get_announcements_for_courses(
+                [course.get('id') for course in courses], canvas_token, since=windows
+            )
+        if Config.CANVAS_RESPONSE_CACHE:
+            log_response_cache_stats(stats_since(response_stats_before, response_cache.stats()))
+
+        # 2. 各コースの新しいお知らせを集める
+        pending = []  # (コースID, コース名, 今回取得したお知らせ, 新しいお知らせ)
+        for i, course in enumerate(courses, 1):
+            course_id = course.get('id')
+            course_name = course.get('name', 'Unknown')
+
+            logger.info(f"[{i}/{len(courses)}] コース: {course_name} (ID: {course_id})")
+
+            if not course_id:
+                logger.warning("  コースIDが取得できませんでした。スキップします。")
+                continue
+
+            # 取得済みのお知らせを参照
+            announcements = announcements_by_course.get(course_id)
+            full_sync = windows.get(course_id) is None
+            if not announcements:
+                logger.debug("  お知らせが見つかりませんでした。")
+                if announcements is not None and full_sync:
+                    # お知らせがないことを確認した時刻を、次回の差分取得の基準として記録しておく
+                    update_cache_with_announcements(course_id, [], cache, full_sync=True)
+                continue
+
+            logger.debug(f"  お知らせ数: {len(announcements)}")
+
+            # 新しいお知らせのみを抽出
+            new_announcements = get_new_announcements(course_id, announcements, cache)
+            if not new_announcements:
+                logger.debug("  新しいお知らせはありません。")
+                # キャッシュは更新しておく
+                update_cache_with_announcements(
+                    course_id, announcements, cache, advance_high_water=True, full_sync=full_sync
+                )
+                continue
+
+            logger.info(f"  新しいお知らせ数: {len(new_announcements)}")
+            pending.append((course_id, course_name, announcements, new_announcements))
+
+        # 3. 新しいお知らせをまとめて休講判定（既定ではスケジューラーで並行実行）
+        #    内容が同じお知らせ（合同授業・複数コースへの同じ投稿）は1件だけ判定し、結果を各コースに配る
+        items = build_analysis_items(pending)
+        with STAGE_SECONDS.time(stage='gpt_analysis'):
+            analysis_results = iter(analyze_deduplicated(items, analyze_items))
+
+        for course_id, course_name, announcements, new_announcements in pending:
+            unseen_ids = set()
+            for ann in new_announcements:
+                ann_title = ann.get('title', '')
+                ann_id = ann.get('id')
+                analysis_result = next(analysis_results)
+
+                # 判定を後回しにしたお知らせ（Batch APIに投入したものなど）はキャッシュに登録しない
+                if analysis_result.get('deferred'):
+                    unseen_ids.add(ann_id)
+                    continue
+
+                # エラーチェック（次回の実行で再分析するため、キャッシュには登録しない）
+                if 'error' in analysis_result:
+                    logger.error(f"  エラー（{course_name}: {ann_title}）: {analysis_result['error']}")
+                    unseen_ids.add(ann_id)
+                    continue
+
+                # 結果に追加情報を付与
+                annotate_result(analysis_result, course_id, course_name, ann, current_time)
+                analyzed.append(analysis_result)
+
+                # 休講の場合のみ結果に追加
+                if analysis_result.get('canceled', False):
+                    all_results.append(analysis_result)
+                    logger.info(f"  ✓ 休講情報を検出（{course_name}）: {analysis_result.get('date')} {analysis_result.get('period')}")
+                else:
+                    logger.debug(f"  - 休講ではありません（{course_name}: {ann_title}）")
+
+            # キャッシュを更新（判定できなかったお知らせがある場合は、次回も取得するよう差分取得の基準を進めない）
+            update_cache_with_announcements(
+                course_id, [ann for ann in announcements if ann.get('id') not in unseen_ids], cache,
+                advance_high_water=not unseen_ids, full_sync=windows.get(course_id) is None and not unseen_ids
+            )
+    finally:
+        # キャッシュと分析結果を保存
+        logger.info("キャッシュを保存中...")
+        analysis_store = get_analysis_store()
+        with STAGE_SECONDS.time(stage='cache_save'):
+            save_cache(cache)
+            analysis_store.flush()
+        stats = analysis_store.stats()
+        logger.info(f"分析結果の再利用: ヒット {stats['hits']}件 / ミス {stats['misses']}件")
+        if Config.CANVAS_RESPONSE_CACHE:
+            response_cache.purge(Config.CANVAS_RESPONSE_CACHE_MAX_AGE)
+
+    result = {
+        'summary': {
+            'total_courses': total_courses if total_courses is not None else len(courses),
+            'total_cancellations': len(all_results),
+            'analyzed_at': current_time.isoformat()
+        },
+        'cancellations': all_results
+    }
+    update_cancellations(namespace, analyzed)
+    save_latest_result(namespace, result)
+    return result
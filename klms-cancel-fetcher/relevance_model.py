@@ -0,0 +1,279 @@
+"""
+休講に関係するお知らせの判定モデル（GPTの前段の絞り込み）
+
+お知らせの大半（課題・成績・教室などの連絡）は休講情報ではありませんが、ルールベース抽出・保存済みの結果で
+判定できないお知らせはすべてGPTに送られます。これまでにGPTで判定した結果（analyses テーブル）から
+文字 n-gram の TF-IDF とロジスティック回帰のモデルを学習し（tools/train_relevance.py）、
+休講情報である確率がしきい値より低いお知らせは、GPTを呼ばずに「休講ではない」と判定します。
+しきい値以上のお知らせ（休講の可能性があるもの・判断がつかないもの）は、これまで通りGPTで判定します。
+
+しきい値は学習時に、検証データの休講のお知らせのうち RELEVANCE_RECALL_TARGET の割合以上を
+GPTに送るように決めます（RELEVANCE_THRESHOLD で上書きできます）。
+モデルファイル（RELEVANCE_MODEL_FILE）がない場合や RELEVANCE_GATE が無効な場合は、すべてのお知らせをGPTで判定します。
+
+外部パッケージは使わず、1回の実行で判定するお知らせをまとめて score_many で採点します。
+"""
+
+import math
+import os
+import random
+import threading
+from collections import Counter as TermCounter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from analysis_store import normalize_text
+from metrics import RELEVANCE_GATE
+from serialization import dumps, loads
+from config import Config, get_logger
+
+logger = get_logger(__name__)
+
+# モデルファイルの形式のバージョン
+MODEL_FORMAT_VERSION = 1
+
+def document_text(title: str, body: str) -> str:
+    """採点に使うテキスト（正規化したタイトルと本文）"""
+    return f"{normalize_text(title)}\n{normalize_text(body)}"
+
+def char_ngrams(text: str, sizes: Sequence[int]) -> TermCounter:
+    """文字 n-gram の出現回数"""
+    counts = TermCounter()
+    for size in sizes:
+        counts.update(text[i:i + size] for i in range(len(text) - size + 1))
+    return counts
+
+class RelevanceModel:
+    """
+    文字 n-gram の TF-IDF（サブリニアTF・L2正規化）とロジスティック回帰による休講らしさのモデル
+
+    features は n-gram ごとの (IDF, 重み) です。
+    """
+
+    def __init__(self, ngram_sizes: Sequence[int], features: Dict[str, Tuple[float, float]], bias: float,
+                 threshold: float, metadata: Optional[Dict] = None):
+        self.ngram_sizes = tuple(ngram_sizes)
+        self.features = features
+        self.bias = bias
+        self.threshold = threshold
+        self.metadata = metadata or {}
+
+    def score_many(self, texts: Iterable[str]) -> List[float]:
+        """document_text のリストを採点し、休講情報である確率のリストを返す"""
+        features = self.features
+        sizes = self.ngram_sizes
+        scores = []
+        for text in texts:
+            norm = 0.0
+            dot = 0.0
+            for ngram, count in char_ngrams(text, sizes).items():
+                feature = features.get(ngram)
+                if feature is None:
+                    continue
+                value = (1.0 + math.log(count)) * feature[0]
+                norm += value * value
+                dot += value * feature[1]
+            z = self.bias + (dot / math.sqrt(norm) if norm else 0.0)
+            scores.append(_sigmoid(z))
+        return scores
+
+    def to_dict(self) -> Dict:
+        return {
+            'format_version': MODEL_FORMAT_VERSION,
+            'ngram_sizes': list(self.ngram_sizes),
+            'bias': self.bias,
+            'threshold': self.threshold,
+            'metadata': self.metadata,
+            'features': {ngram: [idf, weight] for ngram, (idf, weight) in self.features.items()}
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'RelevanceModel':
+        if data.get('format_version') != MODEL_FORMAT_VERSION:
+            raise ValueError(f"モデルファイルの形式が違います: {data.get('format_version')}")
+        return cls(
+            data['ngram_sizes'],
+            {ngram: (idf, weight) for ngram, (idf, weight) in data['features'].items()},
+            data['bias'], data['threshold'], data.get('metadata')
+        )
+
+def _sigmoid(z: float) -> float:
+    if z >= 0:
+        return 1.0 / (1.0 + math.exp(-z))
+    e = math.exp(z)
+    return e / (1.0 + e)
+
+def save_model(model: RelevanceModel, path: Optional[str] = None):
+    """モデルをファイルに保存する（一時ファイルに書いてから置き換える）"""
+    path = path or Config.RELEVANCE_MODEL_FILE
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(dumps(model.to_dict()))
+    os.replace(tmp_path, path)
+
+def load_model(path: Optional[str] = None) -> RelevanceModel:
+    """モデルをファイルから読み込む"""
+    with open(path or Config.RELEVANCE_MODEL_FILE, 'rb') as f:
+        return RelevanceModel.from_dict(loads(f.read()))
+
+# ---- 学習 ----
+
+def build_features(documents: List[TermCounter], min_df: int, max_features: int) -> Dict[str, float]:
+    """文書頻度が min_df 以上の n-gram を最大 max_features 個選び、n-gram ごとの IDF を返す"""
+    df = TermCounter()
+    for counts in documents:
+        df.update(counts.keys())
+    selected = sorted((ngram for ngram, count in df.items() if count >= min_df), key=lambda ngram: (-df[ngram], ngram))
+    total = len(documents)
+    return {ngram: math.log((1 + total) / (1 + df[ngram])) + 1.0 for ngram in selected[:max_features]}
+
+def vectorize(counts: TermCounter, idf: Dict[str, float]) -> List[Tuple[str, float]]:
+    """TF-IDF ベクトル（L2正規化した (n-gram, 値) のリスト）"""
+    vector = [(ngram, (1.0 + math.log(count)) * idf[ngram]) for ngram, count in counts.items() if ngram in idf]
+    norm = math.sqrt(sum(value * value for _, value in vector))
+    return [(ngram, value / norm) for ngram, value in vector] if norm else []
+
+def fit_logistic(vectors: List[List[Tuple[str, float]]], labels: List[bool], epochs: int,
+                 learning_rate: float, l2: float, seed: int = 0) -> Tuple[Dict[str, float], float]:
+    """
+    L2正則化付きロジスティック回帰を確率的勾配降下法（AdaGrad）で学習する
+
+    休講のお知らせは少ないため、正例・負例の重みを件数の逆数に比例させます。
+
+    Returns:
+        (n-gram ごとの重み, バイアス)
+    """
+    positives = sum(1 for label in labels if label)
+    negatives = len(labels) - positives
+    class_weight = {
+        True: len(labels) / (2 * positives) if positives else 1.0,
+        False: len(labels) / (2 * negatives) if negatives else 1.0
+    }
+    weights: Dict[str, float] = {}
+    squared: Dict[str, float] = {}
+    bias = 0.0
+    bias_squared = 0.0
+    order = list(range(len(vectors)))
+    rng = random.Random(seed)
+    for _ in range(epochs):
+        rng.shuffle(order)
+        for index in order:
+            vector = vectors[index]
+            label = labels[index]
+            z = bias + sum(weights.get(ngram, 0.0) * value for ngram, value in vector)
+            error = (_sigmoid(z) - (1.0 if label else 0.0)) * class_weight[label]
+            for ngram, value in vector:
+                weight = weights.get(ngram, 0.0)
+                gradient = error * value + l2 * weight
+                squared[ngram] = squared.get(ngram, 0.0) + gradient * gradient
+                weights[ngram] = weight - learning_rate * gradient / math.sqrt(squared[ngram])
+            bias_squared += error * error
+            bias -= learning_rate * error / math.sqrt(bias_squared)
+    return weights, bias
+
+def train_model(texts: List[str], labels: List[bool], ngram_sizes: Sequence[int] = (2, 3), min_df: int = 2,
+                max_features: int = 50000, epochs: int = 10, learning_rate: float = 0.5,
+                l2: float = 1e-4) -> RelevanceModel:
+    """document_text のリストと休講かどうかのラベルからモデルを学習する（しきい値は 0.5 のまま）"""
+    documents = [char_ngrams(text, ngram_sizes) for text in texts]
+    idf = build_features(documents, min_df, max_features)
+    vectors = [vectorize(counts, idf) for counts in documents]
+    weights, bias = fit_logistic(vectors, labels, epochs, learning_rate, l2)
+    features = {ngram: (value, weights.get(ngram, 0.0)) for ngram, value in idf.items()}
+    return RelevanceModel(ngram_sizes, features, bias, 0.5)
+
+def threshold_for_recall(positive_scores: List[float], recall_target: float) -> float:
+    """休講のお知らせのうち recall_target の割合以上がしきい値以上になる、最も大きいしきい値"""
+    if not positive_scores:
+        return 0.0
+    ordered = sorted(positive_scores)
+    allowed_misses = int(math.floor((1.0 - recall_target) * len(ordered) + 1e-9))
+    return ordered[min(allowed_misses, len(ordered) - 1)]
+
+# ---- 判定時の絞り込み ----
+
+_model: Optional[RelevanceModel] = None
+_model_mtime: Optional[float] = None
+_model_lock = threading.Lock()
+
+def get_relevance_model() -> Optional[RelevanceModel]:
+    """
+    共有のモデルを返す（モデルファイルがない場合は None）
+
+    モデルファイルが更新されていれば読み込み直すため、APIサーバーを再起動せずに学習し直したモデルを使えます。
+    """
+    global _model, _model_mtime
+    try:
+        mtime = os.path.getmtime(Config.RELEVANCE_MODEL_FILE)
+    except OSError:
+        return None
+    if mtime != _model_mtime:
+        with _model_lock:
+            if mtime != _model_mtime:
+                try:
+                    _model = load_model()
+                    logger.info(f"関連度モデルを読み込みました: {Config.RELEVANCE_MODEL_FILE}（しきい値 {_model.threshold:.4f}）")
+                except (OSError, ValueError, KeyError) as e:
+                    logger.error(f"関連度モデルの読み込みエラー: {e}")
+                    _model = None
+                _model_mtime = mtime
+    return _model
+
+def current_threshold(model: RelevanceModel) -> float:
+    return Config.RELEVANCE_THRESHOLD if Config.RELEVANCE_THRESHOLD is not None else model.threshold
+
+def screen(items: List[Dict]) -> List[Optional[Dict]]:
+    """
+    GPTで判定する前のお知らせをまとめて採点し、休講ではないと判定できたものの結果を返す
+
+    Args:
+        items: title, body, course_name をキーに持つ辞書のリスト（ルールベース抽出・保存済みの結果で
+            判定できなかったもの）
+
+    Returns:
+        入力と同じ順序のリスト。しきい値より低いお知らせは休講ではない判定結果、それ以外は None
+        （GPTで判定する）
+    """
+    if not items or not Config.RELEVANCE_GATE:
+        return [None] * len(items)
+    model = get_relevance_model()
+    if model is None:
+        return [None] * len(items)
+
+    threshold = current_threshold(model)
+    scores = model.score_many(document_text(item['title'], item['body']) for item in items)
+    results: List[Optional[Dict]] = []
+    for item, score in zip(items, scores):
+        if score >= threshold:
+            results.append(None)
+            continue
+        results.append({
+            "course": item.get('course_name'),
+            "date": None,
+            "period": None,
+            "canceled": False,
+            "source": "KLMS",
+            "message": None,
+            "relevance_score": round(score, 4)
+        })
+    skipped = sum(1 for result in results if result is not None)
+    RELEVANCE_GATE.inc(skipped, result='skipped')
+    RELEVANCE_GATE.inc(len(items) - skipped, result='passed')
+    if skipped:
+        logger.info(f"関連度モデル: {len(items)}件中 {skipped}件を休講ではないと判定しました（しきい値 {threshold:.4f}）")
+    return results
+
+def stats() -> Dict:
+    """関連度モデルの情報と、GPTを呼ばずに判定した件数の累計"""
+    skipped = int(RELEVANCE_GATE.value(result='skipped'))
+    passed = int(RELEVANCE_GATE.value(result='passed'))
+    model = get_relevance_model() if Config.RELEVANCE_GATE else None
+    return {
+        'enabled': model is not None,
+        'threshold': current_threshold(model) if model is not None else None,
+        'trained_at': model.metadata.get('trained_at') if model is not None else None,
+        'recall_target': model.metadata.get('recall_target') if model is not None else None,
+        'validation': model.metadata.get('validation') if model is not None else None,
+        'skipped': skipped,
+        'passed': passed
+    }
@@ -0,0 +1,58 @@
+"""
+ユーザーごとの最新の結果の保存モジュール
+
+run_pipeline の結果（summary と cancellations）を名前空間（Canvasトークンのハッシュ値）ごとに
+データベースの latest_results テーブルに保存し、/api/kyukou/latest で返せるようにします。
+同じプロセス内で結果を保存したときは、登録されたリスナー（latest_index など）にすぐ通知します。
+"""
+
+import threading
+from typing import Callable, Dict, List, Optional
+
+from database import get_connection, transaction
+from serialization import dumps_str, loads
+from config import get_logger
+
+logger = get_logger(__name__)
+
+_listeners: List[Callable[[str, Dict], None]] = []
+_listeners_lock = threading.Lock()
+
+def add_listener(callback: Callable[[str, Dict], None]):
+    """最新の結果が保存されたときに callback(名前空間, 結果) を呼ぶよう登録する"""
+    with _listeners_lock:
+        _listeners.append(callback)
+
+def save_latest_result(namespace: str, result: Dict):
+    """名前空間の最新の結果を保存する"""
+    try:
+        with transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO latest_results (namespace, result, analyzed_at) VALUES (?, ?, ?)",
+                (namespace, dumps_str(result), result.get('summary', {}).get('analyzed_at'))
+            )
+    except Exception as e:
+        logger.error(f"最新の結果の保存エラー: {e}")
+        return
+
+    with _listeners_lock:
+        listeners = list(_listeners)
+    for callback in listeners:
+        try:
+            callback(namespace, result)
+        except Exception as e:
+            logger.error(f"最新の結果の通知エラー: {e}")
+
+def get_latest_result(namespace: str) -> Optional[Dict]:
+    """名前空間の最新の結果を返す（まだ結果がない場合は None）"""
+    row = get_connection().execute(
+        "SELECT result FROM latest_results WHERE namespace = ?", (namespace,)
+    ).fetchone()
+    return loads(row['result']) if row is not None else None
+
+def get_latest_analyzed_at(namespace: str) -> Optional[str]:
+    """名前空間の最新の結果の分析時刻だけを返す（結果を読み込まずに更新の有無を確認するため）"""
+    row = get_connection().execute(
+        "SELECT analyzed_at FROM latest_results WHERE namespace = ?", (namespace,)
+    ).fetchone()
+    return row['analyzed_at'] if row is not None else None
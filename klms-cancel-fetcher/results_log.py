@@ -0,0 +1,264 @@
+"""
+追記型の結果ログ
+
+main.py の実行結果（summary と cancellations）を、1回の実行につき1行のNDJSON（results/klms_results.ndjson）に追記します。
+あわせて、各行の分析時刻・開始位置・長さを固定長レコードで記録したインデックス（results/klms_results.idx）を書くため、
+最新の結果や指定した期間の結果を、ログ全体やディレクトリを走査せずに読み出せます。
+
+古い結果は compact() （python3 -m tools.compact_results）で保持期間を過ぎたものを削除し、
+前日以前の結果を1日1件にまとめます（休講情報は (course_id, announcement_id) ごとに最新のものだけを残す）。
+"""
+
+import bisect
+import glob
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from itertools import groupby
+from typing import Dict, List, Optional, Tuple
+
+from serialization import dumps, loads
+from config import Config, get_logger
+
+logger = get_logger(__name__)
+
+# fcntl がない環境（Windows）では、プロセス間のロックは行わない
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# インデックスの1レコード: 分析時刻（UNIX時刻）, ログ内の開始位置, 行の長さ（改行を含む）
+INDEX_RECORD = struct.Struct("<dQI")
+
+# 以前のバージョンが1回の実行ごとに書いていた結果ファイル
+LEGACY_FILE_PATTERN = "klms_results_*.json"
+
+def snapshot_timestamp(result: Dict) -> float:
+    """結果の分析時刻を UNIX 時刻で返す（分析時刻がない場合は 0）"""
+    analyzed_at = result.get('summary', {}).get('analyzed_at')
+    try:
+        return datetime.fromisoformat(analyzed_at).timestamp() if analyzed_at else 0.0
+    except ValueError:
+        return 0.0
+
+def cancellation_key(cancellation: Dict) -> Tuple:
+    """休講情報の重複判定に使うキー（お知らせIDがない場合は日付・時限で代用する）"""
+    if cancellation.get('announcement_id') is not None:
+        return (str(cancellation.get('course_id')), str(cancellation.get('announcement_id')))
+    return (str(cancellation.get('course_id')), None, cancellation.get('date'), cancellation.get('period'))
+
+def merge_snapshots(snapshots: List[Dict]) -> Dict:
+    """
+    複数の結果を1件にまとめる
+
+    休講情報は (course_id, announcement_id) ごとに、後の結果のものを残します。
+    """
+    merged = {}
+    for snapshot in snapshots:
+        for cancellation in snapshot.get('cancellations', []):
+            merged[cancellation_key(cancellation)] = cancellation
+    cancellations = list(merged.values())
+    last_summary = snapshots[-1].get('summary', {})
+    return {
+        'summary': dict(
+            last_summary,
+            total_courses=max(snapshot.get('summary', {}).get('total_courses', 0) for snapshot in snapshots),
+            total_cancellations=len(cancellations),
+            merged_snapshots=sum(snapshot.get('summary', {}).get('merged_snapshots', 1) for snapshot in snapshots)
+        ),
+        'cancellations': cancellations
+    }
+
+class ResultsLog:
+    """
+    NDJSON形式の追記型結果ログとそのインデックス
+
+    Args:
+        log_path: ログファイルのパス
+        index_path: インデックスファイルのパス
+    """
+
+    def __init__(self, log_path: str, index_path: str):
+        self.log_path = log_path
+        self.index_path = index_path
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self, exclusive: bool):
+        """プロセス内・プロセス間のロックを取得する（書き込みは排他、読み込みは共有）"""
+        os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(f"{self.log_path}.lock", 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def append(self, result: Dict):
+        """結果を1行追記し、インデックスにレコードを追加する"""
+        line = dumps(result) + b"\n"
+        with self._locked(exclusive=True):
+            self._repair_index()
+            with open(self.log_path, 'ab') as log_file:
+                offset = log_file.seek(0, os.SEEK_END)
+                log_file.write(line)
+            with open(self.index_path, 'ab') as index_file:
+                index_file.write(INDEX_RECORD.pack(snapshot_timestamp(result), offset, len(line)))
+
+    def latest(self) -> Optional[Dict]:
+        """最新の結果を返す（まだ結果がない場合は None）"""
+        with self._locked(exclusive=False):
+            if not os.path.exists(self.index_path):
+                return None
+            with open(self.index_path, 'rb') as index_file:
+                size = index_file.seek(0, os.SEEK_END)
+                if size < INDEX_RECORD.size:
+                    return None
+                index_file.seek(size - size % INDEX_RECORD.size - INDEX_RECORD.size)
+                _, offset, length = INDEX_RECORD.unpack(index_file.read(INDEX_RECORD.size))
+            return self._read_records([(offset, length)])[0]
+
+    def between(self, start: Optional[datetime] = None, end: Optional[datetime] = None) -> List[Dict]:
+        """分析時刻が start 以上 end 未満の結果を古い順に返す（インデックスを二分探索する）"""
+        with self._locked(exclusive=False):
+            records = self._read_index()
+            timestamps = [timestamp for timestamp, _, _ in records]
+            low = bisect.bisect_left(timestamps, start.timestamp()) if start else 0
+            high = bisect.bisect_left(timestamps, end.timestamp()) if end else len(records)
+            return self._read_records([(offset, length) for _, offset, length in records[low:high]])
+
+    def version(self) -> Optional[Tuple[int, int]]:
+        """ログが更新されたかどうかを判定するための値（インデックスのサイズと更新時刻）"""
+        try:
+            stat = os.stat(self.index_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def compact(self, retention_days: int, legacy_files: Optional[List[str]] = None,
+                now: Optional[datetime] = None) -> Dict:
+        """
+        ログを書き直して小さくする
+
+        1. legacy_files（以前のバージョンの結果ファイル）があれば取り込む
+        2. 保持期間（retention_days 日）より古い結果を削除する
+        3. 前日以前の結果を1日1件にまとめる（当日の結果はそのまま残す）
+
+        Returns:
+            書き直す前後の件数などの統計情報
+        """
+        now = now or datetime.now()
+        cutoff = (now - timedelta(days=retention_days)).timestamp()
+        today = now.date()
+
+        with self._locked(exclusive=True):
+            self._repair_index()
+            snapshots = self._read_records([(offset, length) for _, offset, length in self._read_index()])
+            before = len(snapshots)
+            for path in legacy_files or []:
+                try:
+                    with open(path, 'rb') as f:
+                        snapshots.append(loads(f.read()))
+                except (ValueError, IOError) as e:
+                    logger.error(f"結果ファイルの読み込みエラー（{path}）: {e}")
+
+            snapshots.sort(key=snapshot_timestamp)
+            kept = [snapshot for snapshot in snapshots if snapshot_timestamp(snapshot) >= cutoff]
+            cancellations_before = sum(len(snapshot.get('cancellations', [])) for snapshot in kept)
+
+            compacted = []
+            for day, group in groupby(kept, key=lambda snapshot: datetime.fromtimestamp(snapshot_timestamp(snapshot)).date()):
+                group = list(group)
+                if day < today and len(group) > 1:
+                    compacted.append(merge_snapshots(group))
+                else:
+                    compacted.extend(group)
+            cancellations_after = sum(len(snapshot.get('cancellations', [])) for snapshot in compacted)
+
+            self._rewrite(compacted)
+
+        return {
+            'snapshots_before': before,
+            'legacy_files': len(legacy_files or []),
+            'expired': len(snapshots) - len(kept),
+            'snapshots_after': len(compacted),
+            'duplicate_cancellations_removed': cancellations_before - cancellations_after
+        }
+
+    def _read_index(self) -> List[Tuple[float, int, int]]:
+        if not os.path.exists(self.index_path):
+            return []
+        with open(self.index_path, 'rb') as index_file:
+            data = index_file.read()
+        usable = len(data) - len(data) % INDEX_RECORD.size
+        return list(INDEX_RECORD.iter_unpack(data[:usable]))
+
+    def _read_records(self, positions: List[Tuple[int, int]]) -> List[Dict]:
+        if not positions:
+            return []
+        results = []
+        with open(self.log_path, 'rb') as log_file:
+            for offset, length in positions:
+                log_file.seek(offset)
+                results.append(loads(log_file.read(length)))
+        return results
+
+    def _repair_index(self):
+        """
+        インデックスがログと食い違っている場合（追記の途中で中断した場合など）はログから作り直す（排他ロック取得済みで呼ぶ）
+        """
+        log_size = os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0
+        records = self._read_index()
+        indexed_size = records[-1][1] + records[-1][2] if records else 0
+        index_size = os.path.getsize(self.index_path) if os.path.exists(self.index_path) else 0
+        if indexed_size == log_size and index_size == len(records) * INDEX_RECORD.size:
+            return
+
+        logger.warning("結果ログのインデックスを作り直します。")
+        snapshots = []
+        if log_size:
+            with open(self.log_path, 'rb') as log_file:
+                for line in log_file:
+                    try:
+                        snapshots.append(loads(line))
+                    except ValueError:
+                        # 書き込み途中の行は捨てる
+                        logger.warning("結果ログの壊れた行を読み飛ばしました。")
+        self._rewrite(snapshots)
+
+    def _rewrite(self, snapshots: List[Dict]):
+        """ログとインデックスを一時ファイルに書き、置き換える（排他ロック取得済みで呼ぶ）"""
+        log_tmp = f"{self.log_path}.tmp"
+        index_tmp = f"{self.index_path}.tmp"
+        offset = 0
+        with open(log_tmp, 'wb') as log_file, open(index_tmp, 'wb') as index_file:
+            for snapshot in snapshots:
+                line = dumps(snapshot) + b"\n"
+                log_file.write(line)
+                index_file.write(INDEX_RECORD.pack(snapshot_timestamp(snapshot), offset, len(line)))
+                offset += len(line)
+        os.replace(log_tmp, self.log_path)
+        os.replace(index_tmp, self.index_path)
+
+def legacy_result_files(results_dir: str) -> List[str]:
+    """以前のバージョンの結果ファイル（results/klms_results_<日時>.json）の一覧"""
+    return sorted(glob.glob(os.path.join(results_dir, LEGACY_FILE_PATTERN)))
+
+_results_log = None
+_results_log_lock = threading.Lock()
+
+def get_results_log() -> ResultsLog:
+    """共有の ResultsLog を取得する"""
+    global _results_log
+    if _results_log is None:
+        with _results_log_lock:
+            if _results_log is None:
+                _results_log = ResultsLog(Config.RESULTS_LOG_FILE, Config.RESULTS_INDEX_FILE)
+    return _results_log
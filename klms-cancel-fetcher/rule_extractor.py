@@ -0,0 +1,171 @@
+"""
+ルールベースの休講情報抽出モジュール
+
+「6/17(火) 3限 休講」のように日付・時限・休講キーワードがはっきり書かれたお知らせは、
+GPTを呼ばずに正規表現で直接抽出します。少しでも曖昧な場合は None を返し、GPTに判定を任せます。
+"""
+
+import re
+import unicodedata
+from datetime import date, datetime
+from typing import List, Optional, Set, Tuple
+
+from config import get_logger
+from text_preprocessor import html_to_text
+
+logger = get_logger(__name__)
+
+# 休講を表すキーワード
+CANCEL_PATTERN = re.compile(r"休講|休校|授業(?:を|は)?中止|中止(?:と|に)(?:します|いたします|なります)")
+
+# これらを含むお知らせは判定が難しいため GPT に任せる
+# （休講の取り消し・否定、条件付きの休講、振替やオンライン実施への変更など）
+AMBIGUOUS_PATTERN = re.compile(
+    r"取り?消|撤回|ではありません|ありません|しません|行います|実施します|通常通り|通常どおり|"
+    r"場合|可能性|予定|未定|検討|振替|振り替え|変更|延期|オンライン|遠隔|zoom|Zoom|ZOOM|[?？]"
+)
+
+WEEKDAYS = "月火水木金土日"
+# 年が書かれていない日付は、基準日からこの日数以内にあるものとして年を推定する
+MAX_YEAR_INFERENCE_DAYS = 200
+KANJI_DIGITS = {"一": 1, "二": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7}
+
+# 日付の表記（NFKC正規化後のテキストに適用する）
+DATE_PATTERNS = [
+    # 2025年6月17日 / 2025/6/17 / 2025-06-17
+    re.compile(r"(?P<year>20\d{2})\s*(?:年|/|-)\s*(?P<month>\d{1,2})\s*(?:月|/|-)\s*(?P<day>\d{1,2})\s*日?"),
+    # 6月17日
+    re.compile(r"(?<![\d/])(?P<month>\d{1,2})\s*月\s*(?P<day>\d{1,2})\s*日"),
+    # 6/17
+    re.compile(r"(?<![\d/])(?P<month>\d{1,2})/(?P<day>\d{1,2})(?![\d/])"),
+]
+WEEKDAY_SUFFIX = re.compile(r"^\s*\(\s*(?P<weekday>[月火水木金土日])(?:曜日?)?\s*\)|^\s*(?P<weekday2>[月火水木金土日])曜日?")
+
+# 時限の表記: 3限 / 第3限 / 3時限 / 三限
+PERIOD_PATTERN = re.compile(r"第?\s*(?P<period>[1-7一二三四五六七])\s*(?:時限|限)")
+
+def _to_text(body: Optional[str]) -> str:
+    """HTMLタグを取り除き、プレーンテキストにする"""
+    return html_to_text(body)
+
+def _resolve_year(month: int, day: int, weekday: Optional[int], reference: date) -> Optional[date]:
+    """
+    年の書かれていない日付の年を推定する
+
+    基準日の前後半年以内で最も近い年を採用します。曜日が書かれている場合は曜日が一致する年に限定し、
+    該当する年がなければ None を返します。
+    """
+    candidates = []
+    for year in (reference.year - 1, reference.year, reference.year + 1):
+        try:
+            candidate = date(year, month, day)
+        except ValueError:
+            continue
+        if abs((candidate - reference).days) > MAX_YEAR_INFERENCE_DAYS:
+            continue
+        if weekday is not None and candidate.weekday() != weekday:
+            continue
+        candidates.append(candidate)
+    if not candidates:
+        return None
+    return min(candidates, key=lambda candidate: abs((candidate - reference).days))
+
+def find_dates(text: str, reference: date) -> Optional[Set[date]]:
+    """
+    テキスト中の日付をすべて抽出する
+
+    日付として解釈できない表記（存在しない日付・曜日の不一致）があった場合は None を返します。
+    """
+    found = set()
+    consumed: List[Tuple[int, int]] = []
+    for pattern in DATE_PATTERNS:
+        for match in pattern.finditer(text):
+            # より具体的なパターンで抽出済みの範囲は読み飛ばす
+            if any(start <= match.start() < end for start, end in consumed):
+                continue
+            consumed.append(match.span())
+
+            suffix = WEEKDAY_SUFFIX.match(text[match.end():])
+            weekday = None
+            if suffix:
+                weekday = WEEKDAYS.index(suffix.group("weekday") or suffix.group("weekday2"))
+
+            month, day = int(match.group("month")), int(match.group("day"))
+            if match.groupdict().get("year"):
+                try:
+                    resolved = date(int(match.group("year")), month, day)
+                except ValueError:
+                    return None
+                if weekday is not None and resolved.weekday() != weekday:
+                    return None
+            else:
+                resolved = _resolve_year(month, day, weekday, reference)
+                if resolved is None:
+                    return None
+            found.add(resolved)
+    return found
+
+def find_periods(text: str) -> Set[int]:
+    """テキスト中の時限をすべて抽出する"""
+    periods = set()
+    for match in PERIOD_PATTERN.finditer(text):
+        value = match.group("period")
+        periods.add(KANJI_DIGITS.get(value) or int(value))
+    return periods
+
+def _summary_sentence(text: str) -> str:
+    """休講キーワードを含む最初の文をメッセージとして返す"""
+    for sentence in re.split(r"(?<=[。！!\n])", text):
+        if CANCEL_PATTERN.search(sentence):
+            return " ".join(sentence.split())[:100]
+    return " ".join(text.split())[:100]
+
+def extract_cancellation(title: str, body: str, course_name: Optional[str] = None,
+                         reference_date: Optional[date] = None) -> Optional[dict]:
+    """
+    休講情報をルールベースで抽出する
+
+    休講キーワードがあり、日付と時限がそれぞれ1つに定まり、曖昧な表現を含まない場合のみ
+    analyze_announcement と同じ形式の辞書を返します。それ以外は None を返します。
+
+    Args:
+        title: お知らせのタイトル
+        body: お知らせの本文（HTML可）
+        course_name: 授業名（結果の course に使用）
+        reference_date: 年を推定するときの基準日（通常はお知らせの投稿日。Noneの場合は今日）
+    """
+    title_text = unicodedata.normalize("NFKC", title or "")
+    body_text = unicodedata.normalize("NFKC", _to_text(body))
+    text = f"{title_text}\n{body_text}"
+
+    if not CANCEL_PATTERN.search(text):
+        return None
+    if AMBIGUOUS_PATTERN.search(text):
+        return None
+
+    reference = reference_date or datetime.now().date()
+    dates = find_dates(text, reference)
+    if not dates or len(dates) != 1:
+        return None
+    periods = find_periods(text)
+    if len(periods) != 1:
+        return None
+
+    return {
+        "course": course_name,
+        "date": dates.pop().isoformat(),
+        "period": f"{periods.pop()}限",
+        "canceled": True,
+        "source": "KLMS",
+        "message": _summary_sentence(body_text or title_text)
+    }
+
+if __name__ == "__main__":
+    logger.info("ルールベース抽出のテストを開始します...")
+    result = extract_cancellation(
+        "【重要】〇〇ゼミ 6/17(火) 3限 休講のお知らせ",
+        "教員の急病のため、6月17日（火）3限の〇〇ゼミは休講といたします。補講については別途お知らせします。",
+        course_name="〇〇ゼミ",
+        reference_date=date(2025, 6, 10)
+    )
+    logger.info(f"抽出結果: {result}")
@@ -0,0 +1,99 @@
+"""
+JSONのシリアライズ
+
+キャッシュ・分析結果・結果ログ・APIの応答のJSONの読み書きをこのモジュールにまとめ、
+orjson がインストールされていれば orjson を、なければ標準の json を使います（JSON_BACKEND で固定もできる）。
+どちらを使っても出力は空白なしのUTF-8（日本語はエスケープしない）で、読み込み側はどちらの出力も読めます。
+
+デコードに失敗した場合は、どちらのバックエンドでも json.JSONDecodeError（ValueError のサブクラス）が発生します。
+
+保存する本文の圧縮（compress_blob・decompress_blob）もここにまとめます。COMPACT_STORAGE が有効な場合、
+Canvas APIの応答キャッシュなど大きな本文を zlib で圧縮してデータベースに保存します。
+"""
+
+import json
+import threading
+import zlib
+from typing import Any, Union
+
+from config import Config, get_logger
+
+logger = get_logger(__name__)
+
+class _StdlibBackend:
+    """標準の json モジュール"""
+
+    name = "json"
+
+    @staticmethod
+    def dumps(obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    @staticmethod
+    def loads(data: Union[bytes, str]) -> Any:
+        return json.loads(data)
+
+class _OrjsonBackend:
+    """orjson（標準の json より数倍速い。dict のキーが文字列でない場合も標準の json と同じく文字列にする）"""
+
+    name = "orjson"
+
+    def __init__(self, orjson):
+        self._dumps = orjson.dumps
+        self._option = orjson.OPT_NON_STR_KEYS
+        self.loads = orjson.loads
+
+    def dumps(self, obj: Any) -> bytes:
+        return self._dumps(obj, option=self._option)
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_backend():
+    """使用するバックエンドを返す（初回呼び出し時に JSON_BACKEND に従って決める）"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = _select_backend(Config.JSON_BACKEND)
+    return _backend
+
+def _select_backend(name: str):
+    if name == "json":
+        return _StdlibBackend()
+    try:
+        import orjson
+    except ImportError:
+        if name == "orjson":
+            logger.warning("orjson がインストールされていないため、標準の json を使います。")
+        return _StdlibBackend()
+    return _OrjsonBackend(orjson)
+
+def dumps(obj: Any) -> bytes:
+    """JSONのバイト列（UTF-8・空白なし）にする"""
+    return get_backend().dumps(obj)
+
+def dumps_str(obj: Any) -> str:
+    """JSONの文字列にする（データベースのTEXT列に保存する場合など）"""
+    return get_backend().dumps(obj).decode('utf-8')
+
+def loads(data: Union[bytes, str]) -> Any:
+    """JSONのバイト列・文字列を読み込む"""
+    return get_backend().loads(data)
+
+def compress_blob(data: bytes) -> Union[bytes, str]:
+    """
+    保存する本文を圧縮する（COMPACT_STORAGE が無効な場合は文字列のまま返す）
+
+    圧縮した本文は bytes（データベースではBLOB）、圧縮していない本文は str（TEXT）として保存するため、
+    decompress_blob はどちらも読めます。
+    """
+    if Config.COMPACT_STORAGE:
+        return zlib.compress(data, Config.COMPACT_STORAGE_LEVEL)
+    return data.decode('utf-8')
+
+def decompress_blob(value: Union[bytes, str]) -> bytes:
+    """compress_blob で保存した本文を元のバイト列に戻す"""
+    if isinstance(value, bytes):
+        return zlib.decompress(value)
+    return value.encode('utf-8')
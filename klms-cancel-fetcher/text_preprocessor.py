@@ -0,0 +1,216 @@
+"""
+お知らせ本文の前処理モジュール
+
+Canvasのお知らせ本文（HTML）をプロンプトに入れる前に、
+HTMLをテキストに変換し、空白をまとめ、引用・署名などの定型部分を取り除き、
+休講に関係するキーワードの周辺だけをトークン数の上限内に収まるよう切り出します。
+"""
+
+import re
+import threading
+import unicodedata
+from html.parser import HTMLParser
+from typing import Dict, List, Optional, Tuple
+
+from metrics import PREPROCESS_DOCUMENTS, PREPROCESS_TOKENS
+from config import Config, get_logger
+
+logger = get_logger(__name__)
+
+# tiktoken がインストールされていれば正確なトークン数を使う（なければ文字数から概算する）
+# 読み込みに時間がかかるため、初めてトークン数を数えるときに読み込む
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+def _get_encoding():
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        with _encoding_lock:
+            if not _encoding_loaded:
+                try:
+                    import tiktoken
+                    _encoding = tiktoken.get_encoding("o200k_base")
+                except Exception:
+                    _encoding = None
+                _encoding_loaded = True
+    return _encoding
+
+# 改行として扱うHTMLタグ
+BLOCK_TAGS = {
+    "p", "div", "br", "li", "ul", "ol", "tr", "table", "h1", "h2", "h3", "h4", "h5", "h6",
+    "blockquote", "section", "article", "header", "footer", "hr", "pre"
+}
+# 中身ごと捨てるHTMLタグ
+SKIP_TAGS = {"script", "style", "head", "title", "iframe", "object", "svg"}
+
+# これ以降は署名・転送元などの定型部分とみなして切り捨てる行
+FOOTER_PATTERN = re.compile(
+    r"^(?:--\s*|[-─━=＝_＿*＊~〜]{4,}.*|-+\s*Original Message\s*-+|From:.*|Sent from.*|"
+    r"※このメールは.*|※本メールは.*|このメッセージは.*自動.*送信.*)$",
+    re.IGNORECASE
+)
+# 引用行（メールの返信など）
+QUOTE_PATTERN = re.compile(r"^\s*[>＞]")
+
+# 休講の判定に関係するキーワード（この周辺を優先して残す）
+KEYWORD_PATTERN = re.compile(r"休講|休校|中止|休み|延期|変更|振替|振り替え|補講|オンライン|\d+\s*限")
+
+class _TextExtractor(HTMLParser):
+    """HTMLから表示テキストだけを取り出すパーサー"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts: List[str] = []
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self._skip_depth += 1
+        elif tag in BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag in BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self.parts.append(data)
+
+def html_to_text(html: Optional[str]) -> str:
+    """HTMLをプレーンテキストに変換する（画像・スタイル・スクリプトは除去）"""
+    if not html:
+        return ""
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    return "".join(parser.parts)
+
+def collapse_whitespace(text: str) -> str:
+    """行ごとに連続する空白をまとめ、空行を取り除く"""
+    text = unicodedata.normalize("NFKC", text)
+    lines = (" ".join(line.split()) for line in text.splitlines())
+    return "\n".join(line for line in lines if line)
+
+def strip_boilerplate(text: str) -> str:
+    """
+    引用行を除き、署名の区切り線などの定型部分以降を切り捨てる
+
+    区切り線・転送元などの行より後に休講に関わるキーワードがある場合は、本文中の飾りの区切り線とみなし、
+    その行だけを除いて続きを残します（休講の記述を切り捨てないため）。
+    """
+    lines = [line for line in text.splitlines() if not QUOTE_PATTERN.match(line)]
+    last_keyword_line = max((i for i, line in enumerate(lines) if KEYWORD_PATTERN.search(line)), default=-1)
+    kept = []
+    for index, line in enumerate(lines):
+        if FOOTER_PATTERN.match(line) and kept:
+            if index > last_keyword_line:
+                break
+            continue
+        kept.append(line)
+    return "\n".join(kept)
+
+def estimate_tokens(text: str) -> int:
+    """
+    テキストのトークン数を返す
+
+    tiktoken がない場合は、日本語などの全角文字を1文字1トークン、それ以外を4文字1トークンとして概算します。
+    """
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    wide = sum(1 for char in text if ord(char) > 0x2FF)
+    return wide + (len(text) - wide + 3) // 4
+
+def _truncate_to_budget(text: str, token_budget: int) -> str:
+    """トークン数が上限に収まるよう末尾を切り詰める"""
+    if estimate_tokens(text) <= token_budget:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[:middle]) <= token_budget:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low]
+
+def keyword_window(text: str, token_budget: int, window_chars: int) -> str:
+    """
+    トークン数が上限を超える場合、キーワード周辺の範囲だけを残す
+
+    キーワードが見つからない場合は先頭から上限まで残します。
+    """
+    if estimate_tokens(text) <= token_budget:
+        return text
+
+    spans: List[Tuple[int, int]] = []
+    for match in KEYWORD_PATTERN.finditer(text):
+        start = max(0, match.start() - window_chars)
+        end = min(len(text), match.end() + window_chars)
+        if spans and start <= spans[-1][1]:
+            spans[-1] = (spans[-1][0], max(spans[-1][1], end))
+        else:
+            spans.append((start, end))
+
+    if not spans:
+        return _truncate_to_budget(text, token_budget)
+
+    selected = []
+    used = 0
+    for start, end in spans:
+        piece = text[start:end].strip()
+        tokens = estimate_tokens(piece)
+        if used + tokens > token_budget:
+            piece = _truncate_to_budget(piece, token_budget - used)
+            if piece:
+                selected.append(piece)
+            break
+        selected.append(piece)
+        used += tokens + 1
+    return " … ".join(selected)
+
+class PreprocessStats:
+    """前処理によるトークン削減量の累計（metrics の klms_preprocess_tokens_total）"""
+
+    def add(self, tokens_before: int, tokens_after: int):
+        PREPROCESS_DOCUMENTS.inc()
+        PREPROCESS_TOKENS.inc(tokens_before, stage='before')
+        PREPROCESS_TOKENS.inc(tokens_after, stage='after')
+
+    def to_dict(self) -> Dict:
+        tokens_before = int(PREPROCESS_TOKENS.value(stage='before'))
+        tokens_after = int(PREPROCESS_TOKENS.value(stage='after'))
+        return {
+            'documents': int(PREPROCESS_DOCUMENTS.value()),
+            'tokens_before': tokens_before,
+            'tokens_after': tokens_after,
+            'reduction_ratio': 1 - tokens_after / tokens_before if tokens_before else None
+        }
+
+stats = PreprocessStats()
+
+def prepare_body(body: Optional[str], token_budget: Optional[int] = None) -> Tuple[str, int, int]:
+    """
+    お知らせ本文をプロンプト用に前処理する
+
+    Args:
+        body: お知らせの本文（Canvas の HTML）
+        token_budget: 本文に使うトークン数の上限（Noneの場合は Config.PROMPT_BODY_TOKEN_BUDGET）
+
+    Returns:
+        (前処理後のテキスト, 前処理前のトークン数, 前処理後のトークン数)
+    """
+    body = body or ""
+    tokens_before = estimate_tokens(body)
+    text = collapse_whitespace(html_to_text(body))
+    text = strip_boilerplate(text)
+    text = keyword_window(text, token_budget or Config.PROMPT_BODY_TOKEN_BUDGET, Config.PROMPT_KEYWORD_WINDOW_CHARS)
+    tokens_after = estimate_tokens(text)
+    stats.add(tokens_before, tokens_after)
+    return text, tokens_before, tokens_after
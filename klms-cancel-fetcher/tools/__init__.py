@@ -0,0 +1 @@
+"""開発用ツール（評価・ベンチマークなど）"""
@@ -0,0 +1,39 @@
+"""
+結果ログ（results/klms_results.ndjson）の圧縮ツール
+
+保持期間を過ぎた結果を削除し、前日以前の結果を1日1件にまとめます
+（休講情報は (course_id, announcement_id) ごとに最新のものだけを残します）。
+--import-legacy を指定すると、以前のバージョンが1回の実行ごとに書いていた
+results/klms_results_<日時>.json を結果ログに取り込み、取り込んだファイルを削除します。
+
+使い方（klms-cancel-fetcher ディレクトリで実行）:
+    python3 -m tools.compact_results
+    python3 -m tools.compact_results --retention-days 90 --import-legacy
+"""
+
+import argparse
+import os
+
+from results_log import get_results_log, legacy_result_files
+from config import Config
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="結果ログの圧縮")
+    parser.add_argument("--retention-days", type=int, default=Config.RESULTS_RETENTION_DAYS,
+                        help=f"結果を残す日数（既定: {Config.RESULTS_RETENTION_DAYS}）")
+    parser.add_argument("--import-legacy", action="store_true",
+                        help="以前のバージョンの結果ファイル（klms_results_<日時>.json）を取り込んで削除する")
+    args = parser.parse_args(argv)
+
+    legacy_files = legacy_result_files(Config.RESULTS_DIR) if args.import_legacy else []
+    stats = get_results_log().compact(args.retention_days, legacy_files)
+    for path in legacy_files:
+        os.remove(path)
+
+    print(f"圧縮前の結果: {stats['snapshots_before']}件（取り込んだ結果ファイル {stats['legacy_files']}件）")
+    print(f"保持期間（{args.retention_days}日）を過ぎて削除: {stats['expired']}件")
+    print(f"圧縮後の結果: {stats['snapshots_after']}件")
+    print(f"重複を除いた休講情報: {stats['duplicate_cancellations_removed']}件")
+
+if __name__ == "__main__":
+    main()
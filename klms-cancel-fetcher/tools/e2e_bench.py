@@ -0,0 +1,359 @@
+"""
+オフラインのエンドツーエンドベンチマーク
+
+KLMS・OpenAIの認証情報なしで、パイプライン全体のスループットと遅延を計測します。
+Canvas API（tools.fake_canvas）と OpenAI API（tools.fake_openai）のスタンドインサーバーを起動し、
+ユーザー数を変えながら次の対象を動かします。
+
+- main: main.main をユーザー（Canvasトークン）ごとに順に実行する
+- api: APIサーバー（uvicorn）を起動し、GET /api/kyukou を --concurrency 並列で呼び出す
+  （--devices を指定すると、ユーザーごとにその数の端末が同時に更新を要求する）
+
+対象・ユーザー数の組ごとに新しい作業ディレクトリ（データベース・結果ログ）を使う子プロセスで実行し、
+同じユーザーで2回（cold: キャッシュなし, warm: 2回目）計測します。
+経過時間・Canvas APIとOpenAI APIのリクエスト数・トークン数・ユーザー（api では1リクエスト）ごとの所要時間の p50/p99 を表示し、
+基準値（--baseline の JSONL）の同じ条件の最新の記録と比べて、悪化した項目を回帰として報告します
+（回帰があった場合の終了コードは 1）。--save-baseline を付けると今回の結果を基準値に追記します。
+
+トークン数は偽サーバーが数えた文字数（実際のトークン数の目安）です。
+--cascade でモデルを指定すると段階的な判定（ANALYSIS_CASCADE_MODELS）で計測し、モデルごとのリクエスト数も表示します。
+
+使い方（klms-cancel-fetcher ディレクトリで実行）:
+    python3 -m tools.e2e_bench
+    python3 -m tools.e2e_bench --users 1,100,1000 --courses 20 --target api --concurrency 32
+    python3 -m tools.e2e_bench --canvas-latency 0.05 --openai-latency 0.3 --error-rate 0.05 --save-baseline
+    python3 -m tools.e2e_bench --cascade gpt-4o-mini,gpt-4o
+"""
+
+import argparse
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE_FILE = os.path.join(os.path.dirname(__file__), "benchmarks", "e2e_baselines.jsonl")
+
+TARGETS = ("main", "api")
+PHASES = ("cold", "warm")
+
+# 回帰として扱う項目（すべて小さいほど良い）と、時間の項目で誤差として無視する増加量
+TIME_METRICS = {'wall_seconds': 0.05, 'p50_ms': 5.0, 'p99_ms': 5.0}
+COUNT_METRICS = ('canvas_requests', 'openai_requests', 'prompt_tokens', 'completion_tokens', 'errors')
+
+# 条件が同じ記録どうしを比べるための項目
+SCENARIO_KEYS = ('target', 'users', 'courses', 'announcements', 'course_pool', 'page_size', 'canvas_latency',
+                 'openai_latency', 'error_rate', 'canned', 'concurrency', 'devices', 'cascade')
+
+def percentile(values: List[float], q: float) -> float:
+    """最近接順位法のパーセンタイル（values が空の場合は 0）"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(math.ceil(q * len(ordered) / 100), 1)
+    return ordered[min(rank, len(ordered)) - 1]
+
+def scenario_key(scenario: Dict, phase: str) -> str:
+    return " ".join(f"{name}={scenario[name]}" for name in SCENARIO_KEYS) + f" phase={phase}"
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+class _MainTarget:
+    """main.main をユーザーごとに順に実行する"""
+
+    def __init__(self, scenario: Dict):
+        import main as klms_main
+        self.klms_main = klms_main
+
+    def run(self, tokens: List[str]) -> Tuple[List[float], int]:
+        from metrics import PIPELINE_RUNS
+        failed_before = PIPELINE_RUNS.value(result='failed')
+        latencies = []
+        for token in tokens:
+            start = time.perf_counter()
+            self.klms_main.main(canvas_token=token)
+            latencies.append(time.perf_counter() - start)
+        return latencies, int(PIPELINE_RUNS.value(result='failed') - failed_before)
+
+    def close(self):
+        pass
+
+class _ApiTarget:
+    """APIサーバーを起動し、GET /api/kyukou を並列に呼び出す"""
+
+    def __init__(self, scenario: Dict):
+        import uvicorn
+        from api_server import app
+        port = _free_port()
+        self.url = f"http://127.0.0.1:{port}/api/kyukou"
+        self.concurrency = scenario['concurrency']
+        self.devices = scenario['devices']
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+
+    def _request(self, token: str) -> Tuple[float, bool]:
+        import requests
+        start = time.perf_counter()
+        try:
+            ok = requests.get(self.url, params={'canvas_token': token}, timeout=600).status_code == 200
+        except requests.exceptions.RequestException:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    def run(self, tokens: List[str]) -> Tuple[List[float], int]:
+        requests_by_device = [token for token in tokens for _ in range(self.devices)]
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            results = list(executor.map(self._request, requests_by_device))
+        return [latency for latency, _ in results], sum(1 for _, ok in results if not ok)
+
+    def close(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+
+def run_scenario(scenario: Dict) -> List[Dict]:
+    """
+    1つの条件を計測する（子プロセスの作業ディレクトリで実行する）
+
+    Returns:
+        計測の段階（cold, warm）ごとの結果
+    """
+    from config import Config
+    Config.LOG_LEVEL = "WARNING"
+    Config.ANALYSIS_CASCADE_MODELS = [name for name in scenario['cascade'].split(',') if name]
+    # 実際のAPIのレート制限で待たないように、上限を十分に大きくする（環境変数で指定した場合はその値）
+    os.environ.setdefault('OPENAI_REQUESTS_PER_MINUTE', '1000000')
+    os.environ.setdefault('OPENAI_TOKENS_PER_MINUTE', '1000000000')
+
+    from tools import fake_canvas, fake_openai
+    canvas_server, canvas_state = fake_canvas.start_server(
+        courses=scenario['courses'], announcements=scenario['announcements'], course_pool=scenario['course_pool'],
+        page_size=scenario['page_size'], latency=scenario['canvas_latency']
+    )
+    openai_server, openai_state = fake_openai.start_server(
+        latency=scenario['openai_latency'], error_rate=scenario['error_rate'], retry_after=0.1,
+        canned=scenario['canned_result']
+    )
+    os.environ.update({
+        'CANVAS_API_BASE_URL': f"http://127.0.0.1:{canvas_server.server_port}/api/v1/",
+        'OPENAI_BASE_URL': f"http://127.0.0.1:{openai_server.server_port}/v1",
+        'OPENAI_API_KEY': "bench",
+        'KLMS_DATABASE_FILE': os.path.join("data", "klms.sqlite3"),
+        'METRICS_FILE': os.path.join("results", "klms_metrics.prom")
+    })
+
+    from metrics import GPT_ERRORS
+    tokens = [f"bench-user-{i}" for i in range(scenario['users'])]
+    target = (_MainTarget if scenario['target'] == "main" else _ApiTarget)(scenario)
+    phases = []
+    try:
+        for phase in PHASES:
+            canvas_before = canvas_state.stats()
+            openai_before = openai_state.stats()
+            gpt_errors_before = GPT_ERRORS.value()
+            start = time.perf_counter()
+            latencies, errors = target.run(tokens)
+            wall_seconds = time.perf_counter() - start
+            canvas_after = canvas_state.stats()
+            openai_after = openai_state.stats()
+            phases.append({
+                'phase': phase,
+                'wall_seconds': round(wall_seconds, 3),
+                'users_per_second': round(len(tokens) / wall_seconds, 2) if wall_seconds else 0.0,
+                'canvas_requests': canvas_after['requests'] - canvas_before['requests'],
+                'canvas_not_modified': canvas_after['not_modified'] - canvas_before['not_modified'],
+                'openai_requests': openai_after['requests'] - openai_before['requests'],
+                'openai_rate_limited': openai_after['rate_limited'] - openai_before['rate_limited'],
+                'prompt_tokens': openai_after['prompt_tokens'] - openai_before['prompt_tokens'],
+                'completion_tokens': openai_after['completion_tokens'] - openai_before['completion_tokens'],
+                'openai_requests_by_model': {
+                    model: count - openai_before['requests_by_model'].get(model, 0)
+                    for model, count in openai_after['requests_by_model'].items()
+                    if count > openai_before['requests_by_model'].get(model, 0)
+                },
+                'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+                'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+                'errors': errors + int(GPT_ERRORS.value() - gpt_errors_before)
+            })
+    finally:
+        target.close()
+        canvas_server.shutdown()
+        openai_server.shutdown()
+    return phases
+
+def run_in_subprocess(scenario: Dict, timeout: float) -> List[Dict]:
+    """新しい作業ディレクトリの子プロセスで run_scenario を実行する"""
+    with tempfile.TemporaryDirectory(prefix="klms-e2e-") as workdir:
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [PROJECT_DIR, env.get('PYTHONPATH')]))
+        process = subprocess.run(
+            [sys.executable, "-m", "tools.e2e_bench", "--worker", json.dumps(scenario)],
+            cwd=workdir, env=env, capture_output=True, text=True, timeout=timeout
+        )
+    if process.returncode != 0:
+        raise RuntimeError(f"計測に失敗しました（{scenario['target']}, {scenario['users']}ユーザー）:\n"
+                           + "\n".join(process.stderr.splitlines()[-20:]))
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+def load_baselines(path: str) -> Dict[str, Dict]:
+    """条件ごとの最新の基準値"""
+    baselines = {}
+    if not os.path.exists(path):
+        return baselines
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                baselines[record['key']] = record
+    return baselines
+
+def find_regressions(current: Dict, baseline: Dict, tolerance: float, count_tolerance: float) -> List[str]:
+    """基準値より悪化した項目の説明"""
+    regressions = []
+    for name, min_delta in TIME_METRICS.items():
+        before, after = baseline['metrics'].get(name), current[name]
+        if before is not None and after > before * (1 + tolerance) and after - before > min_delta:
+            regressions.append(f"{name}: {before} → {after} (+{(after / before - 1) * 100 if before else 100:.0f}%)")
+    for name in COUNT_METRICS:
+        before, after = baseline['metrics'].get(name), current[name]
+        if before is not None and after > before * (1 + count_tolerance) and after > before:
+            regressions.append(f"{name}: {before} → {after}")
+    return regressions
+
+def print_results(rows: List[Tuple[Dict, Dict]]):
+    print(f"{'対象':<6}{'段階':<6}{'ユーザー':>8}{'経過(秒)':>10}{'ユーザー/秒':>12}{'Canvas':>8}{'304':>7}"
+          f"{'OpenAI':>8}{'429':>6}{'トークン':>11}{'p50(ms)':>10}{'p99(ms)':>10}{'エラー':>7}")
+    for scenario, phase in rows:
+        tokens = phase['prompt_tokens'] + phase['completion_tokens']
+        print(
+            f"{scenario['target']:<6}{phase['phase']:<6}{scenario['users']:>8}{phase['wall_seconds']:>10.2f}"
+            f"{phase['users_per_second']:>12.2f}{phase['canvas_requests']:>8}{phase['canvas_not_modified']:>7}"
+            f"{phase['openai_requests']:>8}{phase['openai_rate_limited']:>6}{tokens:>11,}"
+            f"{phase['p50_ms']:>10.1f}{phase['p99_ms']:>10.1f}{phase['errors']:>7}"
+        )
+    for scenario, phase in rows:
+        if scenario['cascade'] and phase['openai_requests_by_model']:
+            by_model = ", ".join(f"{model} {count}" for model, count in phase['openai_requests_by_model'].items())
+            print(f"  {scenario['target']}/{phase['phase']}/{scenario['users']}ユーザー のモデルごとのリクエスト数: {by_model}")
+
+def _int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(',') if item.strip()]
+
+def _target_list(value: str) -> List[str]:
+    targets = [item.strip() for item in value.split(',') if item.strip()]
+    for target in targets:
+        if target not in TARGETS:
+            raise argparse.ArgumentTypeError(f"対象は {', '.join(TARGETS)} のいずれかです: {target}")
+    return targets
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="オフラインのエンドツーエンドベンチマーク")
+    parser.add_argument("--target", type=_target_list, default=list(TARGETS),
+                        help="計測する対象（main, api をカンマ区切り。既定: 両方）")
+    parser.add_argument("--users", type=_int_list, default=[1, 100], help="ユーザー数（カンマ区切り。既定: 1,100）")
+    parser.add_argument("--courses", type=int, default=20, help="ユーザーごとのコース数（既定: 20）")
+    parser.add_argument("--announcements", type=int, default=10, help="コースごとのお知らせ数（既定: 10）")
+    parser.add_argument("--course-pool", type=int, default=200,
+                        help="コースの候補の数（ユーザーはこの中から --courses 件を受ける。既定: 200）")
+    parser.add_argument("--page-size", type=int, default=100, help="Canvas APIが1ページに返す件数の上限（既定: 100）")
+    parser.add_argument("--canvas-latency", type=float, default=0.0, help="Canvas APIの応答遅延（秒）")
+    parser.add_argument("--openai-latency", type=float, default=0.0, help="OpenAI APIの応答遅延（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="OpenAI APIが429を返す割合（0〜1）")
+    parser.add_argument("--canned", default=None,
+                        help="OpenAI APIが常に返す判定結果（JSON文字列、またはJSONファイルのパス）")
+    parser.add_argument("--concurrency", type=int, default=16, help="api の同時リクエスト数（既定: 16）")
+    parser.add_argument("--devices", type=int, default=1,
+                        help="api でユーザーごとに同時に更新を要求する端末数（既定: 1）")
+    parser.add_argument("--cascade", default="",
+                        help="段階的に判定するモデル（カンマ区切りで安い順。既定: 段階的な判定なし）")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_FILE, help="基準値のファイル（JSONL）")
+    parser.add_argument("--save-baseline", action="store_true", help="今回の結果を基準値に追記する")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="経過時間・p50・p99 の悪化を回帰とみなす割合（既定: 0.25）")
+    parser.add_argument("--count-tolerance", type=float, default=0.1,
+                        help="リクエスト数・トークン数・エラー数の増加を回帰とみなす割合（既定: 0.1。"
+                             "同じ本文のお知らせを並行して判定する順序で、OpenAI APIのリクエスト数は数件ぶれる）")
+    parser.add_argument("--timeout", type=float, default=3600, help="1つの条件の計測の制限時間（秒）")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        print(json.dumps(run_scenario(json.loads(args.worker))))
+        return
+
+    from tools.fake_openai import load_canned
+    canned_result = load_canned(args.canned) if args.canned else None
+    scenarios = [
+        {
+            'target': target,
+            'users': users,
+            'courses': args.courses,
+            'announcements': args.announcements,
+            'course_pool': args.course_pool,
+            'page_size': args.page_size,
+            'canvas_latency': args.canvas_latency,
+            'openai_latency': args.openai_latency,
+            'error_rate': args.error_rate,
+            'canned': canned_result is not None,
+            'canned_result': canned_result,
+            'concurrency': args.concurrency if target == "api" else 1,
+            'devices': args.devices if target == "api" else 1,
+            'cascade': args.cascade
+        }
+        for target in args.target
+        for users in args.users
+    ]
+
+    rows = []
+    for scenario in scenarios:
+        print(f"計測中: {scenario['target']} / {scenario['users']}ユーザー × {scenario['courses']}コース ...", flush=True)
+        for phase in run_in_subprocess(scenario, args.timeout):
+            rows.append((scenario, phase))
+    print()
+    print_results(rows)
+
+    baselines = load_baselines(args.baseline)
+    regression_count = 0
+    compared = 0
+    for scenario, phase in rows:
+        baseline = baselines.get(scenario_key(scenario, phase['phase']))
+        if baseline is None:
+            continue
+        compared += 1
+        for regression in find_regressions(phase, baseline, args.tolerance, args.count_tolerance):
+            regression_count += 1
+            print(f"回帰: {scenario['target']}/{phase['phase']}/{scenario['users']}ユーザー {regression}"
+                  f"（基準値: {baseline['recorded_at']}）")
+    print(f"\n基準値との比較: {compared}件（回帰 {regression_count}件）")
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline) or ".", exist_ok=True)
+        recorded_at = datetime.now().isoformat(timespec='seconds')
+        with open(args.baseline, 'a', encoding='utf-8') as f:
+            for scenario, phase in rows:
+                f.write(json.dumps({
+                    'key': scenario_key(scenario, phase['phase']),
+                    'recorded_at': recorded_at,
+                    'scenario': {name: scenario[name] for name in SCENARIO_KEYS},
+                    'metrics': {name: value for name, value in phase.items() if name != 'phase'}
+                }, ensure_ascii=False) + "\n")
+        print(f"基準値を保存しました: {args.baseline}")
+
+    if regression_count:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
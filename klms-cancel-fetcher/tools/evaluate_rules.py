@@ -0,0 +1,104 @@
+"""
+ルールベース抽出（rule_extractor）の評価ツール
+
+ラベル付きコーパス（JSONL）に対して extract_cancellation を実行し、
+適合率・再現率と、GPT呼び出しを省略できた割合を表示します。
+本文はパイプラインと同じく text_preprocessor.prepare_body で前処理してから抽出します。
+
+使い方（klms-cancel-fetcher ディレクトリで実行）:
+    python3 -m tools.evaluate_rules
+    python3 -m tools.evaluate_rules --corpus path/to/corpus.jsonl --min-precision 0.95
+
+コーパスの各行の形式:
+    {"title": "...", "body": "...", "posted_at": "2025-06-15T09:00:00Z",
+     "label": {"canceled": true, "date": "2025-06-17", "period": "3限"}}
+"""
+
+import argparse
+import json
+import os
+import sys
+from datetime import datetime
+from typing import Dict, List
+
+from rule_extractor import extract_cancellation
+from text_preprocessor import prepare_body
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(__file__), "corpus", "cancellation_corpus.jsonl")
+
+def load_corpus(path: str) -> List[Dict]:
+    """JSONL形式のコーパスを読み込む"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def evaluate(corpus: List[Dict]) -> Dict:
+    """
+    コーパス全体で抽出結果を評価する
+
+    ルールが結果を返したものを「抽出」、ラベルと休講・日付・時限がすべて一致したものを「正解」とし、
+    適合率 = 正解 / 抽出、再現率 = 正解 / 日付と時限が確定している休講 として計算します。
+    """
+    fired = 0
+    correct = 0
+    extractable = 0
+    errors = []
+
+    for i, example in enumerate(corpus, 1):
+        label = example['label']
+        posted_at = example.get('posted_at')
+        reference_date = datetime.fromisoformat(posted_at.replace('Z', '+00:00')).date() if posted_at else None
+
+        body, _, _ = prepare_body(example['body'])
+        result = extract_cancellation(example['title'], body, reference_date=reference_date)
+
+        if label.get('canceled') and label.get('date') and label.get('period'):
+            extractable += 1
+        if result is None:
+            continue
+
+        fired += 1
+        if (label.get('canceled')
+                and result['date'] == label.get('date')
+                and result['period'] == label.get('period')):
+            correct += 1
+        else:
+            errors.append({'line': i, 'title': example['title'], 'expected': label, 'actual': result})
+
+    total = len(corpus)
+    return {
+        'total': total,
+        'fired': fired,
+        'correct': correct,
+        'extractable': extractable,
+        'precision': correct / fired if fired else None,
+        'recall': correct / extractable if extractable else None,
+        'gpt_calls_avoided': fired / total if total else None,
+        'errors': errors
+    }
+
+def _format_ratio(value) -> str:
+    return "-" if value is None else f"{value:.1%}"
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="ルールベース休講抽出の評価")
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS, help="ラベル付きコーパス（JSONL）のパス")
+    parser.add_argument("--min-precision", type=float, default=None,
+                        help="適合率がこの値を下回った場合に終了コード1で終了する")
+    args = parser.parse_args(argv)
+
+    report = evaluate(load_corpus(args.corpus))
+
+    print(f"件数: {report['total']}")
+    print(f"ルールで抽出: {report['fired']}件（うち正解 {report['correct']}件）")
+    print(f"適合率: {_format_ratio(report['precision'])}")
+    print(f"再現率: {_format_ratio(report['recall'])}（日付・時限が確定している休講 {report['extractable']}件中）")
+    print(f"GPT呼び出しの削減率: {_format_ratio(report['gpt_calls_avoided'])}")
+    for error in report['errors']:
+        print(f"  誤抽出 (行 {error['line']}): {error['title']} 期待: {error['expected']} 実際: {error['actual']}")
+
+    if args.min_precision is not None and (report['precision'] or 0) < args.min_precision:
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,297 @@
+"""
+Canvas API（KLMS）のローカルスタンドインサーバー
+
+KLMSのアカウントなしで canvas_api・pipeline を動かすための偽サーバーです。
+コース一覧（/api/v1/courses）・お知らせ（/api/v1/announcements）・カレンダーの予定（/api/v1/calendar_events）の
+最小限のエンドポイントを実装しています。
+
+- トークンごとに、コースの共通の候補（course_pool 件）から courses 件のコースを決まった順で割り当てます
+  （同じ授業を受けるユーザーどうしは同じお知らせを受け取る）。
+- お知らせはコースごとに announcements 件を決まった内容で作ります（日付・時限のはっきりした休講・
+  あいまいな休講・複数のコースに投稿された同じお知らせ（コース名や言い回しだけが違う）・休講以外のお知らせが混ざる）。
+  投稿日時はサーバーの起動時刻から1日ずつさかのぼります。
+- カレンダーの予定は、コースごとに決まった曜日（コースIDから決める月〜金のいずれか）の毎週の授業回です。
+- per_page は page_size を上限とし、続きがある場合は Link ヘッダーの rel="next" を返します。
+- 応答には ETag を付け、If-None-Match が一致する場合は 304 を返します。
+
+使い方（klms-cancel-fetcher ディレクトリで実行）:
+    python3 -m tools.fake_canvas --port 8002 --courses 20 --announcements 10 --latency 0.05
+    CANVAS_API_BASE_URL=http://127.0.0.1:8002/api/v1/ CANVAS_ACCESS_TOKEN=dummy python3 main.py
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlencode, urlparse
+
+# コースID・お知らせIDの開始値
+COURSE_ID_BASE = 10000
+ANNOUNCEMENT_ID_BASE = 1000000
+
+WEEKDAYS = "月火水木金土日"
+
+def _announcement(course_id: int, index: int, posted_at: datetime) -> Dict:
+    """コースの index 番目のお知らせ（同じ引数からは常に同じ内容を作る）"""
+    rng = random.Random(course_id * 1000 + index)
+    kind = rng.random()
+    day = posted_at + timedelta(days=rng.randint(1, 14))
+    period = rng.randint(1, 6)
+    if kind < 0.2:
+        # 日付・時限のはっきりした休講（ルールベース抽出で判定できる）
+        title = f"【休講】{day.month}月{day.day}日の授業について"
+        body = (f"<p>{day.month}月{day.day}日({WEEKDAYS[day.weekday()]}){period}限の授業は、"
+                f"担当教員の出張のため休講とします。補講は後日連絡します。</p>")
+    elif kind < 0.35:
+        # あいまいな休講（GPTでの判定が必要）
+        title = "次回の授業について"
+        body = "<p>担当教員の体調不良のため、次回の授業は休講とします。課題は別途お知らせします。</p>"
+    elif kind < 0.45:
+        # 複数のコースに投稿された同じお知らせ（コース名と言い回しが少しだけ違う）
+        name = f"授業{course_id}"
+        title = f"【{name}】教室変更のお知らせ"
+        body = (f"<p>{name}の{'受講者' if course_id % 2 else '受講生'}の皆さん、来週から教室を変更します。"
+                "新しい教室は掲示板で確認してください。</p>")
+    else:
+        title = f"第{index + 1}回の授業資料について"
+        body = ("<p>受講者の皆さん、" + "次回の授業では前回の課題を解説します。資料を事前に確認してください。" * rng.randint(1, 6)
+                + "</p>")
+    announcement_id = ANNOUNCEMENT_ID_BASE + course_id * 1000 + index
+    return {
+        "id": announcement_id,
+        "title": title,
+        "message": body,
+        "posted_at": posted_at.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "context_code": f"course_{course_id}",
+        "author": {"id": 42, "display_name": "担当教員"},
+        "read_state": "unread",
+        "html_url": f"https://lms.example.ac.jp/courses/{course_id}/discussion_topics/{announcement_id}"
+    }
+
+def _parse_time(value: Optional[str], end_of_day: bool = False) -> Optional[datetime]:
+    """ISO 8601 の日時・日付（end_of_day が True の場合、日付だけの値はその日の終わり）"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if end_of_day and len(value) == 10:
+        parsed += timedelta(days=1) - timedelta(microseconds=1)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+class FakeCanvasState:
+    """偽サーバーの状態（コース・お知らせの内容と統計）"""
+
+    def __init__(self, courses: int = 20, announcements: int = 10, course_pool: Optional[int] = None,
+                 page_size: int = 100, latency: float = 0.0):
+        """
+        Args:
+            courses: トークン（ユーザー）ごとのコース数
+            announcements: コースごとのお知らせ数
+            course_pool: コースの候補の数（None の場合は courses と同じで、全ユーザーが同じコースを受ける）
+            page_size: 1ページに返す件数の上限（per_page がこれより大きい場合はこの件数）
+            latency: 1リクエストごとの応答遅延（秒）
+        """
+        self.courses = courses
+        self.announcements = announcements
+        self.course_pool = max(course_pool or courses, courses)
+        self.page_size = page_size
+        self.latency = latency
+        self.started_at = datetime.now(timezone.utc).replace(microsecond=0)
+        self._announcements: Dict[int, List[Dict]] = {}
+        self.requests = 0
+        self.not_modified = 0
+        self.unauthorized = 0
+        self.items_served = 0
+        self.lock = threading.Lock()
+
+    def courses_for_token(self, token: str) -> List[Dict]:
+        """トークンに割り当てるコース（候補から決まった位置の courses 件）"""
+        start = int(hashlib.sha256(token.encode('utf-8')).hexdigest(), 16) % self.course_pool
+        return [
+            {"id": course_id, "name": f"授業{course_id}", "course_code": f"C{course_id}"}
+            for course_id in (COURSE_ID_BASE + (start + i) % self.course_pool for i in range(self.courses))
+        ]
+
+    def announcements_for_course(self, course_id: int) -> List[Dict]:
+        """コースのお知らせ（新しい順）"""
+        with self.lock:
+            cached = self._announcements.get(course_id)
+            if cached is None:
+                cached = self._announcements[course_id] = [
+                    _announcement(course_id, index, self.started_at - timedelta(days=index, hours=course_id % 24))
+                    for index in range(self.announcements)
+                ]
+            return cached
+
+    def list_announcements(self, token: str, context_codes: List[str], start_date: Optional[str],
+                           end_date: Optional[str]) -> List[Dict]:
+        """指定したコースのうちトークンが受けているコースのお知らせを、期間で絞って新しい順に返す"""
+        allowed = {f"course_{course['id']}" for course in self.courses_for_token(token)}
+        start = _parse_time(start_date)
+        end = _parse_time(end_date, end_of_day=True)
+        results = []
+        for context_code in context_codes:
+            if context_code not in allowed:
+                continue
+            for ann in self.announcements_for_course(int(context_code.split('_', 1)[1])):
+                posted_at = _parse_time(ann['posted_at'])
+                if (start is None or posted_at >= start) and (end is None or posted_at <= end):
+                    results.append(ann)
+        results.sort(key=lambda ann: ann['posted_at'], reverse=True)
+        return results
+
+    def list_calendar_events(self, token: str, context_codes: List[str], start_date: Optional[str],
+                             end_date: Optional[str]) -> List[Dict]:
+        """指定したコースのうちトークンが受けているコースの毎週の授業回を、期間で絞って古い順に返す"""
+        allowed = {f"course_{course['id']}" for course in self.courses_for_token(token)}
+        start = (_parse_time(start_date) or self.started_at - timedelta(days=7)).date()
+        end = (_parse_time(end_date, end_of_day=True) or self.started_at + timedelta(days=7)).date()
+        results = []
+        for context_code in context_codes:
+            if context_code not in allowed:
+                continue
+            course_id = int(context_code.split('_', 1)[1])
+            day = start + timedelta(days=(course_id % 5 - start.weekday()) % 7)
+            while day <= end:
+                results.append({
+                    "id": course_id * 100000 + day.toordinal() % 100000,
+                    "title": f"授業{course_id}",
+                    "start_at": f"{day.isoformat()}T01:00:00Z",
+                    "end_at": f"{day.isoformat()}T02:30:00Z",
+                    "context_code": context_code
+                })
+                day += timedelta(days=7)
+        results.sort(key=lambda event: event['start_at'])
+        return results
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "not_modified": self.not_modified,
+                "unauthorized": self.unauthorized,
+                "items_served": self.items_served
+            }
+
+def _make_handler(state: FakeCanvasState):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # ヘッダーと本文を別々に書き込むため、Nagle アルゴリズムによる応答の遅れ（約40ms）を避ける
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status: int, payload: bytes = b"", headers: Optional[Dict] = None):
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            if payload:
+                self.wfile.write(payload)
+
+        def _send_page(self, items: List, query: Dict[str, List[str]], path: str):
+            """items を per_page・page で区切って返す（続きがある場合は Link ヘッダーを付ける）"""
+            try:
+                per_page = min(int(query.get('per_page', ['10'])[0]), state.page_size)
+                page = max(int(query.get('page', ['1'])[0]), 1)
+            except ValueError:
+                self._send(400, b'{"errors":[{"message":"invalid page"}]}', {"Content-Type": "application/json"})
+                return
+            per_page = max(per_page, 1)
+            chunk = items[(page - 1) * per_page:page * per_page]
+            payload = json.dumps(chunk, ensure_ascii=False).encode('utf-8')
+            etag = f'"{hashlib.sha256(payload).hexdigest()[:32]}"'
+            headers = {"Content-Type": "application/json; charset=utf-8", "ETag": etag}
+            if page * per_page < len(items):
+                next_query = dict(query, page=[str(page + 1)], per_page=[str(per_page)])
+                next_url = f"http://{self.headers.get('Host')}{path}?{urlencode(next_query, doseq=True)}"
+                headers["Link"] = f'<{next_url}>; rel="next"'
+            if self.headers.get('If-None-Match') == etag:
+                with state.lock:
+                    state.not_modified += 1
+                self._send(304, headers={"ETag": etag, **({"Link": headers["Link"]} if "Link" in headers else {})})
+                return
+            with state.lock:
+                state.items_served += len(chunk)
+            self._send(200, payload, headers)
+
+        def do_GET(self):
+            with state.lock:
+                state.requests += 1
+            time.sleep(state.latency)
+            parsed = urlparse(self.path)
+            query = parse_qs(parsed.query)
+            authorization = self.headers.get('Authorization', '')
+            token = authorization[len("Bearer "):] if authorization.startswith("Bearer ") else ""
+            if not token:
+                with state.lock:
+                    state.unauthorized += 1
+                self._send(401, b'{"errors":[{"message":"Invalid access token."}]}', {"Content-Type": "application/json"})
+                return
+
+            if parsed.path.endswith("/courses"):
+                self._send_page(state.courses_for_token(token), query, parsed.path)
+            elif parsed.path.endswith("/announcements"):
+                items = state.list_announcements(
+                    token, query.get('context_codes[]', []),
+                    query.get('start_date', [None])[0], query.get('end_date', [None])[0]
+                )
+                self._send_page(items, query, parsed.path)
+            elif parsed.path.endswith("/calendar_events"):
+                items = state.list_calendar_events(
+                    token, query.get('context_codes[]', []),
+                    query.get('start_date', [None])[0], query.get('end_date', [None])[0]
+                )
+                self._send_page(items, query, parsed.path)
+            else:
+                self._send(404, b'{"errors":[{"message":"The specified resource does not exist."}]}',
+                           {"Content-Type": "application/json"})
+
+    return Handler
+
+def start_server(host: str = "127.0.0.1", port: int = 0, **options) -> Tuple[ThreadingHTTPServer, FakeCanvasState]:
+    """
+    偽サーバーをバックグラウンドスレッドで起動する
+
+    Returns:
+        (サーバー, 状態)。CANVAS_API_BASE_URL は f"http://{host}:{server.server_port}/api/v1/"
+    """
+    state = FakeCanvasState(**options)
+    server = ThreadingHTTPServer((host, port), _make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Canvas API（KLMS）のローカルスタンドインサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8002)
+    parser.add_argument("--courses", type=int, default=20, help="ユーザーごとのコース数（既定: 20）")
+    parser.add_argument("--announcements", type=int, default=10, help="コースごとのお知らせ数（既定: 10）")
+    parser.add_argument("--course-pool", type=int, default=None,
+                        help="コースの候補の数（既定: --courses と同じで、全ユーザーが同じコースを受ける）")
+    parser.add_argument("--page-size", type=int, default=100, help="1ページに返す件数の上限（既定: 100）")
+    parser.add_argument("--latency", type=float, default=0.0, help="1リクエストごとの応答遅延（秒）")
+    args = parser.parse_args(argv)
+
+    state = FakeCanvasState(args.courses, args.announcements, args.course_pool, args.page_size, args.latency)
+    server = ThreadingHTTPServer((args.host, args.port), _make_handler(state))
+    print(f"Canvas API スタンドインサーバーを起動しました: http://{args.host}:{args.port}/api/v1/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"統計: {state.stats()}")
+
+if __name__ == "__main__":
+    main()
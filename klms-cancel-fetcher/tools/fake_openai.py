@@ -0,0 +1,304 @@
+"""
+OpenAI API のローカルスタンドインサーバー
+
+APIキーや課金なしで gpt_analyzer・analysis_scheduler・batch_jobs を動かすための偽サーバーです。
+Chat Completions（1件ずつ・まとめて判定の両方）、Files、Batches の最小限のエンドポイントを実装しています。
+判定結果はルールベース抽出と「休講」キーワードの有無から機械的に作ります（--canned で固定の判定結果を返すこともできる）。
+確信度（confidence）は、ルールで抽出できたお知らせと休講に関わる語のないお知らせでは高く、日付・時限のない休講や
+「変更」「延期」などを含むお知らせでは低くなるため、段階的な判定（ANALYSIS_CASCADE_MODELS）の上位モデルへの再判定も試せます。
+
+使い方（klms-cancel-fetcher ディレクトリで実行）:
+    python3 -m tools.fake_openai --port 8001 --latency 0.5 --error-rate 0.1
+    python3 -m tools.fake_openai --canned '{"canceled": false, "course": null, "date": null, "period": null}'
+    OPENAI_BASE_URL=http://127.0.0.1:8001/v1 OPENAI_API_KEY=dummy python3 main.py
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+from rule_extractor import extract_cancellation
+
+SINGLE_PROMPT_PATTERN = re.compile(r"お知らせのタイトル: (?P<title>.*?)\nお知らせの本文: (?P<body>.*)", re.DOTALL)
+
+# 休講ではないと判定したときに確信度を下げる語
+UNCERTAIN_PATTERN = re.compile(r"変更|延期|中止|振替|補講|オンライン")
+
+def classify(title: str, body: str) -> Dict:
+    """お知らせの内容から機械的に判定結果を作る"""
+    result = extract_cancellation(title, body)
+    if result is not None:
+        return dict(result, confidence=0.95)
+    text = f"{title}{body}"
+    canceled = "休講" in text
+    if canceled:
+        confidence = 0.6
+    else:
+        confidence = 0.7 if UNCERTAIN_PATTERN.search(text) else 0.95
+    return {
+        "course": None,
+        "date": None,
+        "period": None,
+        "canceled": canceled,
+        "source": "KLMS",
+        "message": title if canceled else None,
+        "confidence": confidence
+    }
+
+def _completion_content(messages: List[Dict], canned: Optional[Dict] = None) -> str:
+    """
+    リクエストのメッセージから応答本文（JSON文字列）を作る
+
+    canned を指定した場合は、お知らせの内容によらずその判定結果を返す
+    """
+    user_content = messages[-1]['content']
+    match = SINGLE_PROMPT_PATTERN.match(user_content)
+    if match:
+        result = dict(canned) if canned is not None else classify(match.group('title'), match.group('body'))
+        return json.dumps(result, ensure_ascii=False)
+
+    announcements = json.loads(user_content)['announcements']
+    results = [
+        dict(canned if canned is not None else classify(ann['title'], ann['body']), id=ann['id'])
+        for ann in announcements
+    ]
+    return json.dumps({"results": results}, ensure_ascii=False)
+
+class FakeOpenAIState:
+    """偽サーバーの状態（アップロードされたファイル・Batchジョブ・統計）"""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, retry_after: float = 1.0,
+                 canned: Optional[Dict] = None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.canned = canned
+        self.files: Dict[str, Dict] = {}
+        self.batches: Dict[str, Dict] = {}
+        self.requests = 0
+        self.rate_limited = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.requests_by_model: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def chat_completion(self, params: Dict) -> Dict:
+        """Chat Completions の応答を作る"""
+        content = _completion_content(params['messages'], self.canned)
+        prompt_tokens = sum(len(message['content']) for message in params['messages'])
+        completion_tokens = len(content)
+        with self.lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            model = params.get('model') or ""
+            self.requests_by_model[model] = self.requests_by_model.get(model, 0) + 1
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": params.get('model'),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        }
+
+    def add_file(self, filename: str, purpose: str, content: bytes) -> Dict:
+        file_id = f"file-{uuid.uuid4().hex}"
+        file_object = {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed"
+        }
+        with self.lock:
+            self.files[file_id] = {"object": file_object, "content": content}
+        return file_object
+
+    def create_batch(self, params: Dict) -> Dict:
+        """Batchジョブを作成し、その場で処理して完了状態にする"""
+        input_file = self.files[params['input_file_id']]
+        output_lines = []
+        lines = [line for line in input_file['content'].decode('utf-8').splitlines() if line.strip()]
+        for raw_line in lines:
+            request = json.loads(raw_line)
+            output_lines.append(json.dumps({
+                "id": f"batch_req_{uuid.uuid4().hex}",
+                "custom_id": request['custom_id'],
+                "response": {
+                    "status_code": 200,
+                    "request_id": uuid.uuid4().hex,
+                    "body": self.chat_completion(request['body'])
+                },
+                "error": None
+            }, ensure_ascii=False))
+        output_file = self.add_file("batch_output.jsonl", "batch_output", ("\n".join(output_lines) + "\n").encode('utf-8'))
+
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        now = int(time.time())
+        batch = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": params['endpoint'],
+            "input_file_id": params['input_file_id'],
+            "completion_window": params['completion_window'],
+            "status": "completed",
+            "output_file_id": output_file['id'],
+            "error_file_id": None,
+            "created_at": now,
+            "completed_at": now,
+            "request_counts": {"total": len(lines), "completed": len(lines), "failed": 0}
+        }
+        with self.lock:
+            self.batches[batch_id] = batch
+        return batch
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "rate_limited": self.rate_limited,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "requests_by_model": dict(self.requests_by_model)
+            }
+
+def _make_handler(state: FakeOpenAIState):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # ヘッダーと本文を別々に書き込むため、Nagle アルゴリズムによる応答の遅れ（約40ms）を避ける
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status: int, data: Dict, headers: Optional[Dict] = None):
+            payload = json.dumps(data, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _read_body(self) -> bytes:
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        def _parse_multipart(self, body: bytes) -> Tuple[Dict[str, str], Optional[Tuple[str, bytes]]]:
+            message = BytesParser(policy=default_policy).parsebytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode('utf-8') + body
+            )
+            fields = {}
+            uploaded = None
+            for part in message.iter_parts():
+                name = part.get_param('name', header='content-disposition')
+                if part.get_filename():
+                    uploaded = (part.get_filename(), part.get_payload(decode=True))
+                else:
+                    fields[name] = part.get_content().strip()
+            return fields, uploaded
+
+        def do_POST(self):
+            body = self._read_body()
+            path = self.path.split('?')[0]
+            if path.endswith("/chat/completions"):
+                with state.lock:
+                    state.requests += 1
+                time.sleep(state.latency)
+                if random.random() < state.error_rate:
+                    with state.lock:
+                        state.rate_limited += 1
+                    self._send_json(429, {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                                    {"retry-after": str(state.retry_after)})
+                    return
+                self._send_json(200, state.chat_completion(json.loads(body)))
+            elif path.endswith("/files"):
+                fields, uploaded = self._parse_multipart(body)
+                filename, content = uploaded
+                self._send_json(200, state.add_file(filename, fields.get('purpose', ''), content))
+            elif path.endswith("/batches"):
+                self._send_json(200, state.create_batch(json.loads(body)))
+            else:
+                self._send_json(404, {"error": {"message": f"Unknown path: {path}"}})
+
+        def do_GET(self):
+            path = self.path.split('?')[0]
+            parts = path.strip('/').split('/')
+            if len(parts) >= 3 and parts[-2] == "batches" and parts[-1] in state.batches:
+                self._send_json(200, state.batches[parts[-1]])
+            elif len(parts) >= 3 and parts[-1] == "content" and parts[-2] in state.files:
+                content = state.files[parts[-2]]['content']
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+            elif len(parts) >= 2 and parts[-2] == "files" and parts[-1] in state.files:
+                self._send_json(200, state.files[parts[-1]]['object'])
+            else:
+                self._send_json(404, {"error": {"message": f"Unknown path: {path}"}})
+
+    return Handler
+
+def load_canned(value: str) -> Dict:
+    """--canned の値（JSON文字列、またはJSONファイルのパス）を読み込む"""
+    if os.path.isfile(value):
+        with open(value, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return json.loads(value)
+
+def start_server(host: str = "127.0.0.1", port: int = 0, **options) -> Tuple[ThreadingHTTPServer, FakeOpenAIState]:
+    """
+    偽サーバーをバックグラウンドスレッドで起動する
+
+    Returns:
+        (サーバー, 状態)。base_url は f"http://{host}:{server.server_port}/v1"
+    """
+    state = FakeOpenAIState(**options)
+    server = ThreadingHTTPServer((host, port), _make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="OpenAI API のローカルスタンドインサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.0, help="Chat Completions の応答遅延（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="429を返す割合（0〜1）")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="429応答の Retry-After（秒）")
+    parser.add_argument("--canned", type=load_canned, default=None,
+                        help="常に返す判定結果（JSON文字列、またはJSONファイルのパス）")
+    args = parser.parse_args(argv)
+
+    state = FakeOpenAIState(args.latency, args.error_rate, args.retry_after, args.canned)
+    server = ThreadingHTTPServer((args.host, args.port), _make_handler(state))
+    print(f"OpenAI スタンドインサーバーを起動しました: http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"統計: {state.stats()}")
+
+if __name__ == "__main__":
+    main()
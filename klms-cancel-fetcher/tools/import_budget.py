@@ -0,0 +1,110 @@
+"""
+起動時間（インポート時間）の確認ツール
+
+各モジュールを新しいPythonプロセスで空のディレクトリからインポートし、インポートにかかった時間（中央値）が
+予算内に収まっているか、重いパッケージ（openai・tiktoken）を読み込んでいないか、
+ファイルやディレクトリ（data/・logs/・results/ など）を作成していないかを確認します。
+API キーは未設定の状態でインポートします（/health・/latest だけを使うプロセスはキーなしで起動できる必要がある）。
+1つでも条件を満たさないモジュールがあれば終了コード 1 で終了します。
+
+使い方（klms-cancel-fetcher ディレクトリで実行）:
+    python3 -m tools.import_budget
+    python3 -m tools.import_budget --repeat 10 --budget main=150 --budget api_server=800
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from typing import Dict, List
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# モジュールごとのインポート時間の予算（ミリ秒）
+DEFAULT_BUDGETS = {
+    'config': 50,
+    'main': 300,
+    'api_server': 900,
+}
+
+# インポートしただけでは読み込んではいけないパッケージ（最初に使うときに読み込む）
+DEFERRED_PACKAGES = ('openai', 'tiktoken')
+
+MEASURE_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'ms': elapsed * 1000, 'loaded': [name for name in {deferred!r} if name in sys.modules]}}))
+"""
+
+def measure(module: str) -> Dict:
+    """モジュールを新しいプロセスで1回インポートし、時間・読み込んだパッケージ・作成したファイルを返す"""
+    env = {name: value for name, value in os.environ.items() if name not in ('CANVAS_ACCESS_TOKEN', 'OPENAI_API_KEY')}
+    env['PYTHONPATH'] = PACKAGE_DIR
+    with tempfile.TemporaryDirectory() as workdir:
+        completed = subprocess.run(
+            [sys.executable, '-c', MEASURE_SCRIPT.format(module=module, deferred=DEFERRED_PACKAGES)],
+            cwd=workdir, env=env, capture_output=True, text=True
+        )
+        created = sorted(os.listdir(workdir))
+    if completed.returncode != 0:
+        return {'error': completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else 'unknown error'}
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result['created'] = created
+    return result
+
+def check(module: str, budget_ms: float, repeat: int) -> Dict:
+    """repeat 回計測して中央値を予算と比べる"""
+    runs = [measure(module) for _ in range(repeat)]
+    errors = [run['error'] for run in runs if 'error' in run]
+    if errors:
+        return {'module': module, 'ok': False, 'error': errors[0]}
+    median_ms = statistics.median(run['ms'] for run in runs)
+    loaded = sorted({name for run in runs for name in run['loaded']})
+    created = sorted({name for run in runs for name in run['created']})
+    return {
+        'module': module,
+        'median_ms': median_ms,
+        'budget_ms': budget_ms,
+        'loaded': loaded,
+        'created': created,
+        'ok': median_ms <= budget_ms and not loaded and not created
+    }
+
+def parse_budgets(values: List[str]) -> Dict[str, float]:
+    budgets = dict(DEFAULT_BUDGETS)
+    for value in values:
+        module, _, ms = value.partition('=')
+        budgets[module] = float(ms)
+    return budgets
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="インポート時間の確認")
+    parser.add_argument("--repeat", type=int, default=5, help="モジュールごとの計測回数（既定: 5）")
+    parser.add_argument("--budget", action="append", default=[], metavar="MODULE=MS",
+                        help="モジュールの予算（ミリ秒）。複数指定でき、確認するモジュールを追加できる")
+    args = parser.parse_args(argv)
+
+    failed = False
+    for module, budget_ms in parse_budgets(args.budget).items():
+        result = check(module, budget_ms, args.repeat)
+        if 'error' in result:
+            print(f"NG {module}: インポートに失敗しました: {result['error']}")
+            failed = True
+            continue
+        status = "OK" if result['ok'] else "NG"
+        print(f"{status} {module}: {result['median_ms']:.0f}ms（予算 {budget_ms:.0f}ms）")
+        if result['loaded']:
+            print(f"   インポート時に読み込まれたパッケージ: {', '.join(result['loaded'])}")
+        if result['created']:
+            print(f"   インポート時に作成されたファイル: {', '.join(result['created'])}")
+        failed = failed or not result['ok']
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+シリアライズ・圧縮のベンチマーク
+
+休講情報の結果（/api/kyukou/latest の応答）と、1回の実行で保存する Canvas APIの応答キャッシュ・結果ログを
+模したデータを作り、JSONのバックエンド（json・orjson）と圧縮方式ごとのバイト数・CPU時間を比べます。
+基準は以前の書き方（標準の json で ensure_ascii=False・圧縮なし）で、1リクエストあたり・1回の実行あたりの
+削減量を表示します。
+
+使い方（klms-cancel-fetcher ディレクトリで実行）:
+    python3 -m tools.serialization_bench
+    python3 -m tools.serialization_bench --cancellations 200 --courses 30 --announcements 20
+"""
+
+import argparse
+import gzip
+import json
+import random
+import time
+import zlib
+from typing import Callable, Dict, List, Optional, Tuple
+
+from compression import _get_brotli
+from serialization import _select_backend
+
+def make_result(cancellations: int) -> Dict:
+    """/api/kyukou/latest の応答を模した結果"""
+    random.seed(0)
+    return {
+        'summary': {
+            'total_courses': 15,
+            'total_cancellations': cancellations,
+            'analyzed_at': '2025-07-02T10:30:00',
+            'source': 'latest_result'
+        },
+        'cancellations': [
+            {
+                'course_id': 10000 + i % 15,
+                'course_name': f'データサイエンス入門 {i % 15}',
+                'announcement_id': 500000 + i,
+                'announcement_title': f'【休講】{i % 28 + 1}日の授業について',
+                'analyzed_at': '2025-07-02T10:30:00',
+                'canceled': True,
+                'course': f'データサイエンス入門 {i % 15}',
+                'date': f'2025-07-{i % 28 + 1:02d}',
+                'period': f'{random.randint(1, 6)}限',
+                'message': f'7月{i % 28 + 1}日の{random.randint(1, 6)}限の授業は、担当教員の出張のため休講とします。補講は後日連絡します。',
+                'reason': '出張',
+                'confidence': round(random.random(), 2)
+            }
+            for i in range(cancellations)
+        ]
+    }
+
+def make_announcements(count: int) -> List[Dict]:
+    """Canvas APIのお知らせ一覧の応答（1コース分）を模したデータ"""
+    return [
+        {
+            'id': 700000 + i,
+            'title': f'第{i + 1}回の授業について',
+            'message': '<p>' + '受講者の皆さん、' + '次回の授業では前回の課題を解説します。資料を事前に確認してください。' * 8 + '</p>',
+            'posted_at': f'2025-06-{i % 28 + 1:02d}T09:00:00Z',
+            'context_code': f'course_{10000 + i % 15}',
+            'author': {'id': 42, 'display_name': '担当教員', 'html_url': 'https://lms.example.ac.jp/about/42'},
+            'read_state': 'unread',
+            'html_url': f'https://lms.example.ac.jp/courses/10000/discussion_topics/{700000 + i}'
+        }
+        for i in range(count)
+    ]
+
+def cpu_time(fn: Callable[[], object], repeat: int) -> float:
+    """fn の1回あたりのCPU時間（マイクロ秒）"""
+    start = time.process_time()
+    for _ in range(repeat):
+        fn()
+    return (time.process_time() - start) / repeat * 1e6
+
+def baseline_dumps(obj) -> bytes:
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+def compressors() -> List[Tuple[str, Optional[Callable[[bytes], bytes]]]]:
+    available = [('none', None), ('gzip', lambda body: gzip.compress(body, compresslevel=6, mtime=0))]
+    brotli = _get_brotli()
+    if brotli is not None:
+        available.append(('br', lambda body: brotli.compress(body, quality=5)))
+    return available
+
+def bench_request(result: Dict, repeat: int) -> List[Dict]:
+    """1リクエスト分（最新の結果のシリアライズと圧縮）"""
+    rows = []
+    backends = [('json(以前)', baseline_dumps)] + [(name, _select_backend(name).dumps) for name in ('json', 'orjson')]
+    for backend_name, encode in backends:
+        body = encode(result)
+        encode_us = cpu_time(lambda: encode(result), repeat)
+        for compression_name, compress in compressors():
+            if compress is None:
+                rows.append({'name': f"{backend_name} / {compression_name}", 'bytes': len(body), 'cpu_us': encode_us})
+                continue
+            compressed = compress(body)
+            compress_us = cpu_time(lambda: compress(body), repeat)
+            rows.append({
+                'name': f"{backend_name} / {compression_name}",
+                'bytes': len(compressed),
+                'cpu_us': encode_us + compress_us
+            })
+    return rows
+
+def bench_run(result: Dict, courses: int, announcements: int, repeat: int) -> List[Dict]:
+    """1回の実行分（Canvas APIの応答キャッシュへの保存・読み込みと結果ログへの追記）"""
+    pages = [make_announcements(announcements) for _ in range(courses)]
+    rows = []
+    variants = [
+        ('json(以前) / 圧縮なし', json.loads, baseline_dumps, False),
+        ('json / 圧縮なし', json.loads, _select_backend('json').dumps, False),
+        ('orjson / 圧縮なし', _select_backend('orjson').loads, _select_backend('orjson').dumps, False),
+        ('orjson / compact', _select_backend('orjson').loads, _select_backend('orjson').dumps, True),
+    ]
+    for name, decode, encode, compact in variants:
+        def run():
+            stored = 0
+            for page in pages:
+                body = encode(page)
+                if compact:
+                    body = zlib.compress(body, 6)
+                stored += len(body)
+                decode(zlib.decompress(body) if compact else body)
+            stored += len(encode(result)) + 1
+            return stored
+        rows.append({'name': name, 'bytes': run(), 'cpu_us': cpu_time(run, max(repeat // 20, 1))})
+    return rows
+
+def print_rows(title: str, rows: List[Dict]):
+    baseline = rows[0]
+    print(f"\n== {title} ==")
+    print(f"{'方式':<24}{'バイト数':>12}{'CPU時間(µs)':>14}{'削減バイト':>12}{'削減CPU(µs)':>14}")
+    for row in rows:
+        print(
+            f"{row['name']:<24}{row['bytes']:>12,}{row['cpu_us']:>14.1f}"
+            f"{baseline['bytes'] - row['bytes']:>12,}{baseline['cpu_us'] - row['cpu_us']:>14.1f}"
+        )
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="シリアライズ・圧縮のベンチマーク")
+    parser.add_argument("--cancellations", type=int, default=50, help="結果に含める休講情報の件数（既定: 50）")
+    parser.add_argument("--courses", type=int, default=15, help="1回の実行で取得するコース数（既定: 15）")
+    parser.add_argument("--announcements", type=int, default=10, help="コースごとのお知らせ数（既定: 10）")
+    parser.add_argument("--repeat", type=int, default=200, help="計測の繰り返し回数（既定: 200）")
+    args = parser.parse_args(argv)
+
+    if _select_backend('orjson').name != 'orjson':
+        print("orjson がインストールされていないため、orjson の行は標準の json の値です。")
+    if _get_brotli() is None:
+        print("brotli がインストールされていないため、brotli の行は表示しません。")
+
+    result = make_result(args.cancellations)
+    print_rows(f"1リクエストあたり（休講情報 {args.cancellations}件の最新の結果）", bench_request(result, args.repeat))
+    print_rows(
+        f"1回の実行あたり（{args.courses}コース × お知らせ {args.announcements}件の応答キャッシュと結果ログ）",
+        bench_run(result, args.courses, args.announcements, args.repeat)
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+関連度モデル（relevance_model）の学習ツール
+
+これまでにGPTで判定した結果（データベースの analyses テーブル）を学習データにして、
+休講に関係するお知らせかどうかのモデルを学習し、RELEVANCE_MODEL_FILE に保存します。
+ラベル付きコーパス（tools/evaluate_rules.py と同じ形式のJSONL）を --corpus で追加できます。
+
+しきい値は交差検証で決めます。各分割で学習したモデルで残りのお知らせを採点し（学習に使っていない採点）、
+休講のお知らせのうち --recall-target の割合以上がしきい値以上になる（GPTに送られる）ように選びます。
+そのしきい値での再現率・適合率・GPT呼び出しの削減率を表示し、最後に全件で学習し直したモデルを保存します。
+
+使い方（klms-cancel-fetcher ディレクトリで実行）:
+    python3 -m tools.train_relevance
+    python3 -m tools.train_relevance --recall-target 0.995 --corpus tools/corpus/cancellation_corpus.jsonl
+    python3 -m tools.train_relevance --dry-run
+"""
+
+import argparse
+import random
+import sys
+import time
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+from database import get_connection
+from relevance_model import document_text, save_model, threshold_for_recall, train_model
+from serialization import loads
+from text_preprocessor import prepare_body
+from config import Config
+
+def load_verdicts() -> List[Tuple[str, bool]]:
+    """analyses テーブルの判定結果を (document_text, 休講かどうか) のリストで返す"""
+    examples = []
+    for row in get_connection().execute("SELECT title, body, result FROM analyses"):
+        try:
+            result = loads(row['result'])
+        except ValueError:
+            continue
+        if not isinstance(result, dict) or 'canceled' not in result:
+            continue
+        examples.append((document_text(row['title'] or "", row['body'] or ""), bool(result['canceled'])))
+    return examples
+
+def load_corpus(path: str) -> List[Tuple[str, bool]]:
+    """ラベル付きコーパス（JSONL）を読み込む（本文は判定時と同じ前処理をする）"""
+    from tools.evaluate_rules import load_corpus as load_jsonl
+    return [
+        (document_text(example['title'], prepare_body(example['body'])[0]), bool(example['label'].get('canceled')))
+        for example in load_jsonl(path)
+    ]
+
+def deduplicate(examples: List[Tuple[str, bool]]) -> List[Tuple[str, bool]]:
+    """同じテキストのお知らせは1件にする（ラベルが食い違う場合は休講を優先する）"""
+    labels: Dict[str, bool] = {}
+    for text, label in examples:
+        labels[text] = labels.get(text, False) or label
+    return list(labels.items())
+
+def cross_validate(texts: List[str], labels: List[bool], folds: int, options: Dict) -> List[float]:
+    """層化 k 分割交差検証で、各お知らせを学習に使っていないモデルで採点したスコアを返す"""
+    if folds < 2:
+        raise ValueError(f"交差検証の分割数は2以上が必要です: {folds}")
+    rng = random.Random(0)
+    fold_of = [0] * len(texts)
+    for label in (True, False):
+        indexes = [i for i, value in enumerate(labels) if value == label]
+        rng.shuffle(indexes)
+        for position, index in enumerate(indexes):
+            fold_of[index] = position % folds
+
+    scores = [0.0] * len(texts)
+    for fold in range(folds):
+        train = [i for i in range(len(texts)) if fold_of[i] != fold]
+        held_out = [i for i in range(len(texts)) if fold_of[i] == fold]
+        if not held_out:
+            continue
+        model = train_model([texts[i] for i in train], [labels[i] for i in train], **options)
+        for index, score in zip(held_out, model.score_many(texts[i] for i in held_out)):
+            scores[index] = score
+    return scores
+
+def evaluate_threshold(scores: List[float], labels: List[bool], threshold: float) -> Dict:
+    """しきい値で絞り込んだときの再現率・適合率・GPT呼び出しの削減率"""
+    passed = [label for score, label in zip(scores, labels) if score >= threshold]
+    positives = sum(1 for label in labels if label)
+    true_positives = sum(1 for label in passed if label)
+    return {
+        'examples': len(labels),
+        'positives': positives,
+        'recall': true_positives / positives if positives else None,
+        'precision': true_positives / len(passed) if passed else None,
+        'gpt_calls_avoided': (len(labels) - len(passed)) / len(labels) if labels else None,
+        'missed': positives - true_positives
+    }
+
+def _format_ratio(value) -> str:
+    return "-" if value is None else f"{value:.1%}"
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="関連度モデルの学習")
+    parser.add_argument("--recall-target", type=float, default=None,
+                        help=f"休講のお知らせのうちGPTに送る割合の目標（既定: RELEVANCE_RECALL_TARGET={Config.RELEVANCE_RECALL_TARGET}）")
+    parser.add_argument("--corpus", action="append", default=[], help="学習データに追加するラベル付きコーパス（JSONL）")
+    parser.add_argument("--output", default=None, help=f"モデルの保存先（既定: {Config.RELEVANCE_MODEL_FILE}）")
+    parser.add_argument("--folds", type=int, default=5, help="しきい値を決める交差検証の分割数（既定: 5）")
+    parser.add_argument("--epochs", type=int, default=10, help="学習の繰り返し回数（既定: 10）")
+    parser.add_argument("--min-df", type=int, default=2, help="特徴に使う n-gram の最小の文書頻度（既定: 2）")
+    parser.add_argument("--max-features", type=int, default=50000, help="特徴に使う n-gram の数の上限（既定: 50000）")
+    parser.add_argument("--min-positives", type=int, default=10,
+                        help="休講のお知らせがこの件数より少ない場合は保存せずに終了コード1で終了する（既定: 10）")
+    parser.add_argument("--dry-run", action="store_true", help="評価だけを表示してモデルを保存しない")
+    args = parser.parse_args(argv)
+    if args.folds < 2:
+        parser.error("--folds は2以上を指定してください（しきい値は学習に使っていないお知らせのスコアで決めます）")
+
+    recall_target = args.recall_target if args.recall_target is not None else Config.RELEVANCE_RECALL_TARGET
+    examples = load_verdicts()
+    print(f"GPTの判定結果: {len(examples)}件")
+    for path in args.corpus:
+        corpus = load_corpus(path)
+        print(f"コーパス {path}: {len(corpus)}件")
+        examples.extend(corpus)
+    examples = deduplicate(examples)
+
+    texts = [text for text, _ in examples]
+    labels = [label for _, label in examples]
+    positives = sum(1 for label in labels if label)
+    print(f"学習データ: {len(examples)}件（休講 {positives}件 / 休講以外 {len(examples) - positives}件）")
+    # 交差検証には休講のお知らせが2件以上必要（1分割では学習データが空になる）
+    min_positives = max(args.min_positives, 2)
+    if positives < min_positives or positives == len(labels):
+        print(f"休講・休講以外のお知らせが足りないため学習しません（休講 {min_positives}件以上と休講以外が必要です）")
+        return 1
+
+    options = {'epochs': args.epochs, 'min_df': args.min_df, 'max_features': args.max_features}
+    started = time.perf_counter()
+    scores = cross_validate(texts, labels, min(args.folds, positives), options)
+    threshold = threshold_for_recall([score for score, label in zip(scores, labels) if label], recall_target)
+    validation = evaluate_threshold(scores, labels, threshold)
+    print(f"しきい値: {threshold:.4f}（再現率の目標 {recall_target:.1%}）")
+    print(f"交差検証の再現率: {_format_ratio(validation['recall'])}（見逃し {validation['missed']}件）")
+    print(f"交差検証の適合率: {_format_ratio(validation['precision'])}")
+    print(f"GPT呼び出しの削減率: {_format_ratio(validation['gpt_calls_avoided'])}")
+
+    model = train_model(texts, labels, **options)
+    model.threshold = threshold
+    model.metadata = {
+        'trained_at': datetime.now().isoformat(timespec='seconds'),
+        'recall_target': recall_target,
+        'validation': validation
+    }
+    print(f"特徴の数: {len(model.features)}（学習時間 {time.perf_counter() - started:.1f}秒）")
+
+    if args.dry_run:
+        return 0
+    output = args.output or Config.RELEVANCE_MODEL_FILE
+    save_model(model, output)
+    print(f"モデルを保存しました: {output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())